@@ -5,7 +5,7 @@ import pickle
 from pymbar import MBAR
 from .Restraint import *
 from .PosteriorSampler import *
-from .toolbox import get_files
+from .toolbox import get_files, discard_burn_in, decode_state_trace
 import matplotlib
 matplotlib.use('Agg')
 from matplotlib import pyplot as plt
@@ -75,13 +75,15 @@ class Analysis(object):
         for filename in exp_files:
             if self.verbose: print('Loading %s ...'%filename)
             traj = np.load(filename, allow_pickle=True )['arr_0'].item()
+            traj = discard_burn_in(traj)
             self.traj.append(traj)
         self.nreplicas = len(traj['trajectory'][0][3])
-        if self.precheck:
+        # Reservoir (low-memory) trajectories do not store the state trace
+        if self.precheck and not any(traj.get('reservoir') for traj in self.traj):
             steps = []
             fractions = []
             for i in range(len(self.traj)):
-                s,f = find_all_state_sampled_time(self.traj[i]['state_trace'],self.states)
+                s,f = find_all_state_sampled_time(decode_state_trace(self.traj[i]),self.states)
                 steps.append(s)
                 fractions.append(f)
             total_fractions = np.concatenate(fractions)
@@ -121,7 +123,10 @@ class Analysis(object):
         #   of snapshot n \in 1,...,N_k of simulation k \in 1,...,K evaluated at reduced potential for state l.
         self.K = self.nlambda   # number of thermodynamic ensembles
         # N_k[k] will denote the number of correlated snapshots from state k
-        N_k = np.array( [len(self.traj[i]['trajectory']) for i in range(self.nlambda)] )
+        # Run-length encoded snapshots are evaluated once per run (see toolbox.compress_trajectory)
+        run_lengths = [np.asarray(self.traj[i].get('run_lengths', np.ones(len(self.traj[i]['trajectory']))),
+            dtype=int) for i in range(self.nlambda)]
+        N_k = np.array( [lengths.sum() for lengths in run_lengths] )
         nsnaps = N_k.max()
         u_kln = np.zeros( (self.K, self.K, nsnaps) )
         nstates = int(self.states)
@@ -138,16 +143,18 @@ class Analysis(object):
 
         # Get snapshot energies rescored in the different ensembles
         """['step', 'E', 'accept', 'state', [nuisance parameters]]"""
-        for n in range(nsnaps):
-            for k in range(self.K):
+        for k in range(self.K):
+            ends = np.cumsum(run_lengths[k])
+            for n in range(len(run_lengths[k])):
+                state, sigma_index = self.traj[k]['trajectory'][n][3:]
+                snaps = slice(ends[n]-run_lengths[k][n], ends[n])
+                for r in range(self.nreplicas):
+                    states_kn[k,snaps,r] = state[r]
                 for l in range(self.K):
                     if debug: print('step', self.traj[k]['trajectory'][n][0], end=' ')
                     if k==l:
-                        u_kln[k,k,n] = self.traj[k]['trajectory'][n][1]
+                        u_kln[k,k,snaps] = self.traj[k]['trajectory'][n][1]
                     else:
-                        state, sigma_index = self.traj[k]['trajectory'][n][3:]
-                        for r in range(self.nreplicas):
-                            states_kn[k,n,r] = state[r]
                         temp_parameters = []
                         new_parameters=[[] for i in range(len(temp_parameters_indices))]
                         temp_parameter_indices = np.concatenate(sigma_index)
@@ -155,8 +162,8 @@ class Analysis(object):
                             temp_parameters.append(self.traj[k]['allowed_parameters'][ind][temp_parameter_indices[ind]])
                         for m in range(len(original_index)):
                             new_parameters[original_index[m]].append(temp_parameters[m])
-                        u_kln[k,l,n] = self.sampler[l].neglogP(state, new_parameters, sigma_index)
-                        if debug: print('E_%d evaluated in model_%d'%(k,l), u_kln[k,l,n])
+                        u_kln[k,l,snaps] = self.sampler[l].neglogP(state, new_parameters, sigma_index)
+                        if debug: print('E_%d evaluated in model_%d'%(k,l), u_kln[k,l,snaps.start])
 
 
         # Initialize MBAR with reduced energies u_kln and number of uncorrelated configurations from each state N_k.
@@ -164,7 +171,14 @@ class Analysis(object):
         # beta is the inverse temperature, and and x_kn denotes uncorrelated configuration n from state k.
         # N_k[k] is the number of configurations from state k stored in u_knm
         # Note that this step may take some time, as the relative dimensionless free energies f_k are determined at this point.
-        mbar = MBAR(u_kln, N_k)
+        # Expanded-ensemble weights converge to the relative free energies
+        # of each lambda and serve as the initial guess for MBAR
+        initial_f_k = None
+        expanded = [traj.get('expanded', {}) for traj in self.traj]
+        if all(expanded) and all(set(self.lam) <= set(e['lambdas']) for e in expanded):
+            weights = [expanded[0]['weights'][expanded[0]['lambdas'].index(lam)] for lam in self.lam]
+            initial_f_k = np.array(weights) - weights[0]
+        mbar = MBAR(u_kln, N_k, initial_f_k=initial_f_k)
 
         # Extract dimensionless free energy differences and their statistical uncertainties.
 #       (Deltaf_ij, dDeltaf_ij) = mbar.getFreeEnergyDifferences()
@@ -186,7 +200,7 @@ class Analysis(object):
         states_kn = np.array(states_kn)
         for i in range(nstates):
             sampled = np.array([np.where(states_kn[:,:,r]==i,1,0) for r in range(self.nreplicas)])
-            A_kn = sampled.sum(axis=0)
+            A_kn = sampled.sum(axis=0)/float(self.nreplicas)  # fraction of replicas in state i
             (p_i, dp_i) = mbar.computeExpectations(A_kn, uncertainty_method='approximate')
             self.P_dP[i,0:self.K] = p_i
             self.P_dP[i,self.K:2*self.K] = dp_i
@@ -1,14 +1,21 @@
 # -*- coding: utf-8 -*-
 import numpy as np
-import inspect, time
+import os, inspect, time, pickle
 from .KarplusRelation import *     # Returns J-coupling values from dihedral angles
 from .Restraint import *
 from .toolbox import *
+from .convergence import ConvergenceMonitor
 from tqdm import tqdm # progress bar
+from pymbar import timeseries
+
+# Number of steps of PosteriorSampler.sample drawing their random numbers at once
+RANDOM_BATCH = 1000
 
 class PosteriorSampler(object):
 
-    def __init__(self, ensemble, freq_write_traj=100., freq_save_traj=100., verbose=False):
+    def __init__(self, ensemble, freq_write_traj=100., freq_save_traj=100.,
+            nreplicas=1, table_memory=256., cache_size=100000, lambdas=None,
+            wl_factor=1.0, wl_flatness=0.8, max_snapshots=None, shared=None, verbose=False):
         """A class to perform posterior sampling of conformational populations.
 
         Args:
@@ -16,58 +23,197 @@ class PosteriorSampler(object):
             freq_write_traj(int): the frequency (in steps) to write the MCMC trajectory
             freq_print(int): the frequency (in steps) to print status
             freq_save_traj(int): the frequency (in steps) to store the MCMC trajectory
+            nreplicas(int): number of replicas. With more than one replica, the\
+                    forward model observables are averaged over the replica states\
+                    (see :attr:`replica_neglogP`)
+            table_memory(float): memory budget (in MB) for the precomputed energy\
+                    table (see :attr:`build_energy_table`)
+            cache_size(int): maximum number of energies memoized when the table\
+                    does not fit in **table_memory** (and of protection factor\
+                    terms evaluated on demand, see :attr:`pf_neglogP`)
+            lambdas(list): lambda values for expanded-ensemble sampling. If given,\
+                    lambda is sampled within the same chain as an additional\
+                    discrete variable (see :attr:`init_expanded_ensemble`)
+            wl_factor(float): initial Wang-Landau modification factor (ln f)
+            wl_flatness(float): flatness criterion of the lambda visit histogram
+            max_snapshots(int): maximum number of stored trajectory snapshots.\
+                    When full, the save interval is doubled and the stored\
+                    snapshots are decimated (see :attr:`PosteriorSamplingTrajectory.decimate`)
+            shared(str): directory of packed arrays written by :attr:`publish_arrays`,\
+                    attached read-only instead of being computed (see :attr:`attach_arrays`).\
+                    The reference potentials of the restraints are then not built.
         """
 
         self.lam = ensemble.lam
         self.ensemble = ensemble.to_list() # Allow the ensemble to pass through the class
-        self.nreplicas = 1
+        self.nreplicas = int(nreplicas)
         self.write_traj = freq_write_traj # Step frequencies to write trajectory info
         self.traj_every = freq_save_traj # Frequency of storing trajectory samples
+        self.max_snapshots = max_snapshots
         self.nstates = len(self.ensemble) # Ensemble is a list of Restraint objects
+        self.energies = np.array(ensemble.energies, dtype=float) # scaled by lambda
+        self.unscaled_energies = np.array(ensemble.unscaled_energies, dtype=float)
         # The initial state of the structural ensemble we're sampling from
         self.state = 0    # index in the ensemble
         self.state = np.random.randint(low=0, high=self.nstates, size=self.nreplicas)
         self.E = 1.0e99   # initial energy
+        self.indices = None # nuisance parameter indices (grid midpoints unless warm-started)
         self.accepted = 0
         self.total = 0
         # keep track of what we sampled in a trajectory
         self.traj = PosteriorSamplingTrajectory(ensemble=ensemble, sampler=self, nreplicas=self.nreplicas)
-        # for each Restraint, calculate global reference potential parameters
-        # ..by looking across all structures
-        # TODO: can't this be more general?!?
+        for R in self.ensemble[0]:
+            if self.nreplicas > 1 and hasattr(R, 'precomputed') and not R.precomputed:
+                raise ValueError("Replica-averaged protection factors require precomputed=True")
+            if R.ref not in ('uniform', 'exp', 'gaussian'):
+                raise ValueError('Please choose a reference potential of the following:\n \
+                    {%s,%s,%s}'%('uniform','exp','gaussian'))
+        # With shared arrays, the reference potentials are attached with the
+        # other packed arrays instead of being built for every state
+        self.reference_built = False
+        if shared is None: self.build_reference_potentials()
         for i,R in enumerate(self.ensemble[0]):
             if R.ref == "uniform":
                 self.traj.ref[i].append('Nan')
-                pass
             elif R.ref == 'exp':
+                self.traj.ref[i].append(R.betas)
+            elif R.ref == 'gaussian':
+                self.traj.ref[i].append(R.ref_mean)
+                self.traj.ref[i].append(R.ref_sigma)
+        # Compute ref state logZ for the free energies to normalize.
+        self.compute_logZ()
+        self.restraint_arrays = None
+        self.replica_models = None
+        self.table_memory = table_memory
+        self.energy_table = None
+        self.shared = None
+        self.shared_table = None
+        self.cache_size = cache_size
+        self.energy_cache = LRUCache(maxsize=cache_size)
+        self.pf_cache = LRUCache(maxsize=cache_size)
+        self.verbose = verbose
+        self.lambdas = None
+        if shared is not None: self.attach_arrays(shared)
+        if lambdas is not None:
+            self.init_expanded_ensemble(ensemble, lambdas, wl_factor, wl_flatness)
+
+    def __getstate__(self):
+        """Pickle the sampler without the energy table, the energy caches and
+        the stacked (or memory-mapped) arrays, which are rebuilt on first use."""
+
+        state = self.__dict__.copy()
+        for key in ["energy_table", "shared_table", "restraint_arrays", "replica_models", "shared"]:
+            state[key] = None
+        state.pop("energy_cache", None)
+        state.pop("pf_cache", None)
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.energy_cache = LRUCache(maxsize=self.cache_size)
+        self.pf_cache = LRUCache(maxsize=self.cache_size)
+
+
+    def build_reference_potentials(self):
+        """For each Restraint, calculate global reference potential parameters
+        by looking across all structures."""
+
+        # TODO: can't this be more general?!?
+        for i,R in enumerate(self.ensemble[0]):
+            if R.ref == 'exp':
                 if hasattr(R, 'precomputed'):
-                    if not R.precomputed:
+                    if not (R.precomputed or R.lazy):
                         self.build_exp_ref_pf(i)
                 else:
                     self.build_exp_ref(i)
-                self.traj.ref[i].append(R.betas)
             elif R.ref == 'gaussian':
                 if hasattr(R, 'precomputed'):
-                    if not R.precomputed:
+                    if not (R.precomputed or R.lazy):
                         self.build_gaussian_ref_pf(i, use_global_ref_sigma=R.use_global_ref_sigma)
                 else:
                     self.build_gaussian_ref(i, use_global_ref_sigma=R.use_global_ref_sigma)
-                self.traj.ref[i].append(R.ref_mean)
-                self.traj.ref[i].append(R.ref_sigma)
-            else:
-                raise ValueError('Please choose a reference potential of the following:\n \
-                    {%s,%s,%s}'%('uniform','exp','gaussian'))
-        # Compute ref state logZ for the free energies to normalize.
-        self.compute_logZ()
-        self.verbose = verbose
+        self.reference_built = True
+
 
     def compute_logZ(self):
         """Compute reference state logZ for the free energies to normalize."""
 
-        Z = 0.0
-        for s in self.ensemble:
-            Z +=  np.exp( -np.array(s[0].energy, dtype=np.float128) )
-        self.logZ = np.log(Z)
+        self.logZ = logsumexp(-np.asarray(self.energies, dtype=float))
+
+
+    def init_expanded_ensemble(self, ensemble, lambdas, wl_factor=1.0, wl_flatness=0.8):
+        """Set up expanded-ensemble sampling, where the index of lambda is
+        sampled by the same chain as the conformational state and nuisance
+        parameters. Only the scaled energies and logZ depend on lambda, so
+        one set of restraints is shared by all lambda values. The lambda
+        weights are adapted with the Wang-Landau scheme to flatten the
+        visits of each lambda and converge to the relative free energies.
+        A separate :attr:`PosteriorSamplingTrajectory` is recorded for each
+        lambda (see :attr:`process_results`).
+
+        Args:
+            ensemble(object): a :attr:`biceps.Ensemble` object
+            lambdas(list): lambda values (must include the lambda of **ensemble**)
+            wl_factor(float): initial Wang-Landau modification factor (ln f)
+            wl_flatness(float): flatness criterion of the lambda visit histogram
+        """
+
+        lambdas = [float(lam) for lam in lambdas]
+        if len(set(lambdas)) != len(lambdas):
+            raise ValueError("lambdas should be unique")
+        if self.lam not in lambdas:
+            raise ValueError("lambdas should include the lambda of the ensemble (%s)"%self.lam)
+        self.lambdas = lambdas
+        self.lambda_energies = np.array([lam*np.array(ensemble.unscaled_energies,
+            dtype=float) for lam in lambdas])
+        self.lambda_logZ = np.zeros(len(lambdas))
+        for k in range(len(lambdas)):
+            self.energies = self.lambda_energies[k]
+            self.compute_logZ()
+            self.lambda_logZ[k] = self.logZ
+        self.lambda_weights = np.zeros(len(lambdas))  # Wang-Landau log-weights
+        self.lambda_counts = np.zeros(len(lambdas))   # visits since the last update of ln f
+        self.lambda_accepted = 0
+        self.lambda_total = 0
+        self.wl_factor = wl_factor
+        self.wl_flatness = wl_flatness
+        self.trajs = []
+        for lam in lambdas:
+            traj = PosteriorSamplingTrajectory(ensemble=ensemble, sampler=self, nreplicas=self.nreplicas)
+            traj.lam = lam
+            traj.ref = self.traj.ref
+            self.trajs.append(traj)
+        self.set_lambda(lambdas.index(self.lam))
+
+
+    def set_lambda(self, index):
+        """Switch the sampler to the lambda value **lambdas[index]** in
+        expanded-ensemble sampling.
+
+        Args:
+            index(int): index of the lambda value
+        """
+
+        self.lambda_index = int(index)
+        self.lam = self.lambdas[self.lambda_index]
+        self.energies = self.lambda_energies[self.lambda_index]
+        self.logZ = self.lambda_logZ[self.lambda_index]
+        self.traj = self.trajs[self.lambda_index]
+
+
+    def observable_matrix(self, rest_index, key='model'):
+        """Return the values of **key** (e.g., 'model', 'weight') of every
+        observable of a restraint for every structure.
+
+        Args:
+            rest_index(int): restraint index
+            key(str): name of the field
+
+        :rtype np.ndarray: array with shape (nstates, nobservables)
+        """
+
+        return np.array([s[rest_index].get_observables(key) for s in self.ensemble], dtype=float)
 
 
     def build_exp_ref(self, rest_index, verbose=False):
@@ -82,25 +228,19 @@ class PosteriorSampler(object):
         """
 
         # collect distributions of observables r_j across all structures
-        n_observables  = self.ensemble[0][rest_index].n  # the number of (model,exp) data values in this restraint
-        distributions = [[] for j in range(n_observables)]
-        for s in self.ensemble:   # s is a list of Restraint() objects, we are considering the rest_index^th restraint
-            for j in range(len(s[rest_index].restraints)):
-                if verbose == True:
-                    print( s[rest_index].restraints[j]['model'])
-                distributions[j].append( s[rest_index].restraints[j]['model'] )
+        distributions = self.observable_matrix(rest_index, 'model')
         if verbose == True:
             print('distributions',distributions)
         # Find the MLE average (i.e. beta_j) for each noe
-        # calculate beta[j] for every observable r_j
-        self.betas = np.zeros(n_observables)
-        for j in range(n_observables):
-            # the maximum likelihood exponential distribution fitting the data
-            self.betas[j] =  np.array(distributions[j]).sum()/(len(distributions[j])+1.0)
-        # store the beta information in each structure and compute/store the -log P_potential
-        for s in self.ensemble:
+        # the maximum likelihood exponential distribution fitting the data
+        self.betas = distributions.sum(axis=0)/(len(distributions)+1.0)
+        # compute the -log P_potential of every structure at once, then store it in each structure
+        neglog_exp_ref = np.log(self.betas) + distributions/self.betas
+        sums = np.sum(self.observable_matrix(rest_index, 'weight')*neglog_exp_ref, axis=1)
+        for i,s in enumerate(self.ensemble):
             s[rest_index].betas = self.betas
-            s[rest_index].compute_neglog_exp_ref()
+            s[rest_index].neglog_exp_ref = neglog_exp_ref[i]
+            s[rest_index].sum_neglog_exp_ref = sums[i]
 
 
     def build_gaussian_ref(self, rest_index, use_global_ref_sigma=False, verbose=False):
@@ -113,97 +253,84 @@ class PosteriorSampler(object):
             use_global_ref_sigma(bool):
         """
 
-        #print( 'Computing parameters for Gaussian reference potentials...')
         # collect distributions of observables r_j across all structures
-        n_observables  = self.ensemble[0][rest_index].n  # the number of (model,exp) data values in this restraint
-        #print('n_observables = ',n_observables)
-        distributions = [[] for j in range(n_observables)]
-        for s in self.ensemble:   # s is a list of Restraint() objects, we are considering the rest_index^th restraint
-            for j in range(len(s[rest_index].restraints)):
-                if verbose == True:
-                    print( s[rest_index].restraints[j]['model'])
-                distributions[j].append( s[rest_index].restraints[j]['model'] )
+        distributions = self.observable_matrix(rest_index, 'model')
         if verbose == True:
             print('distributions',distributions)
         # Find the MLE mean (ref_mu_j) and std (ref_sigma_j) for each observable
-        self.ref_mean  = np.zeros(n_observables)
-        self.ref_sigma = np.zeros(n_observables)
-        for j in range(n_observables):
-            self.ref_mean[j] =  np.array(distributions[j]).mean()
-            squared_diffs = [ (d - self.ref_mean[j])**2.0 for d in distributions[j] ]
-            self.ref_sigma[j] = np.sqrt( np.array(squared_diffs).sum() / (len(distributions[j])+1.0))
-            #print(self.ref_sigma[j])
-        #print('ref_mean',self.ref_mean)
-        #print('ref_sigma',self.ref_sigma)
+        self.ref_mean = distributions.mean(axis=0)
+        squared_diffs = (distributions - self.ref_mean)**2.0
+        self.ref_sigma = np.sqrt(squared_diffs.sum(axis=0)/(len(distributions)+1.0))
         if use_global_ref_sigma == True:
             # Use the variance across all ref_sigma[j] values to calculate a single value of ref_sigma for all observables
-            global_ref_sigma = ( np.array([self.ref_sigma[j]**(-2.0) for j in range(n_observables)]).mean() )**-0.5
-            for j in range(n_observables):
-                self.ref_sigma[j] = global_ref_sigma
-                #print(self.ref_sigma[j])
-
-        # store the ref_mean and ref_sigma information in each structure and compute/store the -log P_potential
-        for s in self.ensemble:
+            global_ref_sigma = (np.mean(self.ref_sigma**(-2.0)))**-0.5
+            self.ref_sigma = np.full(len(self.ref_sigma), global_ref_sigma)
+
+        # compute the -log P_potential of every structure at once, then store it in each structure
+        neglog_gaussian_ref = np.log(np.sqrt(2.0*np.pi)) + np.log(self.ref_sigma)\
+                + squared_diffs/(2.0*self.ref_sigma**2.0)
+        sums = np.sum(self.observable_matrix(rest_index, 'weight')*neglog_gaussian_ref, axis=1)
+        for i,s in enumerate(self.ensemble):
             s[rest_index].ref_mean = self.ref_mean
             s[rest_index].ref_sigma = self.ref_sigma
-            s[rest_index].compute_neglog_gaussian_ref()
+            s[rest_index].neglog_gaussian_ref = neglog_gaussian_ref[i]
+            s[rest_index].sum_neglog_gaussian_ref = sums[i]
 
 
     def build_exp_ref_pf(self,rest_index):
-        """Calculate the MLE average PF values for restraint j across all structures,
-
-        ``beta_PF_j = np.array(protectionfactor_distributions[j]).sum()/(len(protectionfactor_distributions[j])+1.0)``
-
-        then use this information to compute the reference prior for each structures.
+        """Compute the exponential reference prior of the protection factors
+        for each structure. The reference potential only depends on the
+        predicted PF of the structure itself (see
+        :attr:`biceps.Restraint.Restraint_pf.compute_neglog_exp_ref_pf`), so no
+        averages across structures are stored.
 
         .. tip:: **(not required)** an additional method specific for protection factor
         """
 
-        # collect distributions of observables r_j across all structures
-        n_observables  = self.ensemble[0][rest_index].n  # the number of (model,exp) data values in this restraint
-
-        for s in self.ensemble:   # s is a list of Restraint() objects, we are considering the rest_index^th restraint
-            s[rest_index].betas = []
-        # for each restraint, find the average model_protectionfactor (a 6-dim array in parameter space) across all structures
-        for j in range(len(s[rest_index].restraints)):
-            running_total = np.zeros(self.ensemble[0][rest_index].restraints[j]['model'].shape)
-            for s in self.ensemble:
-                running_total += s[rest_index].restraints[j]['model']
-            beta_pf_j = running_total/(len(s[rest_index].restraints)+1.0)
-            for s in self.ensemble:
-                s[rest_index].betas.append(beta_pf_j)
-        # With the beta_PF_j values computed (and stored in each structure), now we can calculate the neglog reference potentials
         for s in self.ensemble:
             s[rest_index].compute_neglog_exp_ref_pf()
 
 
-    def build_gaussian_ref_pf(self, rest_index):
+    def build_gaussian_ref_pf(self, rest_index, use_global_ref_sigma=False):
         """Calculate the mean and std PF values for restraint j across all structures,
         then use this information to compute a gaussian reference prior for each structure.
+        The predicted PF grids are evaluated one residue at a time and accumulated
+        in place.
 
         .. tip:: **(not required)** an additional method specific for protection factor
+
+        Args:
+            rest_index(int): restraint index
+            use_global_ref_sigma(bool): use a single sigma (at each point of the\
+                    nuisance parameter grid) for all residues
         """
 
-        # collect distributions of observables r_j across all structures
-        n_observables  = self.ensemble[0][rest_index].n  # the number of (model,exp) data values in this restraint
-        #print('n_observables = ',n_observables)
+        R = self.ensemble[0][rest_index]
+        n_observables  = R.n  # the number of (model,exp) data values in this restraint
         # Find the MLE mean (ref_mu_j) and std (ref_sigma_j) for each observable
+        # (a 6-dim array in parameter space)
+        mean_PF  = np.zeros((n_observables,)+R.nuisance_shape())
+        sigma_PF = np.zeros(mean_PF.shape)
+        model = np.empty(R.nuisance_shape())
+        for s in self.ensemble:
+            for j in range(n_observables):
+                mean_PF[j] += s[rest_index].model_grid(j, out=model)
+        mean_PF /= (n_observables+1.0)
         for s in self.ensemble:
-            s[rest_index].ref_mean = []
-            s[rest_index].ref_sigma = []
-        # for each restraint, find the average model_protectionfactor (a 6-dim array in parameter space) across all structures
-        for j in range(len(s[rest_index].restraints)):
-            mean_PF_j  = np.zeros( self.ensemble[0][rest_index].restraints[j]['model'].shape )
-            sigma_PF_j = np.zeros( self.ensemble[0][rest_index].restraints[j]['model'].shape )
-            for s in self.ensemble:
-                mean_PF_j += s[rest_index].restraints[j]['model']   # a 6-dim array
-            mean_PF_j = mean_PF_j/(len(s[rest_index].restraints)+1.0)
-            for s in self.ensemble:
-                sigma_PF_j += (s[rest_index].restraints[j]['model'] - mean_PF_j)**2.0
-            sigma_PF_j = np.sqrt(sigma_PF_j/(len(s[rest_index].restraints)+1.0))
-            for s in self.ensemble:
-                s[rest_index].ref_mean.append(mean_PF_j)
-                s[rest_index].ref_sigma.append(sigma_PF_j)
+            for j in range(n_observables):
+                s[rest_index].model_grid(j, out=model)
+                model -= mean_PF[j]
+                model **= 2.0
+                sigma_PF[j] += model
+        sigma_PF /= (n_observables+1.0)
+        np.sqrt(sigma_PF, out=sigma_PF)
+        if use_global_ref_sigma == True:
+            sigma_PF[:] = np.mean(sigma_PF**(-2.0), axis=0)**-0.5
+        mean_PF = mean_PF.astype(R.dtype, copy=False)
+        sigma_PF = sigma_PF.astype(R.dtype, copy=False)
+        for s in self.ensemble:
+            s[rest_index].ref_mean = mean_PF
+            s[rest_index].ref_sigma = sigma_PF
         for s in self.ensemble:
             s[rest_index].compute_neglog_gaussian_ref_pf()
 
@@ -229,6 +356,563 @@ class PosteriorSampler(object):
         return self.nuisance_para
 
 
+    def compile_parameter_layout(self):
+        """Collect the name and restraint index of every nuisance parameter
+        and its initial index (set by the restraint, e.g. the grid midpoint).
+
+        :rtype tuple: (rest_type, rest_index, indices)
+        """
+
+        # Store a list of nuisance parameters for each restraint
+        rest_type = []
+        # Store a list of parameter indices for each restraint inside a list
+        indices = [] # e.g., [161, 142, ...]
+        # Loop through the restraints, and get the parameters and indices
+        rest_index = []
+        #NOTE: using information from first state
+        for i,R in enumerate(self.ensemble[0]):
+            keys = R.__dict__.keys() # all attributes of the Child Restraint class
+            for j in [key for key in keys if "index" in key]: # get the parameter indices
+                indices.append(getattr(R, j))
+            for j in [key.split("_")[-1] for key in keys if "allowed_" in key]: #
+                rest_type.append(str(j)+"_"+str(R.__repr__).split("_")[-1].split()[0])
+                rest_index.append(i)
+        return rest_type, rest_index, indices
+
+
+    def find_MAP(self):
+        """Vectorized search for the maximum a posteriori state and nuisance
+        parameters. For a given state, -ln P is a sum over restraints, so each
+        restraint is minimized over its own parameter grid for all states at
+        once (using the energy table, or one restraint table at a time if it
+        does not fit in **table_memory**).
+
+        :rtype tuple: (state, parameter indices)
+        """
+
+        allowed = self.compile_nuisance_parameters()
+        rest_type, rest_index, indices = self.compile_parameter_layout()
+        if self.restraint_arrays is None: self.compile_restraint_arrays()
+        if self.energy_table is None: self.build_energy_table(allowed, rest_index)
+        total = self.energies.copy()
+        best = []
+        for i in range(len(self.restraint_arrays)):
+            if self.energy_table is not None:
+                table = self.energy_table[i]
+            else:
+                table = self.restraint_table(i, allowed, rest_index)
+            flat = table.reshape((self.nstates, -1))
+            arg = flat.argmin(axis=1)
+            total += flat[np.arange(self.nstates), arg]
+            best.append(np.array(np.unravel_index(arg, table.shape[1:])).T)
+        state = int(total.argmin())
+        return state, np.concatenate([b[state] for b in best]).tolist()
+
+
+    def warm_start(self, source="map"):
+        """Initialize the conformational state and nuisance parameter indices
+        for :attr:`sample`, instead of a random state and the grid midpoints.
+
+        Args:
+            source(object): 'map' for the maximum a posteriori estimate (see\
+                    :attr:`find_MAP`), a :class:`PosteriorSampler` (e.g. of a\
+                    neighbouring lambda) or its pickle file, or a\
+                    :class:`PosteriorSamplingTrajectory`, its results (dict)\
+                    or npz file to start from the final snapshot
+
+        :rtype tuple: (states, parameter indices)
+        """
+
+        if isinstance(source, str) and source == "map":
+            state, indices = self.find_MAP()
+        else:
+            if isinstance(source, str):
+                if source.endswith(".pkl"):
+                    with open(source, 'rb') as file:
+                        source = pickle.load(file)
+                else:
+                    source = np.load(source, allow_pickle=True)['arr_0'].item()
+            if isinstance(source, PosteriorSampler):
+                if source.indices is None:
+                    raise ValueError("The sampler has not been sampled yet")
+                state, indices = source.state, np.array(source.indices).tolist()
+            else:
+                if isinstance(source, PosteriorSamplingTrajectory):
+                    source = dict(trajectory=source.trajectory)
+                if len(source['trajectory']) == 0:
+                    raise ValueError("The trajectory is empty")
+                frame = source['trajectory'][-1]
+                state, indices = frame[3], np.concatenate(frame[4]).tolist()
+        n_allowed = [len(a) for a in self.compile_nuisance_parameters()]
+        if len(indices) != len(n_allowed) or any(not 0 <= int(k) < n for k,n in zip(indices, n_allowed)):
+            raise ValueError("The parameter indices do not match the restraints of this ensemble")
+        self.state = np.resize(np.array(state, dtype=int), self.nreplicas)
+        self.indices = np.array(indices, dtype=int)
+        self.E = 1.0e99
+        return self.state, self.indices
+
+
+    def compile_restraint_arrays(self):
+        """Stacks the per-state quantities that enter :attr:`neglogP` (sse,
+        Ndof and reference potentials of each restraint) into arrays over all
+        states, so that -ln P can be evaluated for many states in a single
+        vectorized operation (see :attr:`state_energies`).
+
+        :rtype list: a dictionary of stacked arrays for each restraint
+        """
+
+        if not self.reference_built: self.build_reference_potentials()
+        self.restraint_arrays = []
+        for i,R in enumerate(self.ensemble[0]):
+            arrays = {}
+            arrays["Ndof"] = np.array([s[i].Ndof for s in self.ensemble], dtype=float)
+            arrays["lazy"] = getattr(R, 'lazy', False)
+            if arrays["lazy"]:
+                # Contact counts of every state, to evaluate the protection
+                # factors on demand (see pf_terms)
+                arrays["Nc"] = np.array([s[i].Ncs[:,:,:R.n] for s in self.ensemble], dtype=float)
+                arrays["Nh"] = np.array([s[i].Nhs[:,:,:R.n] for s in self.ensemble], dtype=float)
+                arrays["exp"] = np.array([s[i].restraints['exp'] for s in self.ensemble], dtype=float)
+                arrays["weight"] = np.array([s[i].restraints['weight'] for s in self.ensemble], dtype=float)
+                arrays["sse"], arrays["ref"] = None, None
+                arrays["prior"] = R.pf_prior
+                if R.ref == "gaussian":
+                    # Sums over states of the contact counts and of their
+                    # products, so that the mean and sigma of the predicted
+                    # PF at a grid point cost O(n_residues)
+                    Nc, Nh = arrays["Nc"], arrays["Nh"]
+                    arrays["sum_Nc"], arrays["sum_Nh"] = Nc.sum(axis=0), Nh.sum(axis=0)
+                    arrays["sum_Nc2"], arrays["sum_Nh2"] = (Nc**2.0).sum(axis=0), (Nh**2.0).sum(axis=0)
+                    arrays["sum_NcNh"] = np.einsum('scbj,shbj->chbj', Nc, Nh)
+                self.restraint_arrays.append(arrays)
+                continue
+            # single precision grids (see Restraint_pf) are kept in single precision
+            dtype = np.float32 if np.asarray(R.sse).dtype == np.float32 else float
+            arrays["sse"] = np.array([s[i].sse for s in self.ensemble], dtype=dtype)
+            if R.ref == "exp":
+                arrays["ref"] = np.array([s[i].sum_neglog_exp_ref for s in self.ensemble], dtype=dtype)
+            elif R.ref == "gaussian":
+                arrays["ref"] = np.array([s[i].sum_neglog_gaussian_ref for s in self.ensemble], dtype=dtype)
+            else:
+                arrays["ref"] = np.zeros(self.nstates)
+            arrays["prior"] = None
+            if hasattr(R, 'precomputed') and not R.precomputed:
+                arrays["prior"] = getattr(R, 'pf_prior', None)
+            self.restraint_arrays.append(arrays)
+        return self.restraint_arrays
+
+
+    def state_energies(self, parameters, parameter_indices, states=None):
+        """Return -ln P for many states at once, holding the nuisance
+        parameters fixed. Equivalent to calling :attr:`neglogP` for each
+        state separately.
+
+        Args:
+            parameters(list): a list of the parameters for each of the restraints
+            parameter_indices(list): parameter indices that correspond to each restraint
+            states(np.ndarray): state indices to evaluate (defaults to all states)
+
+        :rtype np.ndarray: -ln P for each of the states
+        """
+
+        if self.restraint_arrays is None: self.compile_restraint_arrays()
+        if states is None: states = np.arange(self.nstates)
+        states = np.asarray(states, dtype=int)
+        result = self.energies[states] + float(self.logZ)
+        if self.energy_table is not None:
+            for i,table in enumerate(self.energy_table):
+                result += table[(states,)+tuple(int(k) for k in parameter_indices[i])]
+            return result
+        for i in range(len(self.restraint_arrays)):
+            result += self.restraint_energy(i, states, float(parameters[i][0]),
+                    tuple(int(k) for k in parameter_indices[i][1:]))
+        return result
+
+
+    def restraint_energy(self, rest_index, states, sigma, grid):
+        """Return -ln P of a single restraint (without the free energy of the
+        state and logZ) from the stacked arrays (see :attr:`compile_restraint_arrays`).
+        **states**, **sigma** and the index arrays of **grid** are broadcast
+        together, so that many states and points of the nuisance parameter
+        grid are evaluated at once (see :attr:`state_energies`,
+        :attr:`restraint_table` and :attr:`biceps.SMCSampler`).
+
+        Args:
+            rest_index(int): restraint index
+            states(np.ndarray): conformational states
+            sigma(np.ndarray): values of sigma
+            grid(tuple): indices of the other nuisance parameters of the restraint
+
+        :rtype np.ndarray: -ln P with the broadcast shape of the arguments
+        """
+
+        if self.restraint_arrays is None: self.compile_restraint_arrays()
+        arrays = self.restraint_arrays[rest_index]
+        Ndof = arrays["Ndof"][states]
+        result = Ndof*np.log(sigma) + Ndof/2.0*np.log(2.0*np.pi)
+        if arrays["lazy"]:
+            sse, ref = self.pf_terms(rest_index, states, grid)
+            result = result + sse/(2.0*sigma**2.0) - ref
+        else:
+            result = result + arrays["sse"][(states,)+tuple(grid[:arrays["sse"].ndim-1])]/(2.0*sigma**2.0)
+            result = result - arrays["ref"][(states,)+tuple(grid[:arrays["ref"].ndim-1])]
+        if arrays["prior"] is not None:
+            result = result + np.asarray(arrays["prior"])[tuple(grid)]
+        return result
+
+
+    def build_energy_table(self, allowed, rest_index):
+        """Precompute -ln P of each restraint for every state and every
+        combination of its nuisance parameters, if the tables fit inside
+        **table_memory**. Since -ln P is a sum over restraints, one table of
+        shape (nstates, n_sigma, ...) per restraint is stored instead of a
+        single table over the product of all parameter grids.
+
+        Args:
+            allowed(np.ndarray): allowed parameters (see :attr:`compile_nuisance_parameters`)
+            rest_index(list): restraint index of each nuisance parameter
+
+        :rtype bool: whether the table was built
+        """
+
+        self.energy_table = None
+        if self.nreplicas > 1: return False
+        if self.restraint_arrays is None: self.compile_restraint_arrays()
+        # Protection factors evaluated on demand are never tabulated
+        if any(arrays["lazy"] for arrays in self.restraint_arrays): return False
+        shapes = []
+        for i in range(len(self.restraint_arrays)):
+            shapes.append([self.nstates]+[len(allowed[k]) for k in range(len(rest_index)) if rest_index[k] == i])
+        if (self.shared_table is not None) and ([list(t.shape) for t in self.shared_table] == shapes):
+            self.energy_table = self.shared_table
+            return True
+        nbytes = 8.*sum([np.prod(shape) for shape in shapes])
+        if (self.table_memory is None) or (nbytes > self.table_memory*1024.**2):
+            return False
+        self.energy_table = [self.restraint_table(i, allowed, rest_index)
+                for i in range(len(self.restraint_arrays))]
+        return True
+
+
+    def restraint_table(self, i, allowed, rest_index):
+        """Return -ln P of restraint **i** for every state and every
+        combination of its nuisance parameters, as an array of shape
+        (nstates, n_sigma, ...).
+
+        Args:
+            i(int): restraint index
+            allowed(np.ndarray): allowed parameters (see :attr:`compile_nuisance_parameters`)
+            rest_index(list): restraint index of each nuisance parameter
+        """
+
+        if self.restraint_arrays is None: self.compile_restraint_arrays()
+        params = [k for k in range(len(rest_index)) if rest_index[k] == i]
+        shape = [self.nstates]+[len(allowed[k]) for k in params]
+        sigma = np.array(allowed[params[0]], dtype=float).reshape((-1,)+(1,)*(len(shape)-2))
+        grid = tuple(np.indices(shape[2:], sparse=True))
+        if self.restraint_arrays[i]["lazy"]:
+            # Evaluate the whole grid of protection factor terms, one state at a time
+            table = np.array([np.broadcast_to(self.restraint_energy(i, state, sigma, grid), shape[1:])
+                for state in range(self.nstates)])
+        else:
+            states = np.arange(self.nstates).reshape((-1,)+(1,)*(len(shape)-1))
+            table = self.restraint_energy(i, states, sigma[np.newaxis], grid)
+        return np.ascontiguousarray(np.broadcast_to(table, shape))
+
+
+    def lookup_neglogP(self, states, parameters, parameter_indices):
+        """Return -ln P of the current configuration, like :attr:`neglogP`,
+        using the precomputed energy table if available or else the bounded
+        LRU memo keyed by (states, parameter indices).
+
+        Args:
+            states(list): the new conformational state(s)
+            parameters(list): a list of the new parameters for each of the restraints
+            parameter_indices(list): parameter indices that correspond to each restraint
+        """
+
+        if self.energy_table is not None:
+            result = 0.0
+            for state in states:
+                result += self.energies[int(state)] + float(self.logZ)
+                for i,table in enumerate(self.energy_table):
+                    result += table[(int(state),)+tuple(parameter_indices[i])]
+            return result
+        key = (tuple(int(state) for state in states),
+                tuple(tuple(int(k) for k in ind) for ind in parameter_indices))
+        # Only the restraint energies are cached, so that the entries stay
+        # valid when lambda changes in expanded-ensemble sampling
+        base = 0.0
+        for state in states:
+            base += self.energies[int(state)] + float(self.logZ)
+        result = self.energy_cache.get(key)
+        if result is None:
+            result = self.neglogP(states, parameters, parameter_indices) - base
+            self.energy_cache.put(key, result)
+        return result + base
+
+
+    def pf_terms(self, rest_index, states, grid):
+        """Evaluate the sse and the reference potential of a protection factor
+        restraint (with `lazy=True`) at the given states and points of the
+        (beta_c, beta_h, beta_0, xcs, xhs, bs) grid, vectorized over residues.
+        **states** and the index arrays of **grid** are broadcast together.
+
+        Args:
+            rest_index(int): restraint index
+            states(np.ndarray): conformational states
+            grid(tuple): index arrays of the six nuisance parameters
+
+        :rtype tuple: (sse, ref) with the broadcast shape of **states** and **grid**
+        """
+
+        if self.restraint_arrays is None: self.compile_restraint_arrays()
+        arrays = self.restraint_arrays[rest_index]
+        R = self.ensemble[0][rest_index]
+        states, ic, ih, i0, xc, xh, b = np.broadcast_arrays(np.asarray(states, dtype=int),
+                *[np.asarray(k, dtype=int) for k in grid])
+        bc = R.allowed_beta_c[ic][...,np.newaxis]
+        bh = R.allowed_beta_h[ih][...,np.newaxis]
+        b0 = R.allowed_beta_0[i0][...,np.newaxis]
+        PF = bc*arrays["Nc"][states,xc,b] + bh*arrays["Nh"][states,xh,b] + b0
+        w = arrays["weight"][states]
+        sse = np.sum(w*(PF - arrays["exp"][states])**2.0, axis=-1)
+        if R.ref == "exp":
+            ref = np.sum(w*np.maximum(-PF, 0.0), axis=-1)
+        elif R.ref == "gaussian":
+            # Same estimates as build_gaussian_ref_pf, at the requested points
+            # only, from the sums over states of PF and PF^2
+            S = float(self.nstates)
+            sum_Nc, sum_Nh = arrays["sum_Nc"][xc,b], arrays["sum_Nh"][xh,b]
+            sum_PF = bc*sum_Nc + bh*sum_Nh + S*b0
+            sum_PF2 = (bc**2.0*arrays["sum_Nc2"][xc,b] + bh**2.0*arrays["sum_Nh2"][xh,b] + S*b0**2.0
+                    + 2.0*bc*bh*arrays["sum_NcNh"][xc,xh,b] + 2.0*bc*b0*sum_Nc + 2.0*bh*b0*sum_Nh)
+            mean = sum_PF/(R.n+1.0)
+            var = np.maximum(sum_PF2 - 2.0*mean*sum_PF + S*mean**2.0, 0.0)
+            sigma = np.sqrt(var/(R.n+1.0))
+            if R.use_global_ref_sigma == True:
+                sigma = np.mean(sigma**(-2.0), axis=-1, keepdims=True)**-0.5
+            ref = np.sum(w*(0.5*np.log(2.0*np.pi) + np.log(sigma)
+                + (PF - mean)**2.0/(2.0*sigma**2.0)), axis=-1)
+        else:
+            ref = np.zeros(sse.shape)
+        return sse, ref
+
+
+    def pf_neglogP(self, rest_index, state, parameters, parameter_indices):
+        """Return -ln P of a protection factor restraint with `lazy=True` for
+        a single state. The sse and reference potential at each visited
+        (state, beta_c, beta_h, beta_0, xcs, xhs, bs) point are evaluated
+        with :attr:`pf_terms` and kept in a bounded LRU cache, so that moves
+        of sigma or of the other restraints reuse them.
+
+        Args:
+            rest_index(int): restraint index
+            state(int): conformational state
+            parameters(list): parameters of the restraint
+            parameter_indices(list): parameter indices of the restraint
+        """
+
+        arrays = self.restraint_arrays[rest_index]
+        grid = tuple(int(k) for k in parameter_indices[1:])
+        key = (rest_index, int(state)) + grid
+        terms = self.pf_cache.get(key)
+        if terms is None:
+            sse, ref = self.pf_terms(rest_index, int(state), grid)
+            terms = (float(sse), float(ref))
+            self.pf_cache.put(key, terms)
+        sigma = float(parameters[0])
+        Ndof = arrays["Ndof"][int(state)]
+        result = Ndof*np.log(sigma) + Ndof/2.0*np.log(2.0*np.pi)
+        result += terms[0] / (2.0*sigma**2.0) - terms[1]
+        if arrays["prior"] is not None:
+            result += arrays["prior"][grid]
+        return result
+
+
+    def multiple_try_move(self, parameters, parameter_indices, ntries):
+        """Multiple-try Metropolis move in state space. Draws **ntries**
+        candidate states uniformly, selects one with probability proportional
+        to its posterior weight and accepts it with the generalized
+        Metropolis ratio against a reference set drawn from the selected
+        candidate. All candidate and reference energies are evaluated in one
+        vectorized call to :attr:`state_energies`.
+
+        Args:
+            parameters(list): a list of the current parameters for each of the restraints
+            parameter_indices(list): parameter indices that correspond to each restraint
+            ntries(int): the number of candidate states (K)
+
+        Returns:
+            tuple: (new state, new energy, accepted)
+        """
+
+        candidates = np.random.randint(low=0, high=self.nstates, size=ntries)
+        reference = np.random.randint(low=0, high=self.nstates, size=ntries-1)
+        reference = np.append(reference, int(self.state[0]))
+        u = self.state_energies(parameters, parameter_indices,
+                states=np.concatenate([candidates, reference]))
+        u_y, u_x = u[:ntries], u[ntries:]
+        shift = u.min()
+        w_y, w_x = np.exp(-(u_y - shift)), np.exp(-(u_x - shift))
+        j = np.random.choice(ntries, p=w_y/w_y.sum())
+        accept = bool(np.random.random() < w_y.sum()/w_x.sum())
+        return np.array([candidates[j]]), u_y[j], accept
+
+
+    def publish_arrays(self, path):
+        """Write the packed arrays of the ensemble (unscaled energies, stacked
+        sse, Ndof, reference potentials and priors, the energy table if it
+        fits in **table_memory** and, with replicas, the model observables)
+        as .npy files to the directory **path**. None of them depend on
+        lambda, so samplers of every lambda (e.g. multiprocess workers) can
+        attach them read-only as memory-mapped arrays with
+        :attr:`attach_arrays`, sharing one copy in the page cache instead of
+        holding their own.
+
+        Args:
+            path(str): output directory
+        """
+
+        if not os.path.exists(path): os.makedirs(path)
+        allowed = self.compile_nuisance_parameters()
+        rest_type, rest_index, indices = self.compile_parameter_layout()
+        if self.restraint_arrays is None: self.compile_restraint_arrays()
+        if any(arrays["lazy"] for arrays in self.restraint_arrays):
+            raise ValueError("Protection factors evaluated on demand (lazy=True) can not be published")
+        # The model observables are only needed to average over replicas
+        if (self.nreplicas > 1) and (self.replica_models is None): self.compile_replica_models()
+        nreplicas, self.nreplicas = self.nreplicas, 1
+        self.build_energy_table(allowed, rest_index)
+        self.nreplicas = nreplicas
+        np.save(os.path.join(path, "energies.npy"), self.unscaled_energies)
+        for i,arrays in enumerate(self.restraint_arrays):
+            for key in ["Ndof", "sse", "ref", "prior"]:
+                array = arrays[key]
+                if array is not None:
+                    np.save(os.path.join(path, "restraint%d_%s.npy"%(i,key)), np.asarray(array))
+            if self.nreplicas > 1:
+                np.save(os.path.join(path, "restraint%d_model.npy"%i), self.replica_models[i])
+            if self.energy_table is not None:
+                np.save(os.path.join(path, "restraint%d_table.npy"%i), self.energy_table[i])
+        # Replace the stacked copies by the published arrays
+        self.energy_table = None
+        self.attach_arrays(path)
+
+
+    def attach_arrays(self, path):
+        """Attach the packed arrays written by :attr:`publish_arrays` as
+        read-only memory-mapped arrays (the lambda-scaled energies and logZ
+        stay private to this sampler). From then on, -ln P is evaluated from
+        the attached arrays only, without the per-state arrays of the
+        restraints.
+
+        Args:
+            path(str): directory of the packed arrays
+        """
+
+        energies = np.load(os.path.join(path, "energies.npy"), mmap_mode='r')
+        if len(energies) != self.nstates:
+            raise ValueError("%s holds arrays for %s states, not %s"%(path, len(energies), self.nstates))
+        self.restraint_arrays, models, tables = [], [], []
+        for i in range(len(self.ensemble[0])):
+            arrays = dict(lazy=False)
+            for key in ["Ndof", "sse", "ref", "prior"]:
+                filename = os.path.join(path, "restraint%d_%s.npy"%(i,key))
+                arrays[key] = np.load(filename, mmap_mode='r') if os.path.exists(filename) else None
+            self.restraint_arrays.append(arrays)
+            filename = os.path.join(path, "restraint%d_model.npy"%i)
+            if os.path.exists(filename): models.append(np.load(filename, mmap_mode='r'))
+            filename = os.path.join(path, "restraint%d_table.npy"%i)
+            if os.path.exists(filename): tables.append(np.load(filename, mmap_mode='r'))
+        self.shared_table = tables if len(tables) == len(self.restraint_arrays) else None
+        # Without published model observables, replicas stack their own
+        self.replica_models = models if len(models) == len(self.restraint_arrays) else None
+        self.shared = path
+
+
+    def compile_replica_models(self):
+        """Stacks the model observables of each restraint into an array of
+        shape (nstates, n_observables), used to average the forward model
+        over replicas.
+
+        :rtype list: model observables for each restraint
+        """
+
+        for R in self.ensemble[0]:
+            if hasattr(R, 'precomputed') and not R.precomputed:
+                raise ValueError("Replica-averaged protection factors require precomputed=True")
+        self.replica_models = []
+        for i in range(len(self.ensemble[0])):
+            self.replica_models.append(np.array([s[i].get_observables('model')
+                for s in self.ensemble], dtype=float))
+        return self.replica_models
+
+
+    def replica_neglogP(self, states, parameters, parameter_indices, model_sums=None):
+        """Return -ln P of a configuration of replicas. The likelihood of each
+        restraint is evaluated once with the model observables averaged over
+        the replica states, while each replica contributes its own free energy
+        and reference potential.
+
+        Args:
+            states(list): the conformational state of each replica
+            parameters(list): a list of the new parameters for each of the restraints
+            parameter_indices(list): parameter indices that correspond to each restraint
+            model_sums(list): sum over replicas of the model observables of each\
+                    restraint (computed from **states** if None)
+        """
+
+        if (self.shared is None) and not self.reference_built:
+            self.build_reference_potentials()
+        if self.replica_models is None: self.compile_replica_models()
+        if model_sums is None:
+            model_sums = [models[np.asarray(states, dtype=int)].sum(axis=0)
+                    for models in self.replica_models]
+        result = 0
+        for state in states:
+            result += self.energies[int(state)] + self.logZ
+        for i,R in enumerate(self.ensemble[int(states[0])]):
+            sse = R.compute_sse_from_model(model_sums[i]/float(len(states)))
+            if self.shared is not None:
+                result += self.shared_neglogP(i, states, parameters[i], parameter_indices[i], sse)
+                continue
+            result += R.compute_neglogP(parameters[i], parameter_indices[i], sse)
+            for state in states[1:]:
+                replica = self.ensemble[int(state)][i]
+                if replica.ref == "exp":
+                    result -= replica.sum_neglog_exp_ref
+                if replica.ref == "gaussian":
+                    result -= replica.sum_neglog_gaussian_ref
+        return result
+
+
+    def shared_neglogP(self, rest_index, states, parameters, parameter_indices, sse):
+        """Return -ln P of a single restraint of a configuration of replicas
+        from the attached arrays (see :attr:`attach_arrays`), given the sse
+        of the replica-averaged observables.
+
+        Args:
+            rest_index(int): restraint index
+            states(list): the conformational state of each replica
+            parameters(list): parameters of the restraint
+            parameter_indices(list): parameter indices of the restraint
+            sse(np.ndarray): sse for the replica-averaged observables
+        """
+
+        arrays = self.restraint_arrays[rest_index]
+        sigma = float(parameters[0])
+        grid = tuple(int(k) for k in parameter_indices[1:])
+        Ndof = arrays["Ndof"][int(states[0])]
+        result = Ndof*np.log(sigma) + Ndof/2.0*np.log(2.0*np.pi)
+        result += np.asarray(sse)[grid[:np.ndim(sse)]] / (2.0*sigma**2.0)
+        for state in states:
+            result -= arrays["ref"][(int(state),)+grid[:arrays["ref"].ndim-1]]
+        if arrays["prior"] is not None:
+            result += arrays["prior"][grid]
+        return float(result)
+
+
     def neglogP(self, states, parameters, parameter_indices):
         """Return -ln P of the current configuration.
 
@@ -238,137 +922,364 @@ class PosteriorSampler(object):
             parameter_indices(list): parameter indices that correspond to each restraint
         """
 
+        if len(states) > 1:
+            return self.replica_neglogP(states, parameters, parameter_indices)
+        if self.shared is not None:
+            return float(self.state_energies(parameters, parameter_indices, states=states)[0])
+        if not self.reference_built: self.build_reference_potentials()
         result = 0
         for state in states:
             s = self.ensemble[int(state)] # Current Structure (list of restraints)
-            result += s[0].energy + self.logZ  # Grab the free energy of the state and normalize
+            result += self.energies[int(state)] + self.logZ  # Grab the free energy of the state and normalize
             for i,R in enumerate(s):
-                result += R.compute_neglogP(parameters[i], parameter_indices[i], s[i].sse)
+                if getattr(R, 'lazy', False):
+                    if self.restraint_arrays is None: self.compile_restraint_arrays()
+                    result += self.pf_neglogP(i, state, parameters[i], parameter_indices[i])
+                else:
+                    result += R.compute_neglogP(parameters[i], parameter_indices[i], s[i].sse)
         return result
 
 
-    def sample(self, nsteps, burn=0, print_freq=1000, verbose=False):
+    def sample(self, nsteps, burn=0, print_freq=1000, ntries=1,
+            progress_freq=1000, max_steps=None, target_ess=None, jsd_threshold=None,
+            gr_threshold=None, check_freq=10000, time_budget=None, reservoir=None,
+            verbose=False):
         """Perform n number of steps (nsteps) of posterior sampling, where Monte
         Carlo moves are accepted or rejected according to Metroplis criterion.
-        Energies are computed via :class:`neglogP`.
+        Energies are computed via :class:`neglogP`. In expanded-ensemble mode
+        (see :attr:`init_expanded_ensemble`), a move to a neighbouring lambda
+        is attempted after every step and the samples are recorded in the
+        trajectory of the current lambda.
 
         Args:
-            nsteps(int): the number of steps of sampling
-            burn(int): the number of steps to burn
+            nsteps(int): the number of steps of sampling (may be None if\
+                    **time_budget** is given)
+            burn(int): the number of steps to burn. If 'auto', no steps are\
+                    burned and the equilibration point is detected afterwards\
+                    from the energy trace (see :attr:`PosteriorSamplingTrajectory.detect_equilibration`)
             print_freq(int): the frequency of printing to the screen
+            ntries(int): the number of candidate states drawn for each state move.\
+                    If greater than 1, state moves use multiple-try Metropolis\
+                    (see :attr:`multiple_try_move`)
+            progress_freq(int): the frequency (in steps) of updating the progress bar
+            max_steps(int): the maximum number of steps of sampling (overrides **nsteps**)
+            target_ess(float): stop once the effective sample size of the state\
+                    and of each nuisance parameter reaches this value
+            jsd_threshold(float): stop once the JSD between the first and second\
+                    half of the chain is below this value for every variable
+            gr_threshold(float): stop once the Gelman-Rubin statistic is below\
+                    this value for every variable
+            check_freq(int): the frequency (in steps) of checking the convergence\
+                    criteria (see :attr:`biceps.convergence.ConvergenceMonitor`)
+            time_budget(float): wall-clock time (in seconds) after which sampling\
+                    stops at the next step boundary. The results are stored\
+                    as if **nsteps** had been reached.
+            reservoir(int): low-memory mode. Keep only the histograms, running\
+                    energy statistics and a uniform random sample (reservoir) of\
+                    this many trajectory snapshots instead of the state trace and\
+                    every snapshot (see :attr:`PosteriorSamplingTrajectory.add_to_reservoir`)
             verbose(bool): control over verbosity
 
         .. tip::
             Set `verbose=False` when using multiprocessing.
         """
 
+        if max_steps is not None: nsteps = int(max_steps)
+        if nsteps is None:
+            if time_budget is None:
+                raise ValueError("nsteps is required without a time_budget")
+            nsteps = 2**62
+        nsteps = int(nsteps)
+        detect = (burn == "auto")
+        if detect: burn = 0
+        low_memory = reservoir is not None
+        if detect and low_memory:
+            raise ValueError("burn='auto' requires the full energy trace (reservoir=None)")
         # Generate a matrix of nuisance parameters
         allowed = self.compile_nuisance_parameters()
-        # Store a list of nuisance parameters for each restraint
-        self.rest_type = []
-        # Store a list of parameter indices for each restraint inside a list
-        self.indices = [] # e.g., [161, 142, ...]
-        # Loop through the restraints, and get the parameters and indices
-        rest_index = []
-        #NOTE: using information from first state
-        for i,R in enumerate(self.ensemble[self.state[0]]):
-            keys = R.__dict__.keys() # all attributes of the Child Restraint class
-            for j in [key for key in keys if "index" in key]: # get the parameter indices
-                self.indices.append(getattr(R, j))
-            for j in [key.split("_")[-1] for key in keys if "allowed_" in key]: #
-                self.rest_type.append(str(j)+"_"+str(R.__repr__).split("_")[-1].split()[0])
-                rest_index.append(i)
+        self.rest_type, rest_index, indices = self.compile_parameter_layout()
+        # Continue from the current (or warm-started) nuisance parameters
+        if self.indices is None: self.indices = indices
         if verbose:
             header = """Step\t\tState\tPara Indices\t\tAvg Energy\tAcceptance (%)"""
             print(header)
         # Create separate accepted ratio recorder list
         n_rest = max(rest_index)+1
         sep_accepted = np.zeros(len(self.indices)+1) # all nuisance paramters + state (n_para starts from 1 not 0)
+        if ntries > 1 and self.nreplicas > 1:
+            raise ValueError("Multiple-try state moves require nreplicas=1")
+        self.build_energy_table(allowed, rest_index)
+
+        # Integer index groups: the parameter slots of each restraint are contiguous
+        n_para = len(self.indices)
+        n_allowed = np.array([len(allowed[k]) for k in range(n_para)])
+        offsets = np.concatenate([[0], np.cumsum(n_allowed)])
+        flat_allowed = np.concatenate([np.asarray(allowed[k], dtype=float) for k in range(n_para)])
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(rest_index, minlength=n_rest))])
+        groups = [slice(bounds[i], bounds[i+1]) for i in range(n_rest)]
+        # Current and proposed configurations (updated in place)
+        self.indices = np.array(self.indices, dtype=int)
+        self.values = flat_allowed[offsets[:-1]+self.indices]
+        indices, values = self.indices.copy(), self.values.copy()
+        state = self.state.copy()
+        # Per-restraint views into the proposal buffers, passed to neglogP
+        sep_indices = [indices[g] for g in groups]
+        sep_values = [values[g] for g in groups]
+        flat_index = offsets[:-1]+self.indices  # position of each index in the flattened histogram
+        expanded = self.lambdas is not None
+        trajs = self.trajs if expanded else [self.traj]
+        k = self.lambda_index if expanded else 0
+        sampled = np.zeros((len(trajs), offsets[-1]))
+        # Trace buffers grow in chunks up to nsteps (which may be unbounded with
+        # a time budget), or are flushed into the state counts in low-memory mode
+        state_trace = np.zeros((min(nsteps, 2**16 if low_memory else 2**20), self.nreplicas), dtype=int)
+        lambda_trace = np.zeros(len(state_trace), dtype=int)
+        trace_offset = 0
+        def store_states(m):
+            for l,traj in enumerate(trajs):
+                trace = state_trace[:m][lambda_trace[:m] == l]
+                np.add.at(traj.state_counts, trace.ravel(), 1)
+                if not low_memory: traj.state_trace.extend(trace.ravel().tolist())
+        if low_memory:
+            for traj in trajs:
+                if not traj.reservoir: traj.reservoir = dict(size=int(reservoir), seen=0)
+            # Running energy statistics of each lambda (count, mean, M2, min, max)
+            energy_stats = np.zeros((len(trajs), 5))
+            energy_stats[:,3], energy_stats[:,4] = np.inf, -np.inf
+        lambda_steps = np.array([traj.nsteps for traj in trajs])
+        lambda_steps0 = lambda_steps.copy()
+        monitor = None
+        if (target_ess is not None) or (jsd_threshold is not None) or (gr_threshold is not None):
+            monitor = ConvergenceMonitor(n_allowed, self.nstates, batch_size=max(1, check_freq//100),
+                    target_ess=target_ess, jsd_threshold=jsd_threshold, gr_threshold=gr_threshold)
+        if self.nreplicas > 1:
+            # Running sums of the model observables over replicas
+            if self.replica_models is None: self.compile_replica_models()
+            model_sums = [models[self.state].sum(axis=0) for models in self.replica_models]
+            new_sums = [sums.copy() for sums in model_sums]
+            self.E = self.replica_neglogP(self.state, sep_values, sep_indices, model_sums=model_sums)
+        else:
+            self.E = self.lookup_neglogP(self.state, sep_values, sep_indices)
+
+        # All sample-space will share the same probability to be sampled
+        RAND = 1. - 1./(n_rest + 1.)   # + 1. is the term to include state-space
+        max_group = max([g.stop-g.start for g in groups])
         step=0
         start = time.time()
-        if not verbose: pbar = tqdm(total=nsteps+burn)
+        deadline = None if time_budget is None else start+time_budget
+        if not verbose: pbar = tqdm(total=nsteps+burn if nsteps < 2**62 else None)
         while step < nsteps+burn:
-            # Redefine based upon acceptance (Metroplis criterion)
-            state, E = self.state.copy(), self.E
-            indices = self.indices.copy() # e.g. [161, 142]
-            #values = self.values # e.g. [1.2122652, 0.832136160]
-            # All sample-space will share the same probability to be sampled
-            RAND = 1. - 1./(n_rest + 1.)   # + 1. is the term to include state-space
-            dice = np.random.random() # rolling the dice
+            # Draw the random numbers for a batch of steps at once (the batch
+            # size is fixed, so the random stream does not depend on progress_freq)
+            n = step%RANDOM_BATCH
+            if n == 0:
+                dices = np.random.random(RANDOM_BATCH) # rolling the dice
+                moves = np.random.randint(n_rest, size=RANDOM_BATCH)
+                deltas = np.random.randint(-1, 2, size=(RANDOM_BATCH, max_group))
+                new_states = np.random.randint(low=0, high=self.nstates, size=(RANDOM_BATCH, self.nreplicas))
+                replicas = np.random.randint(self.nreplicas, size=RANDOM_BATCH)
+                metropolis = np.random.random(RANDOM_BATCH)
+                if expanded:
+                    lambda_moves = np.random.choice([-1, 1], size=RANDOM_BATCH)
+                    lambda_metropolis = np.random.random(RANDOM_BATCH)
+                    # Wang-Landau: reduce ln f once the lambda visits are flat,
+                    # but no faster than K/t (Belardinelli-Pereyra)
+                    counts = self.lambda_counts
+                    if counts.min() > 0 and counts.min() > self.wl_flatness*counts.mean():
+                        self.wl_factor /= 2.0
+                        self.lambda_counts[:] = 0
+                    if self.lambda_total > 0:
+                        self.wl_factor = max(self.wl_factor, len(self.lambdas)/float(self.lambda_total))
+            dice = dices[n]
             if dice < RAND: # Take a random step in Restraint space
-                ind = []
+                g = groups[moves[n]]
                 # Make sure the index doesn't fall out of the boundry of the allowed values
-                for k in np.where(np.array(rest_index)==np.random.randint(n_rest))[0]:
-                    indices[k] = (indices[k]+(np.random.randint(3)-1))%len(allowed[k])
-                    ind.append(k)
+                indices[g] = (self.indices[g]+deltas[n,:g.stop-g.start])%n_allowed[g]
+                values[g] = flat_allowed[offsets[g]+indices[g]]
+                if self.nreplicas > 1:
+                    E = self.replica_neglogP(self.state, sep_values, sep_indices, model_sums=model_sums)
+                else:
+                    E = self.lookup_neglogP(self.state, sep_values, sep_indices)
             else: ## Take a random step in state space
-                state = np.random.randint(low=0, high=self.nstates, size=self.nreplicas)
-                ind = [len(indices)]
-            # values e.g., [1.2122652, 0.832136160, ...]
-            values = [allowed[i][indices[i]] for i in range(len(indices))]
-            # Convert the list of indices and values into a list of list for each restraint
-            sep_indices = [[] for i in range(n_rest)]
-            sep_values = [[] for i in range(n_rest)]
-            for n,m in enumerate(rest_index):
-                sep_indices[m].append(indices[n])
-                sep_values[m].append(values[n])
-            #print(f"sep_indices: {sep_indices}")
-            # Compute new "energy"
-            E = self.neglogP(state, sep_values, sep_indices)
-            # Accept or reject the MC move according to Metroplis criterion
-            self.accept = False
-            if E < self.E:
-                self.accept = True
-            else:
-                if np.random.random() < np.exp( self.E - E ):
+                g = slice(n_para, n_para+1)
+                if ntries > 1:
+                    state[:], E, self.accept = self.multiple_try_move(sep_values, sep_indices, ntries)
+                elif self.nreplicas > 1:
+                    # Move a single replica and update the averaged observables in O(n_observables)
+                    r = replicas[n]
+                    state[r] = new_states[n,r]
+                    for i,models in enumerate(self.replica_models):
+                        np.subtract(model_sums[i], models[self.state[r]], out=new_sums[i])
+                        new_sums[i] += models[state[r]]
+                    E = self.replica_neglogP(state, sep_values, sep_indices, model_sums=new_sums)
+                else:
+                    state[:] = new_states[n]
+                    E = self.lookup_neglogP(state, sep_values, sep_indices)
+
+            if (dice < RAND) or (ntries == 1):
+                # Accept or reject the MC move according to Metroplis criterion
+                self.accept = False
+                if E < self.E:
                     self.accept = True
+                else:
+                    if metropolis[n] < np.exp( self.E - E ):
+                        self.accept = True
 
             # Update values based upon acceptance (Metroplis criterion)
             if self.accept:
                 self.E = E
-                self.state = state.copy()
-                self.indices = indices.copy()
-                self.values = values.copy()
-                for k in ind:
-                    sep_accepted[k] += 1.0
+                self.state[:] = state
+                self.indices[g] = indices[g]
+                self.values[g] = values[g]
+                flat_index[g] = offsets[g]+indices[g]
+                if (dice >= RAND) and (self.nreplicas > 1):
+                    for i in range(len(model_sums)):
+                        model_sums[i][:] = new_sums[i]
+                sep_accepted[g] += 1.0
                 self.accepted += 1.0
+            else:
+                # Restore the proposal buffers to the current configuration
+                state[:] = self.state
+                indices[g] = self.indices[g]
+                values[g] = self.values[g]
             self.total += 1.0
 
+            if expanded:
+                # Attempt a move to a neighbouring lambda
+                l = k + lambda_moves[n]
+                if 0 <= l < len(self.lambdas):
+                    dE = (self.lambda_energies[l,self.state]-self.lambda_energies[k,self.state]).sum()
+                    dE += self.nreplicas*(self.lambda_logZ[l]-self.lambda_logZ[k])
+                    if lambda_metropolis[n] < np.exp(-dE + self.lambda_weights[l] - self.lambda_weights[k]):
+                        self.E += dE
+                        self.set_lambda(l)
+                        k = l
+                        self.lambda_accepted += 1
+                self.lambda_total += 1
+                self.lambda_weights[k] -= self.wl_factor
+                self.lambda_counts[k] += 1
+
             if (step >= burn):
                 _step = step-burn
-                if not verbose: pbar.update(1)
+                if not verbose and (_step+1)%progress_freq == 0: pbar.update(progress_freq)
+                t = _step-trace_offset
+                if t == len(state_trace):
+                    if low_memory:
+                        store_states(t)
+                        trace_offset += t
+                        t = 0
+                    else:
+                        grow = min(len(state_trace), nsteps-len(state_trace))
+                        state_trace = np.concatenate([state_trace, np.zeros((grow, self.nreplicas), dtype=int)])
+                        lambda_trace = np.concatenate([lambda_trace, np.zeros(grow, dtype=int)])
                 # Store sampled states along trajectory
-                for i in range(len(self.state)):
-                    self.traj.state_counts[int(self.state[i])] += 1
-                    self.traj.state_trace.append(int(self.state[i]))
+                state_trace[t] = self.state
+                lambda_trace[t] = k
+                if low_memory:
+                    # Welford update of the running energy statistics
+                    stats = energy_stats[k]
+                    stats[0] += 1
+                    delta = self.E - stats[1]
+                    stats[1] += delta/stats[0]
+                    stats[2] += delta*(self.E - stats[1])
+                    stats[3], stats[4] = min(stats[3], self.E), max(stats[4], self.E)
                 # Store the counts of sampled sigma along the trajectory
-                for i in range(len(self.indices)):
-                    self.traj.sampled_parameters[i][self.indices[i]] += 1
-                # Store trajectory samples
-                temp=[[] for i in range(n_rest)]
-                for n,m in enumerate(rest_index):
-                    temp[m].append(self.indices[n])
-                # Store trajectory samples
-                if (_step%self.traj_every == 0):
-                    self.traj.trajectory.append( [int(_step), float(self.E),
-                        int(self.accept), list(self.state.copy()), list(temp.copy())])
-                        #int(self.accept), int(self.state), list(temp.copy())])
-                    self.traj.traces.append(self.values.copy())
+                sampled[k,flat_index] += 1
+                # Store trajectory samples (steps are counted separately for each lambda)
+                traj_step = lambda_steps[k]
+                lambda_steps[k] += 1
+                if (traj_step%self.traj.freq_save_traj == 0):
+                    frame = [int(traj_step), float(self.E), int(self.accept),
+                            self.state.tolist(), [self.indices[g].tolist() for g in groups]]
+                    if low_memory:
+                        self.traj.add_to_reservoir(frame, self.values.tolist())
+                    else:
+                        self.traj.trajectory.append(frame)
+                        self.traj.traces.append(self.values.tolist())
+                        if self.max_snapshots and len(self.traj.trajectory) >= self.max_snapshots:
+                            self.traj.decimate()
 
                 if verbose:
                     if _step%print_freq == 0:
                         output = """%i\t\t%s\t%s\t\t%.3f\t\t%.2f\t%s"""%(_step, self.state,
-                                self.indices, self.E/self.nreplicas, self.accepted/self.total*100., self.accept)
+                                self.indices.tolist(), self.E/self.nreplicas, self.accepted/self.total*100., self.accept)
                         print(output)
+                if monitor is not None:
+                    monitor.update(self.indices, self.state)
+                    if ((_step+1)%check_freq == 0) and monitor.check(_step+1):
+                        if not verbose: pbar.total = burn+_step+1
+                        print('\nConverged after %s steps'%(_step+1))
+                        nsteps = _step+1
             step += 1
-        restraints = list(dict.fromkeys([r.split("_")[-1] for r in self.rest_type]))
-        if not verbose: pbar.close()
+            if (deadline is not None) and (time.time() > deadline) and (step < nsteps+burn):
+                # Stop at this step boundary and finalize as if nsteps had been reached
+                nsteps, burn = max(0, step-burn), min(burn, step)
+                if not verbose: pbar.total = step
+                print('\nTime budget of %s s reached after %s steps'%(time_budget, nsteps))
+        if not verbose:
+            pbar.update(nsteps%progress_freq)
+            pbar.close()
+
+        # Store sampled states and the counts of sampled nuisance parameters
+        store_states(nsteps-trace_offset)
+        for l,traj in enumerate(trajs):
+            traj.nsteps = int(lambda_steps[l])
+            if low_memory: traj.merge_energy_stats(*energy_stats[l])
+            for i in range(n_para):
+                traj.sampled_parameters[i] += sampled[l,offsets[i]:offsets[i+1]]
 
         print('\nAccepted %s %% \n'%(self.accepted/self.total*100.))
         print('\nAccepted [ ...Nuisance paramters..., state] %')
         print('Accepted %s %% \n'%(sep_accepted/self.total*100.))
-        self.traj.sep_accept.append(sep_accepted/self.total*100.)    # separate accepted ratio
-        self.traj.sep_accept.append(self.accepted/self.total*100.)   # the total accepted ratio
+        if expanded:
+            print('Lambda moves accepted %s %%'%(self.lambda_accepted/self.lambda_total*100.))
+            print('Lambda visits %s'%((lambda_steps-lambda_steps0).tolist()))
+            print('Lambda weights %s (ln f = %s)\n'%((self.lambda_weights-self.lambda_weights[0]).tolist(), self.wl_factor))
+        if self.energy_table is not None:
+            print('Energy table: %s entries\n'%(sum([table.size for table in self.energy_table])))
+        elif self.energy_cache.hits + self.energy_cache.misses:
+            # The cache is not used with replicas
+            print('Energy cache: %(hits)s hits, %(misses)s misses (%(hit_rate).2f) \n'%self.energy_cache.summary())
+        if self.pf_cache.hits + self.pf_cache.misses:
+            print('PF cache: %(hits)s hits, %(misses)s misses (%(hit_rate).2f), %(size)s of %(maxsize)s entries \n'%self.pf_cache.summary())
+        for traj in trajs:
+            traj.energy_cache = dict(table=self.energy_table is not None, **self.energy_cache.summary())
+            if self.pf_cache.hits + self.pf_cache.misses:
+                traj.energy_cache["pf"] = self.pf_cache.summary()
+            traj.sep_accept.append(sep_accepted/self.total*100.)    # separate accepted ratio
+            traj.sep_accept.append(self.accepted/self.total*100.)   # the total accepted ratio
+            if monitor is not None:
+                traj.convergence = monitor.summary()
+            if detect:
+                traj.detect_equilibration()
+                if traj.equilibration:
+                    print('lambda=%s: equilibrated after %s steps (Neff = %.1f)'%(traj.lam,
+                        traj.equilibration["step"], traj.equilibration["Neff"]))
+            if expanded:
+                traj.expanded = dict(lambdas=self.lambdas, weights=self.lambda_weights.tolist(),
+                        wl_factor=self.wl_factor, acceptance=self.lambda_accepted/self.lambda_total*100.)
+
+
+    def process_results(self, outdir="./", compress=False):
+        """Process and write the trajectory of every lambda value sampled
+        (see :attr:`PosteriorSamplingTrajectory.process_results`). In
+        expanded-ensemble mode, the sampler is switched to each lambda before
+        it is saved, so that the pickled sampler evaluates the energies of
+        that lambda in :class:`biceps.Analysis`.
+
+        Args:
+            outdir(str): relative path for the output files
+            compress(bool): store the traces run-length encoded
+        """
+
+        if self.lambdas is None:
+            self.traj.process_results(os.path.join(outdir, f"traj_lambda{self.lam}.npz"), compress=compress)
+            return
+        current = self.lambda_index
+        for k,lam in enumerate(self.lambdas):
+            self.set_lambda(k)
+            self.traj.process_results(os.path.join(outdir, f"traj_lambda{lam}.npz"), compress=compress)
+        self.set_lambda(current)
 
 
 
@@ -414,9 +1325,17 @@ class PosteriorSamplingTrajectory(object):
                 "para_index = %s"%parameter_indices]
         self.trajectory = []
         self.traces = []
+        self.energy_cache = {}
+        self.expanded = {}
+        self.convergence = {}
+        self.equilibration = {}
+        self.reservoir = {}
+        self.energy_stats = {}
+        self.nsteps = 0
+        self.freq_save_traj = int(sampler.traj_every) # may grow (see :attr:`decimate`)
         self.results = {}
 
-    def process_results(self, filename=None):
+    def process_results(self, filename=None, compress=False):
         """Process the trajectory, computing sampling statistics,
         ensemble-average NMR observables.
 
@@ -425,8 +1344,14 @@ class PosteriorSamplingTrajectory(object):
         of several arrays into binary format and 3) significantly smaller
         size over many other formats.
 
+        For protection factors that are not precomputed, the 'model' entry of
+        the restraint holds the contact counts of each state (a dictionary of
+        Nc and Nh arrays) instead of the model observables.
+
         Args:
             filename(str): relative path and filename for MCMC trajectory
+            compress(bool): store the state trace and trajectory run-length\
+                    encoded (see :attr:`biceps.toolbox.compress_trajectory`)
 
         .. tip::
 
@@ -442,12 +1367,18 @@ class PosteriorSamplingTrajectory(object):
                 'allowed_parameters','sampled_parameters','model','ref','traces','state_trace']
 
         for rest_index in range(len(self.ensemble[0])):
-            n_observables  = self.ensemble[0][rest_index].n
-            for n in range(n_observables):
-                model = []
-                for s in range(len(self.ensemble)):
-                    model.append(self.ensemble[s][rest_index].restraints[n]['model'])
-                self.model[rest_index].append(model)
+            R = self.ensemble[0][rest_index]
+            if hasattr(R, 'precomputed') and not R.precomputed:
+                # The predicted protection factors span the whole nuisance
+                # parameter grid, so only the contact counts of each state are
+                # stored (see :attr:`biceps.Restraint.Restraint_pf.model_grid`)
+                self.model[rest_index] = dict(
+                        Nc=np.array([s[rest_index].Ncs[:,:,:R.n] for s in self.ensemble]),
+                        Nh=np.array([s[rest_index].Nhs[:,:,:R.n] for s in self.ensemble]))
+                continue
+            model = np.array([s[rest_index].get_observables('model') for s in self.ensemble])
+            for n in range(self.ensemble[0][rest_index].n):
+                self.model[rest_index].append(list(model[:,n]))
 
         #TODO: Check to make sure that there hasn't been an update in Py3
         # that will allow datatype convervation in the method `getattr()`
@@ -461,6 +1392,21 @@ class PosteriorSamplingTrajectory(object):
         self.results['ref'] = self.ref
         self.results['traces'] = self.traces
         self.results['state_trace'] = self.state_trace
+        self.results['energy_cache'] = self.energy_cache
+        self.results['expanded'] = self.expanded
+        self.results['convergence'] = self.convergence
+        self.results['equilibration'] = self.equilibration
+        self.results['reservoir'] = self.reservoir
+        self.results['energy_stats'] = self.energy_stats
+        self.results['freq_save_traj'] = self.freq_save_traj
+        if self.reservoir:
+            # Reservoir snapshots are stored in the order of their steps
+            order = np.argsort([frame[0] for frame in self.trajectory], kind='stable')
+            self.results['trajectory'] = [self.trajectory[i] for i in order]
+            self.results['traces'] = [self.traces[i] for i in order]
+        self.results.pop('rle', None)
+        self.results.pop('run_lengths', None)
+        if compress: compress_trajectory(self.results)
 
         self.write(filename, self.results)
         # Save Sampler object
@@ -472,6 +1418,95 @@ class PosteriorSamplingTrajectory(object):
         #return pd.DataFrame(self.results)
 
 
+    def decimate(self):
+        """Double the save interval of the trajectory and keep only the
+        stored snapshots on the new interval, so that the snapshots remain
+        evenly spaced.
+        """
+
+        self.freq_save_traj *= 2
+        keep = [i for i,frame in enumerate(self.trajectory) if frame[0]%self.freq_save_traj == 0]
+        self.trajectory = [self.trajectory[i] for i in keep]
+        self.traces = [self.traces[i] for i in keep]
+
+
+    def add_to_reservoir(self, frame, trace):
+        """Add a snapshot to the fixed-size reservoir of snapshots (Algorithm
+        R), so that the stored snapshots are a uniform random sample of all
+        snapshots seen so far.
+
+        Args:
+            frame(list): trajectory snapshot ['step', 'E', 'accept', 'state', [nuisance parameters]]
+            trace(list): values of the nuisance parameters
+        """
+
+        seen, size = self.reservoir["seen"], self.reservoir["size"]
+        if seen < size:
+            self.trajectory.append(frame)
+            self.traces.append(trace)
+        else:
+            j = np.random.randint(seen+1)
+            if j < size:
+                self.trajectory[j] = frame
+                self.traces[j] = trace
+        self.reservoir["seen"] = seen+1
+
+
+    def merge_energy_stats(self, n, mean, M2, Emin, Emax):
+        """Combine running energy statistics into :attr:`energy_stats`.
+
+        Args:
+            n(int): number of samples
+            mean(float): mean energy
+            M2(float): sum of squared deviations from the mean
+            Emin(float): minimum energy
+            Emax(float): maximum energy
+        """
+
+        if n == 0: return
+        stats = self.energy_stats
+        if not stats:
+            stats.update(n=0, mean=0.0, M2=0.0, min=np.inf, max=-np.inf)
+        N = stats["n"] + n
+        delta = mean - stats["mean"]
+        stats["M2"] += M2 + delta**2*stats["n"]*n/N
+        stats["mean"] += delta*n/N
+        stats["n"] = int(N)
+        stats["min"], stats["max"] = min(stats["min"], Emin), max(stats["max"], Emax)
+        stats["std"] = np.sqrt(stats["M2"]/N)
+
+
+    def detect_equilibration(self, nskip=None):
+        """Detect the equilibration point of the stored energy trace, which
+        is the start of the trajectory maximizing the effective number of
+        uncorrelated samples (see :func:`pymbar.timeseries.detectEquilibration`).
+        The result is stored in the trajectory metadata, and the samples
+        before it are discarded by :class:`biceps.Analysis` and
+        :class:`biceps.Convergence` when loading (see :attr:`biceps.toolbox.discard_burn_in`).
+        The in-memory :attr:`state_counts` and :attr:`sampled_parameters` are
+        left untrimmed.
+
+        Args:
+            nskip(int): number of samples between the trial equilibration points\
+                    (defaults to 1% of the trajectory)
+
+        :rtype dict: index of the first equilibrated sample, its step, the\
+                statistical inefficiency (g) and the effective number of samples (Neff)
+        """
+
+        if self.reservoir:
+            raise ValueError("Equilibration detection requires the full trajectory (not a reservoir)")
+        E = np.array([frame[1] for frame in self.trajectory], dtype=float)
+        if len(E) < 3:
+            self.equilibration = {}
+            return self.equilibration
+        if nskip is None: nskip = max(1, len(E)//100)
+        t0, g, Neff = timeseries.detectEquilibration(E, nskip=nskip)
+        self.equilibration = dict(index=int(t0), step=int(self.trajectory[int(t0)][0]),
+                g=float(g), Neff=float(Neff))
+        return self.equilibration
+
+
     def write(self, filename='traj.npz', *args, **kwds):
         """Writes a compact file of several arrays into binary format.
         Standardized: Yes ; Binary: Yes; Human Readable: No;
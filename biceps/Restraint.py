@@ -1,12 +1,37 @@
 
 # -*- coding: utf-8 -*-
-import os, sys, inspect
+import os, sys, inspect, copy, multiprocessing
+import concurrent.futures
 import numpy as np
 import pandas as pd
 import mdtraj as md
 import biceps
 from biceps.KarplusRelation import * # Returns J-coupling values from dihedral angles
 
+_ARGSPECS = {}
+
+def _argspecs(R):
+    """Return the argument names of the constructor and of the init_restraint
+    method of the Restraint class **R**, resolved once per class."""
+
+    if R not in _ARGSPECS:
+        _ARGSPECS[R] = (inspect.getfullargspec(R)[0],
+                inspect.getfullargspec(R.init_restraint)[0])
+    return _ARGSPECS[R]
+
+
+_CONTACT_STORES = {}
+
+def _contact_store(filename):
+    """Return the memory-mapped contact counts of **filename** (see
+    :attr:`biceps.toolbox.read_contact_store`), opened once per file."""
+
+    key = (os.path.abspath(filename), os.path.getmtime(filename))
+    if key not in _CONTACT_STORES:
+        _CONTACT_STORES[key] = biceps.toolbox.read_contact_store(filename)
+    return _CONTACT_STORES[key]
+
+
 class Ensemble(object):
     def __init__(self, lam, energies, debug=False):
         """Container class for :attr:`biceps.Restraint.Restraint` objects.
@@ -25,10 +50,44 @@ class Ensemble(object):
         if np.array(energies).dtype != float:
             raise ValueError("Energies should be array with type of 'float'")
         else:
+            self.unscaled_energies = np.array(energies)
             self.energies = self.lam*energies # Scale the energies
         self.debug = debug
 
 
+    def at_lambda(self, lam):
+        """Return a view of the ensemble at another lambda value, without
+        rebuilding or copying the restraints. The restraints (with their sse
+        grids and reference potentials) are shared with this ensemble; only
+        the scaled energies differ, and the :attr:`biceps.PosteriorSampler`
+        of the view recomputes logZ from them. The lists holding the
+        restraints of each state are copied, so adding states or restraints
+        to the view leaves this ensemble unchanged.
+
+        Args:
+            lam(float): lambda value to scale energies
+
+        Returns:
+            object: :class:`Ensemble` at **lam**
+
+        .. code-block:: python
+
+            ensemble = biceps.Ensemble(0.0, energies)
+            ensemble.initialize_restraints(input_data, parameters)
+            for lam in lambda_values:
+                sampler = biceps.PosteriorSampler(ensemble.at_lambda(lam))
+        """
+
+        if not isinstance(lam, float):
+            raise ValueError("lambda should be a single number with type of 'float'")
+        view = copy.copy(self)
+        view.ensemble = [list(s) for s in self.ensemble]
+        view.unscaled_energies = self.unscaled_energies.copy()
+        view.lam = lam
+        view.energies = lam*self.unscaled_energies
+        return view
+
+
     def to_list(self):
         """Converts the :class:`Ensemble` class to a list.
 
@@ -39,15 +98,21 @@ class Ensemble(object):
         return self.ensemble
 
 
-    def initialize_restraints(self, input_data, parameters=None):
+    def initialize_restraints(self, input_data, parameters=None, cache=None, nprocs=1):
         """Initialize corresponding :attr:`biceps.Restraint.Restraint` classes based on experimental
         observables from **input_data** for each conformational state.
 
         Args:
             input_data(list of str): a sorted collection of filenames (files\
-                    contain `exp` (experimental) and `model` (theoretical) observables)
+                    contain `exp` (experimental) and `model` (theoretical) observables),\
+                    or a list of restraint stores, one file for each restraint with every\
+                    state (see :attr:`biceps.toolbox.write_restraint_store`)
             parameters(list of dict): dictionary containing keys that match \
                     :attr:`biceps.Restraint.Restraint` parameters and values are lists for each restraint.\
+            cache(str or object): directory (or :attr:`biceps.toolbox.EnsembleCache`) of\
+                    an on-disk cache of initialized ensembles. On a hit, the restraints are\
+                    loaded instead of parsing the input files again.
+            nprocs(int): number of processes used to initialize the states in parallel
 
         .. code-block:: python
 
@@ -78,52 +143,319 @@ class Ensemble(object):
         """
 
         verbose = self.debug
-        if parameters is None: parameters = [dict() for i in range(len(input_data[0]))]
+        store = all(isinstance(data, str) for data in input_data)
+        if parameters is None:
+            parameters = [dict() for i in range(len(input_data if store else input_data[0]))]
+        if cache is not None:
+            if isinstance(cache, str): cache = biceps.toolbox.EnsembleCache(cache)
+            cache_key = cache.key(input_data, self.unscaled_energies, parameters)
+            ensemble = cache.get(cache_key)
+            if ensemble is not None:
+                # The cached restraints are independent of lambda
+                for i in range(len(ensemble)):
+                    for R in ensemble[i]: R.energy = self.energies[i]
+                self.ensemble.extend(ensemble)
+                return
+        if store:
+            # The model arrays are memory-mapped, so only one row per state is read
+            data = [biceps.toolbox.read_restraint_store(filename) for filename in input_data]
+            self.initialize_restraints_from_arrays(data, parameters, nprocs=nprocs)
+            if cache is not None: cache.put(cache_key, self.ensemble)
+            return
         extensions = biceps.toolbox.list_extensions(input_data)
-        lam = self.lam
+        jobs = []
         for i in range(self.energies.shape[0]):
-            self.ensemble.append([])
-            energy = self.energies[i]
+            sources = []
             for k in range(len(input_data[0])):
                 data = input_data[i][k]
-                extension = extensions[k]
                 ext = data.split(".")[-1]
-                restraint, extension = ext.split("_")[0], ext.split("_")[-1]
-                # Find all Child Restraint classes in the current file
-                current_module = sys.modules[__name__]
-                # Pick the Restraint class upon file extension
-                R = getattr(current_module, "Restraint_%s"%(restraint))
-                # Get all the arguments for the Parent Restraint Class if given
-                args1 = {"%s"%key: val for key,val in locals().items()
-                        if key in inspect.getfullargspec(R)[0] if key != 'self'}
-                args2 = {"%s"%key: val for key,val in locals().items()
-                        if key in inspect.getfullargspec(R.init_restraint)[0] if key != 'self'}
-                # It shouldn't matter the ordering of the keys and values
-                # All parameters are parsed as respective Restraint child class arguments
-                for key,val in parameters[k].items():
-                    if key in inspect.getfullargspec(R)[0]:
-                        args1[key] = val
-                    elif key in inspect.getfullargspec(R.init_restraint)[0]:
-                        args2[key] = val
-                    else:
-                        possible_args = np.unique(np.concatenate(
-                            [inspect.getfullargspec(R)[0],
-                            inspect.getfullargspec(R.init_restraint)[0]]))
-                        possible_args = np.delete(possible_args, np.where(possible_args == "self"))
-                        possible_args = np.delete(possible_args, np.where(possible_args == "data"))
-                        raise TypeError(f"{key} is an invalid keyword argument for {R}\n\n\
+                sources.append((ext.split("_")[0], data, ext.split("_")[-1], None))
+            jobs.append((self.energies[i], sources, parameters, extensions))
+        self.ensemble.extend(self._initialize_states(jobs, nprocs))
+        if cache is not None: cache.put(cache_key, self.ensemble)
+
+
+    def _init_restraint(self, restraint, data, energy, extension, parameters, extensions,
+            state=None):
+        """Initialize a single :attr:`biceps.Restraint.Restraint` of a state.
+
+        Args:
+            restraint(str): restraint name (e.g., "noe", "J", "cs", "pf")
+            data(str or pd.DataFrame): filename of data, or the data itself
+            energy(float): the (reduced) free energy of the state
+            extension(str): extension of the restraint (e.g., "H" for "cs_H")
+            parameters(dict): keyword arguments of the restraint
+            extensions(list): extensions of all restraints (for error messages)
+            state(int): index of the state in the ensemble (passed on to\
+                    restraints that take it, e.g. :attr:`Restraint_pf.init_restraint`)
+        """
+
+        verbose = self.debug
+        # Find all Child Restraint classes in the current file
+        current_module = sys.modules[__name__]
+        # Pick the Restraint class upon file extension
+        R = getattr(current_module, "Restraint_%s"%(restraint))
+        # Get all the arguments for the Parent Restraint Class if given
+        argspec1, argspec2 = _argspecs(R)
+        args1 = {"%s"%key: val for key,val in locals().items()
+                if key in argspec1 if key != 'self'}
+        args2 = {"%s"%key: val for key,val in locals().items()
+                if key in argspec2 if key != 'self'}
+        # It shouldn't matter the ordering of the keys and values
+        # All parameters are parsed as respective Restraint child class arguments
+        for key,val in parameters.items():
+            if key in argspec1:
+                args1[key] = val
+            elif key in argspec2:
+                args2[key] = val
+            else:
+                possible_args = np.unique(np.concatenate([argspec1, argspec2]))
+                possible_args = np.delete(possible_args, np.where(possible_args == "self"))
+                possible_args = np.delete(possible_args, np.where(possible_args == "data"))
+                raise TypeError(f"{key} is an invalid keyword argument for {R}\n\n\
 Please check your parameters... \n\
-The input data provided suggests the ordering of dictionaries should be: {biceps.toolbox.list_extensions(input_data)}\n\
+The input data provided suggests the ordering of dictionaries should be: {extensions}\n\
 Dictionary keys for {R.__name__} are any of: {possible_args}")
-                if self.debug:
-                    print(R)
-                    print(f"Required args by inspect:{inspect.getfullargspec(R.init_restraint)[0]}")
-                    print(f"args1 given: {args1}")
-                    print(f"args2 given: {args2}")
-                R = R(**args1) # Initializing Restraint
-                R.init_restraint(**args2)
-                self.ensemble[-1].append(R)
+        if self.debug:
+            print(R)
+            print(f"Required args by inspect:{argspec2}")
+            print(f"args1 given: {args1}")
+            print(f"args2 given: {args2}")
+        R = R(**args1) # Initializing Restraint
+        # Restraints with a gamma grid leave their sse to compute_ensemble_sse
+        R.ensemble_sse = (R.__class__ is Restraint_noe)
+        R.init_restraint(**args2)
+        return R
+
+
+    def initialize_restraints_from_arrays(self, data, parameters=None, nprocs=1):
+        """Initialize the :attr:`biceps.Restraint.Restraint` classes of each
+        conformational state directly from arrays held in memory, without
+        writing and reading the per-state files of :attr:`Preparation`.
+
+        Args:
+            data(list of dict): one dictionary for each restraint with keys\
+                    `restraint` (e.g., "noe", "J", "cs_H", "pf"), `exp` (shape (nobs,)),\
+                    `model` (shape (nstates, nobs)) and optionally `weight` (shape (nobs,),\
+                    multiplies the weight of each observable), `restraint_index` (shape (nobs,),\
+                    equivalency groups, defaults to one group per observable) and\
+                    `indices` (atom indices, shape (nobs,) or (nobs, natoms))
+            parameters(list of dict): see :attr:`initialize_restraints`
+            nprocs(int): number of processes used to initialize the states in parallel
+
+        .. code-block:: python
+
+            ensemble = biceps.Ensemble(lam, energies)
+            ensemble.initialize_restraints_from_arrays([
+                dict(restraint="J", exp=J_exp, model=J_model),
+                dict(restraint="noe", exp=noe_exp, model=noe_model, restraint_index=groups)],
+                parameters)
+        """
+
+        if parameters is None: parameters = [dict() for k in range(len(data))]
+        nstates = self.energies.shape[0]
+        columns, models, weights = [], [], []
+        for k,d in enumerate(data):
+            exp = np.asarray(d["exp"], dtype=float)
+            model = np.asarray(d["model"], dtype=float)
+            if model.shape != (nstates, len(exp)):
+                raise ValueError("The model array of %s should have shape (nstates, nobs) = %s"%(
+                    d["restraint"], (nstates, len(exp))))
+            restraint_index = d.get("restraint_index")
+            if restraint_index is None: restraint_index = np.arange(len(exp))
+            indices = d.get("indices")
+            if indices is None: indices = -np.ones((len(exp), 4), dtype=int)
+            indices = np.asarray(indices, dtype=int).reshape((len(exp), -1))
+            cols = dict(exp=exp, restraint_index=np.asarray(restraint_index, dtype=int))
+            for a in range(4):
+                cols["atom_index%s"%(a+1)] = indices[:,min(a, indices.shape[1]-1)]
+            columns.append(cols)
+            models.append(model)
+            weights.append(d.get("weight"))
+        extensions = [str(d["restraint"]).split("_")[-1] for d in data]
+        jobs = []
+        for i in range(nstates):
+            sources = [(str(d["restraint"]).split("_")[0], dict(columns[k], model=models[k][i]),
+                extensions[k], weights[k]) for k,d in enumerate(data)]
+            jobs.append((self.energies[i], sources, parameters, extensions))
+        self.ensemble.extend(self._initialize_states(jobs, nprocs))
+
+
+    def _initialize_state(self, job, state=None):
+        """Initialize the restraints of a single state.
+
+        Args:
+            job(tuple): (energy, sources, parameters, extensions), where each\
+                    source is (restraint, data, extension, weight) of a restraint
+            state(int): index of the state in the ensemble
+
+        Returns:
+            list: :attr:`biceps.Restraint.Restraint` objects of the state
+        """
+
+        energy, sources, parameters, extensions = job
+        restraints = []
+        for k,(restraint, data, extension, weight) in enumerate(sources):
+            if isinstance(data, dict): data = pd.DataFrame(data)
+            R = self._init_restraint(restraint, data, energy, extension,
+                    parameters[k], extensions, state=state)
+            if weight is not None:
+                R.restraints['weight'] = R.restraints['weight']*np.asarray(weight, dtype=float)
+                if not R.ensemble_sse: R.sse = R.compute_sse(f=R.restraints)
+            restraints.append(R)
+        return restraints
+
+
+    def _initialize_states(self, jobs, nprocs=1):
+        """Initialize the restraints of every state, in parallel over
+        **nprocs** processes. The results are returned in state order.
+
+        Args:
+            jobs(list): one job per state (see :attr:`_initialize_state`)
+            nprocs(int): number of processes
+        """
+
+        if nprocs is None: nprocs = multiprocessing.cpu_count()
+        index = range(len(self.ensemble), len(self.ensemble)+len(jobs))
+        if nprocs <= 1 or len(jobs) < 2:
+            states = [self._initialize_state(job, i) for job,i in zip(jobs, index)]
+        else:
+            # Only the energies are needed by the workers, not any earlier restraints
+            worker = copy.copy(self)
+            worker.ensemble = []
+            chunksize = max(1, int(np.ceil(len(jobs)/(4.0*nprocs))))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=nprocs) as executor:
+                states = list(executor.map(worker._initialize_state, jobs, index, chunksize=chunksize))
+        for k in range(len(states[0]) if states else 0):
+            if any(s[k].ensemble_sse and s[k].sse is None for s in states):
+                self.compute_ensemble_sse([s[k] for s in states])
+        return states
+
+
+    def compute_ensemble_sse(self, restraints):
+        """Compute the sse of a :attr:`biceps.Restraint.Restraint_noe` for every
+        state and every allowed gamma at once. The sse of each state is stored
+        as a row of a single shared (nstates, ngamma) array.
+
+        The sums over observables are expanded in powers of gamma (or of
+        log gamma when `log_normal=True`), so the (state, gamma, observable)
+        grid is contracted with a few (nstates, nobs) matrix products.
+
+        Args:
+            restraints(list): the restraint of each state
+
+        :rtype np.ndarray: sse with shape (nstates, ngamma)
+        """
+
+        R = restraints[0]
+        gamma = np.asarray(R.allowed_gamma, dtype=float)
+        exp = np.array([r.restraints['exp'] for r in restraints], dtype=float)
+        model = np.array([r.restraints['model'] for r in restraints], dtype=float)
+        weight = np.array([r.restraints['weight'] for r in restraints], dtype=float)
+        if R.log_normal:
+            # sum_j w_j (d_j - log gamma)^2, with d_j = log(model_j/exp_j)
+            d = np.log(model/exp)
+            g = np.log(gamma)
+            sse = np.sum(weight*d**2.0, axis=1)[:,np.newaxis] - 2.0*np.outer(np.sum(weight*d, axis=1), g)\
+                    + np.outer(np.sum(weight, axis=1), g**2.0)
+        else:
+            # sum_j w_j (gamma*exp_j - model_j)^2
+            sse = np.outer(np.sum(weight*exp**2.0, axis=1), gamma**2.0)\
+                    - 2.0*np.outer(np.sum(weight*exp*model, axis=1), gamma)\
+                    + np.sum(weight*model**2.0, axis=1)[:,np.newaxis]
+        sse = np.maximum(sse, 0.0)
+        Ndof = np.sum(weight, axis=1)
+        for i,r in enumerate(restraints):
+            r.sse = sse[i]
+            r.Ndof = float(Ndof[i])
+        return sse
+
+
+
+class Observables(object):
+    """Compact storage of the observables of a :attr:`biceps.Restraint.Restraint`,
+    with one NumPy array per field (e.g., 'exp', 'model', 'weight') instead of
+    one dictionary per observable. Indexing with a field name returns the
+    array of that field; indexing with an integer returns a read-only
+    :class:`Observable` view with dictionary-like access.
+
+    Args:
+        fields(dict): arrays of each field, with one entry per observable
+    """
+
+    __slots__ = ("fields",)
+
+    def __init__(self, fields=None):
+        self.fields = {key: np.asarray(val) for key,val in (fields or {}).items()}
+
+    def __len__(self):
+        return len(next(iter(self.fields.values()))) if self.fields else 0
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return self.fields[key]
+        if isinstance(key, slice):
+            return [Observable(self, j) for j in range(len(self))[key]]
+        j = int(key)
+        if j < 0: j += len(self)
+        if not 0 <= j < len(self):
+            raise IndexError("observable index out of range")
+        return Observable(self, j)
+
+    def __setitem__(self, key, value):
+        if not isinstance(key, str):
+            raise TypeError("observables are assigned by field, e.g. restraints['weight'] = values")
+        self.fields[key] = np.asarray(value)
+
+    def __iter__(self):
+        for j in range(len(self)):
+            yield Observable(self, j)
+
+    def __repr__(self):
+        return "<Observables n=%s fields=%s>"%(len(self), list(self.fields))
+
+    def keys(self):
+        return self.fields.keys()
 
+    def append(self, observable):
+        """Append a single observable given as a dictionary of its fields."""
+
+        n = len(self)
+        for key in list(self.fields) + [key for key in observable if key not in self.fields]:
+            value = np.asarray(observable.get(key, np.nan))[np.newaxis]
+            current = self.fields.get(key, np.full((n,)+value.shape[1:], np.nan))
+            self.fields[key] = np.concatenate([current, value])
+
+
+class Observable(object):
+    """A read-only view of a single observable of :class:`Observables`."""
+
+    __slots__ = ("table", "index")
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    def __getitem__(self, key):
+        return self.table.fields[key][self.index]
+
+    def __setitem__(self, key, value):
+        raise TypeError("observables are read-only, assign to restraints['%s'] instead"%key)
+
+    def __contains__(self, key):
+        return key in self.table.fields
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def keys(self):
+        return self.table.fields.keys()
+
+    def to_dict(self):
+        return {key: self[key] for key in self.keys()}
 
 
 class Restraint(object):
@@ -141,7 +473,7 @@ class Restraint(object):
         """
 
         # Store restraint info
-        self.restraints = []   # a list of data container objects for each restraint (e.g. NMR_Chemicalshift_Ca())
+        self.restraints = Observables()   # arrays of exp, model, weight,... of each observable
 
         # used for exponential reference potential
         self.betas = None
@@ -184,6 +516,8 @@ class Restraint(object):
             pd.DataFrame
         """
 
+        if isinstance(filename, pd.DataFrame):
+            return filename
         if self.verbose:
             print('Loading %s as %s...'%(filename,As))
         df = getattr(pd, "read_%s"%As)
@@ -192,38 +526,67 @@ class Restraint(object):
 
 
     def add_restraint(self, restraint):
-        """Append an experimental restraint object to the list.
+        """Append an experimental observable to :attr:`restraints`.
 
         Args:
-            restraint(object): :attr:`biceps.Restraint.Restraint` object
+            restraint(dict): fields of the observable (e.g., 'exp', 'model')
         """
 
         self.restraints.append(restraint)
 
+    def get_observables(self, key):
+        """Return the values of **key** (e.g., 'exp', 'model', 'weight') for
+        each observable of this restraint as an array.
+
+        Args:
+            key(str): name of the field
+
+        :rtype np.ndarray:
+        """
+
+        return self.restraints[key]
+
+    def compile_equivalency_groups(self):
+        """Group the observables by their 'restraint_index'. Observables with
+        a restraint index of None belong to no group.
+
+        :rtype dict: indices of the observables of each restraint index
+        """
+
+        index = self.restraints['restraint_index']
+        valid = np.array([i is not None for i in index], dtype=bool)
+        keys, inverse, counts = np.unique(index[valid], return_inverse=True, return_counts=True)
+        members = np.where(valid)[0][np.argsort(inverse, kind="stable")]
+        groups = np.split(members, np.cumsum(counts)[:-1])
+        return {key: group.tolist() for key,group in zip(keys.tolist(), groups)}
+
+    def compute_sse_from_model(self, model):
+        """Returns the (weighted) sum of squared errors for an array of model
+        observables (e.g., observables averaged over replicas).
+
+        Args:
+            model(np.ndarray): model value of each observable
+        """
+
+        err = np.asarray(model) - self.get_observables('exp')
+        return np.sum(self.get_observables('weight')*err**2.0)
+
     def compute_neglog_exp_ref(self):
         """Uses the stored beta information to compute \
                 :math:`-log P_{ref}(r_{j}(X_{i}))` over each structure\
                 :math:`X_{i}` and for each observable :math:`r_{j}`.
         """
 
-        self.neglog_exp_ref = np.zeros(self.n)
-        self.sum_neglog_exp_ref = 0.0
-        for j in range(self.n):
-            self.neglog_exp_ref[j] = np.log(self.betas[j])\
-                    + self.restraints[j]['model']/self.betas[j]
-            self.sum_neglog_exp_ref  += self.restraints[j]['weight'] * self.neglog_exp_ref[j]
+        self.neglog_exp_ref = np.log(self.betas) + self.restraints['model']/self.betas
+        self.sum_neglog_exp_ref = np.sum(self.restraints['weight']*self.neglog_exp_ref)
 
     def compute_neglog_gaussian_ref(self):
         """An alternative option for reference potential based on
         Gaussian distribution. (Ignoring constant terms)"""
 
-        self.neglog_gaussian_ref = np.zeros(self.n)
-        self.sum_neglog_gaussian_ref = 0.0
-        for j in range(self.n):
-            self.neglog_gaussian_ref[j] = np.log(np.sqrt(2.0*np.pi))\
-                    + np.log(self.ref_sigma[j]) + (self.restraints[j]['model'] \
-                    - self.ref_mean[j])**2.0/(2.0*self.ref_sigma[j]**2.0)
-            self.sum_neglog_gaussian_ref += self.restraints[j]['weight'] * self.neglog_gaussian_ref[j]
+        self.neglog_gaussian_ref = np.log(np.sqrt(2.0*np.pi)) + np.log(self.ref_sigma)\
+                + (self.restraints['model'] - self.ref_mean)**2.0/(2.0*self.ref_sigma**2.0)
+        self.sum_neglog_gaussian_ref = np.sum(self.restraints['weight']*self.neglog_gaussian_ref)
 
 
 class Restraint_cs(Restraint):
@@ -260,25 +623,18 @@ class Restraint_cs(Restraint):
 
         # Group by keys
         keys = ['atom_index1', 'exp', 'model']
-        grouped_data = data[keys].to_dict()
-        for row in range(len(grouped_data[keys[0]])):
-            d = {key: grouped_data[key][row] for key in grouped_data.keys()}
-            self.add_restraint(d)
-            # N equivalent chemical shift should only get 1/N f the weight when
-            #... computing chi^2 (not likely in this case but just in case we need it in the future)
-            self.restraints[-1]['weight'] = weight  #1.0/3.0 used in JCTC 2020 paper  # default is N=1
+        self.restraints = Observables({key: data[key].values for key in keys})
+        # N equivalent chemical shift should only get 1/N f the weight when
+        #... computing chi^2 (not likely in this case but just in case we need it in the future)
+        self.restraints['weight'] = np.full(self.n, float(weight))  #1.0/3.0 used in JCTC 2020 paper  # default is N=1
         self.sse = self.compute_sse(f=self.restraints)
 
     def compute_sse(self, f):
         """Returns the (weighted) sum of squared errors for chemical shift values."""
 
-        N,sse = 0.0, 0.0
-        for i in range(self.n):
-            err = f[i]['model'] - f[i]['exp']
-            sse += (f[i]['weight']*err**2.0)
-            N += f[i]['weight']
-        self.Ndof = N
-        return sse
+        err = f['model'] - f['exp']
+        self.Ndof = float(np.sum(f['weight']))
+        return float(np.sum(f['weight']*err**2.0))
 
 
     def compute_neglogP(self, parameters, parameter_indices, sse):
@@ -337,21 +693,13 @@ class Restraint_J(Restraint):
         # Group by keys
         keys = ['atom_index1', 'atom_index2', 'atom_index3', 'atom_index4',
                 'exp', 'model', 'restraint_index']
-        grouped_data = data[keys].to_dict()
-        for row in range(len(grouped_data[keys[0]])):
-            d = {key: grouped_data[key][row] for key in grouped_data.keys()}
-            self.add_restraint(d)
-
-        self.equivalency_groups = {}
-        # Compile equivalency_groups from the list of NMR_Dihedral() objects
-        for i in range(len(self.restraints)):
-            d = self.restraints[i]
-            if d['restraint_index'] != None:
-                if d['restraint_index'] not in self.equivalency_groups:
-                    self.equivalency_groups[d['restraint_index']] = []
-                self.equivalency_groups[d['restraint_index']].append(i)
+        self.restraints = Observables({key: data[key].values for key in keys})
+        self.restraints['weight'] = np.ones(self.n)
+
+        # Compile equivalency_groups from the restraint indices
+        self.equivalency_groups = self.compile_equivalency_groups()
         if verbose:
-            print(f'grouped_data = {grouped_data}')
+            print(f'data = {data[keys]}')
             print(f'self.restraints[0] = {self.restraints[0]}')
             print(f'self.equivalency_groups = {self.equivalency_groups}')
         # adjust the weights of distances and dihedrals to account for equivalencies
@@ -364,21 +712,15 @@ class Restraint_J(Restraint):
         their equivalency group."""
 
         for group in list(self.equivalency_groups.values()):
-            n = float(len(group))
-            for i in group:
-                self.restraints[i]['weight'] = 1.0/n
+            self.restraints['weight'][group] = 1.0/float(len(group))
 
 
     def compute_sse(self, f):
         """Returns the (weighted) sum of squared errors"""
 
-        N,sse = 0.0, 0.0
-        for i in range(self.n):
-            err = f[i]['model'] - f[i]['exp']
-            sse += (f[i]['weight']*err**2.0)
-            N += f[i]['weight']
-        self.Ndof = N
-        return sse
+        err = f['model'] - f['exp']
+        self.Ndof = float(np.sum(f['weight']))
+        return float(np.sum(f['weight']*err**2.0))
 
 
     def compute_neglogP(self, parameters, parameter_indices, sse):
@@ -446,54 +788,57 @@ class Restraint_noe(Restraint):
 
         # Group by keys
         keys = ['atom_index1', 'atom_index2', 'exp', 'model', 'restraint_index']
-        grouped_data = data[keys].to_dict()
-        for row in range(len(grouped_data[keys[0]])):
-            d = {key: grouped_data[key][row] for key in grouped_data.keys()}
-            self.add_restraint(d)
-
-        self.equivalency_groups = {}
-        for i in range(len(self.restraints)):
-            d = self.restraints[i]
-            if d['restraint_index'] != None:
-                if d['restraint_index'] not in self.equivalency_groups:
-                    self.equivalency_groups[d['restraint_index']] = []
-                self.equivalency_groups[d['restraint_index']].append(i)
+        self.restraints = Observables({key: data[key].values for key in keys})
+        self.restraints['weight'] = np.ones(self.n)
+
+        self.equivalency_groups = self.compile_equivalency_groups()
         if verbose:
-            print(f'grouped_data = {grouped_data}')
+            print(f'data = {data[keys]}')
             #print(f'self.restraints[0] = {self.restraints[0]}')
             print(f'self.equivalency_groups = {self.equivalency_groups}')
         # adjust the weights of distances and dihedrals to account for equivalencies
         self.adjust_weights()
-        self.sse = self.compute_sse(f=self.restraints)
+        if getattr(self, "ensemble_sse", False):
+            # The sse of every state is computed at once by :attr:`Ensemble.compute_ensemble_sse`
+            self.sse = None
+        else:
+            self.sse = self.compute_sse(f=self.restraints)
 
     def adjust_weights(self):
         """Adjust the weights of distance and dihedral restraints based on
         their equivalency group."""
 
         for group in list(self.equivalency_groups.values()):
-            n = float(len(group))
-            for i in group:
-                self.restraints[i]['weight'] = 1.0/n
+            self.restraints['weight'][group] = 1.0/float(len(group))
 
 
     def compute_sse(self, f):
         """Returns the (weighted) sum of squared errors"""
 
-        _sse = np.array([0.0 for gamma in self.allowed_gamma])
-        for g in range(len(self.allowed_gamma)):
-            N,sse = 0.0, 0.0
-            for i in range(self.n):
-                gamma = self.allowed_gamma[g]
-                #if self.use_log_normal_noe:
-                if self.log_normal:
-                    err = np.log(f[i]['model']/(gamma*f[i]['exp']))
-                else:
-                    err = gamma*f[i]['exp'] - f[i]['model']
-                sse += (f[i]['weight'] * err**2.0)
-                N += f[i]['weight']
-            _sse[g] = sse
-            self.Ndof = N
-        return _sse
+        gamma = np.asarray(self.allowed_gamma)[:,np.newaxis]
+        if self.log_normal:
+            err = np.log(f['model']/(gamma*f['exp']))
+        else:
+            err = gamma*f['exp'] - f['model']
+        self.Ndof = float(np.sum(f['weight']))
+        return np.sum(f['weight']*err**2.0, axis=1)
+
+
+    def compute_sse_from_model(self, model):
+        """Returns the (weighted) sum of squared errors for an array of model
+        distances (e.g., averaged over replicas) for each allowed gamma.
+
+        Args:
+            model(np.ndarray): model value of each observable
+        """
+
+        exp = self.get_observables('exp')
+        gamma = np.asarray(self.allowed_gamma)[:,np.newaxis]
+        if self.log_normal:
+            err = np.log(np.asarray(model)/(gamma*exp))
+        else:
+            err = gamma*exp - np.asarray(model)
+        return np.sum(self.get_observables('weight')*err**2.0, axis=1)
 
 
     def compute_neglogP(self, parameters, parameter_indices, sse):
@@ -527,7 +872,8 @@ class Restraint_pf(Restraint):
     def init_restraint(self, data, energy, precomputed=False, pf_prior=None,
             Ncs_fi=None, Nhs_fi=None, beta_c=[0.05, 0.25, 0.01], beta_h=[0.0, 5.2, 0.2],
             beta_0=[-10.0, 0.0, 0.2], xcs=[5.0, 8.5, 0.5], xhs=[2.0, 2.7, 0.1],
-            bs=[15.0, 16.0, 1.0], weight=1, states=None, verbose=False):
+            bs=[15.0, 16.0, 1.0], weight=1, states=None, state=None, contacts=None,
+            dtype="float64", lazy=False, verbose=False):
         """Initialize protection factor restraints for each **exp** (experimental)
         and **model** (theoretical) observable given **data**.
 
@@ -541,6 +887,20 @@ class Restraint_pf(Restraint):
             xcs(list): [min, max, spacing]
             xhs(list): [min, max, spacing]
             bs(list): [min, max, spacing]
+            Ncs_fi(str): directory of the `Nc_x%0.1f_b%d_state%03d.npy` contact counts
+            Nhs_fi(str): directory of the `Nh_x%0.1f_b%d_state%03d.npy` contact counts
+            states(list): state label of each conformational state in the contact\
+                    count files (defaults to the index of the state)
+            state(int): index of this conformational state (set by :attr:`Ensemble`)
+            contacts(str): packed contact counts written by\
+                    :attr:`biceps.toolbox.write_contact_store`, used instead of\
+                    **Ncs_fi** and **Nhs_fi**
+            dtype(str): floating point type of the sse and reference potential\
+                    grids ("float32" halves their memory)
+            lazy(bool): never compute the sse and reference potential grids.\
+                    The sampler evaluates them at the visited points of the\
+                    nuisance parameter grid instead (see\
+                    :attr:`biceps.PosteriorSampler.pf_neglogP`)
 
         """
 
@@ -554,25 +914,45 @@ class Restraint_pf(Restraint):
         allowed_xcs=np.arange(xcs_min,xcs_max,dxcs)
         allowed_xhs=np.arange(xhs_min,xhs_max,dxhs)
         allowed_bs=np.arange(bs_min,bs_max,dbs)
-        Ncs=np.zeros((len(allowed_xcs),len(allowed_bs),107))
-        Nhs=np.zeros((len(allowed_xhs),len(allowed_bs),107))
-        for i in range(len(states)):
-            for o in range(len(allowed_xcs)):
-                for q in range(len(allowed_bs)):
-                    infile_Nc='%s/Nc_x%0.1f_b%d_state%03d.npy'%(Ncs_fi,
-                            allowed_xcs[o], allowed_bs[q],states[i])
-                    Ncs[o,q,:] = (np.load(infile_Nc))
-            for p in range(len(allowed_xhs)):
-                for q in range(len(allowed_bs)):
-                    infile_Nh='%s/Nh_x%0.1f_b%d_state%03d.npy'%(Nhs_fi,
-                            allowed_xhs[p], allowed_bs[q],states[i])
-                    Nhs[p,q,:] = (np.load(infile_Nh))
+        Ncs, Nhs = None, None
+        if not precomputed:
+            # Only the contact counts of this state are loaded
+            if states is None:
+                label = state
+            elif state is None and len(states) == 1:
+                label = states[0]
+            elif state is None or not 0 <= state < len(states):
+                raise ValueError("states should give the label of each conformational state")
+            else:
+                label = states[state]
+            if label is None:
+                raise ValueError("The state of the contact counts is unknown")
+            if contacts is not None:
+                store = _contact_store(contacts)
+                for key,allowed in [("xcs", allowed_xcs), ("xhs", allowed_xhs), ("bs", allowed_bs)]:
+                    if (len(store[key]) != len(allowed)) or not np.allclose(store[key], allowed):
+                        raise ValueError("The %s of %s differ from %s"%(key, contacts, allowed))
+                row = np.where(store["states"] == label)[0]
+                if len(row) == 0:
+                    raise ValueError("%s holds no contact counts of state %s"%(contacts, label))
+                Ncs = np.array(store["Nc"][row[0]], dtype=float)
+                Nhs = np.array(store["Nh"][row[0]], dtype=float)
+            else:
+                Ncs = np.array([[np.load('%s/Nc_x%0.1f_b%d_state%03d.npy'%(Ncs_fi, x, b, label))
+                    for b in allowed_bs] for x in allowed_xcs], dtype=float)
+                Nhs = np.array([[np.load('%s/Nh_x%0.1f_b%d_state%03d.npy'%(Nhs_fi, x, b, label))
+                    for b in allowed_bs] for x in allowed_xhs], dtype=float)
 
         # The (reduced) free energy f = beta*F of this structure, as predicted by modeling
         self.energy = energy
         self.Ndof = None
         self.precomputed = precomputed
+        self.dtype = np.dtype(dtype)
+        self.lazy = lazy
+        if self.lazy and self.precomputed:
+            raise ValueError("lazy evaluation requires precomputed=False")
         # load pf priors from training model
+        self.pf_prior = None
         if pf_prior is not None:
             self.pf_prior = np.load(pf_prior)
 
@@ -638,18 +1018,10 @@ class Restraint_pf(Restraint):
         else:
             keys = ['atom_index1', 'exp']
 
-        grouped_data = data[keys].to_dict()
-        if not self.precomputed:
-            for row in range(len(grouped_data[keys[0]])):
-                d = {key: grouped_data[key][row] for key in grouped_data.keys()}
-                d['model'] = self.compute_PF_multi(self.Ncs[:,:,row], self.Nhs[:,:,row], debug=False)
-                self.add_restraint(d)
-                self.restraints[-1]['weight'] = weight
-        else:
-            for row in range(len(grouped_data[keys[0]])):
-                d = {key: grouped_data[key][row] for key in grouped_data.keys()}
-                self.add_restraint(d)
-                self.restraints[-1]['weight'] = weight
+        # Without precomputed protection factors, the model of each residue is
+        # a grid over the nuisance parameters, evaluated on demand (see model_grid)
+        self.restraints = Observables({key: data[key].values for key in keys})
+        self.restraints['weight'] = np.full(self.n, float(weight))
 
         self.sse = self.compute_sse(f=self.restraints)
 
@@ -657,21 +1029,29 @@ class Restraint_pf(Restraint):
     def compute_sse(self, f):
         """Returns the (weighted) sum of squared errors"""
 
-        N,sse = 0.0, 0.0
         if self.precomputed:
-            for i in range(self.n):
-                err = f[i]['model'] - f[i]['exp']
-                sse += (f[i]['weight']*err**2.0)
-                N += f[i]['weight']
-            self.Ndof = N
+            err = f['model'] - f['exp']
+            sse = float(np.sum(f['weight']*err**2.0))
+            self.Ndof = float(np.sum(f['weight']))
+        elif self.lazy:
+            sse = None
+            self.Ndof = float(np.sum(f['weight']))
         else:
-            sse = np.zeros( (len(self.allowed_beta_c), len(self.allowed_beta_h), len(self.allowed_beta_0),
-                len(self.allowed_xcs), len(self.allowed_xhs), len(self.allowed_bs)) )
-            self.Ndof = 0.
-            for i in range(self.n):
-                err = f[i]['model'] - f[i]['exp']
-                sse += (f[i]['weight'] * err**2.0)
-                self.Ndof += f[i]['weight']
+            # sum_j w_j (beta_c*Nc_j + beta_h*Nh_j + beta_0 - exp_j)^2, expanded so
+            # that the sums over residues only involve the (x, b) contact counts
+            w, exp = np.asarray(f['weight'], dtype=float), np.asarray(f['exp'], dtype=float)
+            Nc, Nh = self.Ncs[:,:,:self.n], self.Nhs[:,:,:self.n]
+            bc, bh, b0 = self.nuisance_axes()
+            sse = np.zeros(self.nuisance_shape())
+            sse += bc**2.0 * (Nc**2.0 @ w)[:,None,:]
+            sse += bh**2.0 * (Nh**2.0 @ w)[None,:,:]
+            sse += (b0**2.0*np.sum(w) - 2.0*b0*np.sum(w*exp) + np.sum(w*exp**2.0))
+            sse += 2.0*bc*bh*np.einsum('cbj,hbj,j->chb', Nc, Nh, w)
+            sse += 2.0*bc*(b0*(Nc @ w)[:,None,:] - (Nc @ (w*exp))[:,None,:])
+            sse += 2.0*bh*(b0*(Nh @ w)[None,:,:] - (Nh @ (w*exp))[None,:,:])
+            np.maximum(sse, 0.0, out=sse)
+            sse = sse.astype(self.dtype, copy=False)
+            self.Ndof = float(np.sum(w))
         return sse
 
 
@@ -700,30 +1080,58 @@ class Restraint_pf(Restraint):
             np.ndarray: ``<ln PF> = beta_c <N_c> + beta_h <N_h> + beta_0 for all residues``
         """
 
-        N_beta_c = len(self.allowed_beta_c)
-        N_beta_h = len(self.allowed_beta_h)
-        N_beta_0 = len(self.allowed_beta_0)
-        N_xc     = len(self.allowed_xcs)
-        N_xh     = len(self.allowed_xhs)
-        N_b      = len(self.allowed_bs)
+        bc, bh, b0 = self.nuisance_axes()
+        if debug:
+            print('nuisance_shape', self.nuisance_shape())
+        out = np.empty(self.nuisance_shape())
+        np.multiply(bc, np.asarray(Ncs_i)[:,None,:], out=out)
+        out += bh*np.asarray(Nhs_i)[None,:,:]
+        out += b0
+        return out
 
-        nuisance_shape = (N_beta_c, N_beta_h, N_beta_0, N_xc, N_xh, N_b)
 
-        beta_c = self.tile_multiaxis(self.allowed_beta_c, nuisance_shape, axis=0)
-        beta_h = self.tile_multiaxis(self.allowed_beta_h, nuisance_shape, axis=1)
-        beta_0 = self.tile_multiaxis(self.allowed_beta_0, nuisance_shape, axis=2)
-        Nc     = self.tile_2D_multiaxis(Ncs_i, nuisance_shape, axes=[3,5])
-        Nh     = self.tile_2D_multiaxis(Nhs_i, nuisance_shape, axes=[4,5])
+    def nuisance_shape(self):
+        """Shape of the grid of (beta_c, beta_h, beta_0, xcs, xhs, bs)."""
 
-        if debug:
-            print('nuisance_shape', nuisance_shape)
-            print('beta_c.shape', beta_c.shape)
-            print('beta_h.shape', beta_h.shape)
-            print('beta_0.shape', beta_0.shape)
-            print('Nc.shape', Nc.shape)
-            print('Nh.shape', Nh.shape)
+        return (len(self.allowed_beta_c), len(self.allowed_beta_h), len(self.allowed_beta_0),
+                len(self.allowed_xcs), len(self.allowed_xhs), len(self.allowed_bs))
+
+
+    def nuisance_axes(self):
+        """Return beta_c, beta_h and beta_0 shaped to broadcast against the
+        trailing (xcs, xhs, bs) axes of the nuisance parameter grid."""
+
+        return (self.allowed_beta_c[:,None,None,None,None,None],
+                self.allowed_beta_h[None,:,None,None,None,None],
+                self.allowed_beta_0[None,None,:,None,None,None])
+
+
+    def model_grid(self, j, out=None):
+        """Return the predicted ln PF of residue **j** over the nuisance
+        parameter grid, written into **out** if given.
+
+        Args:
+            j(int): residue index
+            out(np.ndarray): buffer with shape :attr:`nuisance_shape`
+        """
+
+        if out is None: out = np.empty(self.nuisance_shape())
+        bc, bh, b0 = self.nuisance_axes()
+        np.multiply(bc, self.Ncs[:,None,:,j], out=out)
+        out += bh*self.Nhs[None,:,:,j]
+        out += b0
+        return out
+
+
+    def get_observables(self, key):
+        """See :attr:`biceps.Restraint.Restraint.get_observables`. Without
+        precomputed protection factors, the 'model' of each residue is
+        evaluated over the whole nuisance parameter grid."""
+
+        if key == 'model' and not self.precomputed:
+            return np.array([self.model_grid(j) for j in range(self.n)])
+        return super(Restraint_pf, self).get_observables(key)
 
-        return beta_c * Nc + beta_h * Nh + beta_0
 
     def tile_multiaxis(self, p, shape, axis=None):
         """Returns a multi-dimensional array of shape (tuple), with the 1D
@@ -766,22 +1174,37 @@ class Restraint_pf(Restraint):
 
 
     def compute_neglog_exp_ref_pf(self):
-        self.neglog_exp_ref= np.zeros((self.n, len(self.allowed_beta_c), len(self.allowed_beta_h), len(self.allowed_beta_0),
-                                       len(self.allowed_xcs),    len(self.allowed_xhs),    len(self.allowed_bs)))
-        self.sum_neglog_exp_ref = 0.
+        """Exponential reference potential of the protection factors, summed
+        over residues one residue at a time into a single grid."""
+
+        self.sum_neglog_exp_ref = np.zeros(self.nuisance_shape())
+        model = np.empty(self.nuisance_shape())
         for j in range(self.n): # number of residues
-            self.neglog_exp_ref[j] = np.maximum(-1.0*self.restraints[j]['model'], 0.0)
-            self.sum_neglog_exp_ref  += self.restraints[j]['weight'] * self.neglog_exp_ref[j]
+            self.model_grid(j, out=model)
+            np.negative(model, out=model)
+            np.maximum(model, 0.0, out=model)
+            model *= self.restraints['weight'][j]
+            self.sum_neglog_exp_ref += model
+        self.sum_neglog_exp_ref = self.sum_neglog_exp_ref.astype(self.dtype, copy=False)
 
 
     def compute_neglog_gaussian_ref_pf(self):
-        self.neglog_gaussian_ref = np.zeros((self.n, len(self.allowed_beta_c), len(self.allowed_beta_h), len(self.allowed_beta_0),
-                                       len(self.allowed_xcs),    len(self.allowed_xhs),    len(self.allowed_bs)))
-        self.sum_neglog_gaussian_ref = 0.
+        """Gaussian reference potential of the protection factors, summed
+        over residues one residue at a time into a single grid."""
+
+        self.sum_neglog_gaussian_ref = np.zeros(self.nuisance_shape())
+        model = np.empty(self.nuisance_shape())
         for j in range(self.n): # number of residues
-            self.neglog_gaussian_ref[j] = 0.5 * np.log(2.0*np.pi) + np.log(self.ref_sigma[j]) \
-                      + (self.restraints[j]['model'] - self.ref_mean[j])**2.0/(2.0*self.ref_sigma[j]**2.0)
-            self.sum_neglog_gaussian_ref += self.restraints[j]['weight'] * self.neglog_gaussian_ref[j]
+            self.model_grid(j, out=model)
+            model -= self.ref_mean[j]
+            model /= self.ref_sigma[j]
+            model **= 2.0
+            model *= 0.5
+            model += np.log(self.ref_sigma[j])
+            model += 0.5 * np.log(2.0*np.pi)
+            model *= self.restraints['weight'][j]
+            self.sum_neglog_gaussian_ref += model
+        self.sum_neglog_gaussian_ref = self.sum_neglog_gaussian_ref.astype(self.dtype, copy=False)
 
 
     def compute_neglogP(self, parameters, parameter_indices, sse):
@@ -861,7 +1284,27 @@ class Preparation(object):
         dfOut = getattr(df, "to_%s"%As)
         dfOut(filename)
 
-    def prep_cs(self, exp_data, model_data, indices, extension, verbose=False):
+    def write_store(self, restraint, models, verbose=False):
+        """Write the experimental columns of the current DataFrame once,
+        together with the model observables of every state, into
+        `<restraint>.npz` (see :attr:`biceps.toolbox.write_restraint_store`).
+
+        Args:
+            restraint(str): restraint name (e.g., "noe", "J", "cs_H", "pf")
+            models(list): model observables of each state
+        """
+
+        if any(model is None for model in models):
+            raise ValueError("A restraint store requires model data for every state")
+        df = pd.DataFrame(self.biceps_df)
+        columns = [col for col in df.columns if col.startswith("atom_index")]
+        filename = os.path.join(self.outdir, "%s.npz"%restraint)
+        if verbose: print('Writing %s...'%filename)
+        biceps.toolbox.write_restraint_store(filename, restraint, df['exp'].values,
+                np.array(models, dtype=float), df['restraint_index'].values,
+                df[columns].values)
+
+    def prep_cs(self, exp_data, model_data, indices, extension, store=False, verbose=False):
         """A method for preprocessing chemicalshift **exp_data** and **model_data**.
 
         Args:
@@ -869,6 +1312,8 @@ class Preparation(object):
             model_data(str): path to model data file (units: ppm)
             indices(str): path to atom indices
             extension(str): nuclei for the CS data ("H" or "Ca or "N")
+            store(bool): write a single restraint store with every state\
+                    (see :attr:`write_store`) instead of one file per state
         """
 
         self.header = ('exp', 'model', 'restraint_index', 'atom_index1', 'res1',
@@ -884,6 +1329,7 @@ class Preparation(object):
             raise ValueError("The number of states doesn't equal to file numbers")
         if self.ind.shape[0] != self.exp_data.shape[0]:
             raise ValueError('The number of atom pairs (%d) does not match the number of restraints (%d)! Exiting.'%(self.ind.shape[0],self.exp_data.shape[0]))
+        models = []
         for j in range(len(self.model_data)):
             dd = { self.header[i]: [] for i in range(len(self.header)) }
             model_data = np.loadtxt(self.model_data[j])
@@ -898,12 +1344,16 @@ class Preparation(object):
             self.biceps_df = pd.DataFrame(dd)
             if verbose:
                 print(self.biceps_df)
+            if store:
+                models.append(dd.get("model"))
+                continue
             filename = "%s.cs_%s"%(j, extension)
             self.write_DataFrame(filename=os.path.join(self.outdir,filename), verbose=verbose)
+        if store: self.write_store("cs_%s"%extension, models, verbose=verbose)
 
 
 
-    def prep_noe(self, exp_data, model_data, indices, extension=None, verbose=False):
+    def prep_noe(self, exp_data, model_data, indices, extension=None, store=False, verbose=False):
         """A method for preprocessing NOE **exp_data** and **model_data**.
 
         Args:
@@ -911,6 +1361,8 @@ class Preparation(object):
             model_data(str): path to model data file (units: :math:`Å`)
             indices(str): path to atom indices
             extension(str): nuclei for the CS data ("H" or "Ca or "N")
+            store(bool): write a single restraint store with every state\
+                    (see :attr:`write_store`) instead of one file per state
         """
 
         self.header = ('exp', 'model', 'restraint_index', 'atom_index1', 'res1',
@@ -924,6 +1376,7 @@ class Preparation(object):
             raise ValueError("The number of states doesn't equal to file numbers")
         if self.ind.shape[0] != self.exp_data.shape[0]:
             raise ValueError('The number of atom pairs (%d) does not match the number of restraints (%d)! Exiting.'%(self.ind.shape[0],self.exp_data.shape[0]))
+        models = []
         for j in range(len(self.model_data)):
             dd = { self.header[i]: [] for i in range(len(self.header)) }
             model_data = np.loadtxt(self.model_data[j])
@@ -941,12 +1394,16 @@ class Preparation(object):
             self.biceps_df = pd.DataFrame(dd)
             if verbose:
                 print(self.biceps_df)
+            if store:
+                models.append(dd.get("model"))
+                continue
             filename = "%s.noe"%(j)
             self.write_DataFrame(filename=os.path.join(self.outdir,filename), verbose=verbose)
+        if store: self.write_store("noe", models, verbose=verbose)
 
 
 
-    def prep_J(self, exp_data, model_data, indices, extension=None, verbose=False):
+    def prep_J(self, exp_data, model_data, indices, extension=None, store=False, verbose=False):
         """A method for preprocessing scalar coupling **exp_data** and **model_data**.
 
         Args:
@@ -954,6 +1411,8 @@ class Preparation(object):
             model_data(str): path to model data file (units: Hz)
             indices(str): path to atom indices
             extension(str): nuclei for the CS data ("H" or "Ca or "N")
+            store(bool): write a single restraint store with every state\
+                    (see :attr:`write_store`) instead of one file per state
         """
 
         self.header = ('exp', 'model', 'restraint_index', 'atom_index1', 'res1', 'atom_name1',
@@ -971,6 +1430,7 @@ class Preparation(object):
             raise ValueError("The number of states doesn't equal to file numbers")
         if self.ind.shape[0] != self.exp_data.shape[0]:
             raise ValueError('The number of atom pairs (%d) does not match the number of restraints (%d)! Exiting.'%(self.ind.shape[0],self.exp_data.shape[0]))
+        models = []
         for j in range(len(self.model_data)):
             dd = { self.header[i]: [] for i in range(len(self.header)) }
             model_data = np.loadtxt(self.model_data[j])
@@ -992,11 +1452,15 @@ class Preparation(object):
             self.biceps_df = pd.DataFrame(dd)
             if verbose:
                 print(self.biceps_df)
+            if store:
+                models.append(dd.get("model"))
+                continue
             filename = "%s.J"%(j)
             self.write_DataFrame(filename=os.path.join(self.outdir,filename), verbose=verbose)
+        if store: self.write_store("J", models, verbose=verbose)
 
 
-    def prep_pf(self, exp_data, model_data=None, indices=None, extension=None, verbose=False):
+    def prep_pf(self, exp_data, model_data=None, indices=None, extension=None, store=False, verbose=False):
         """A method for preprocessing HDX protection factor **exp_data** and
         **model_data**.
 
@@ -1005,6 +1469,8 @@ class Preparation(object):
             model_data(str): path to model data file (units: Hz)
             indices(str): path to atom indices
             extension(str): nuclei for the CS data ("H" or "Ca or "N")
+            store(bool): write a single restraint store with every state\
+                    (see :attr:`write_store`) instead of one file per state
         """
 
         if model_data: self.header = ('exp','model', 'restraint_index', 'atom_index1', 'res1', )
@@ -1019,6 +1485,7 @@ class Preparation(object):
         if self.ind.shape[0] != self.exp_data.shape[0]:
             raise ValueError('The number of atom pairs (%d) does not match the\
                     number of restraints (%d)! Exiting.'%(self.ind.shape[0],self.exp_data.shape[0]))
+        models = []
         for j in range(len(self.model_data)):
             dd = { self.header[i]: [] for i in range(len(self.header)) }
             model_data = np.loadtxt(self.model_data[j])
@@ -1034,8 +1501,12 @@ class Preparation(object):
             self.biceps_df = pd.DataFrame(dd)
             if verbose:
                 print(self.biceps_df)
+            if store:
+                models.append(dd.get("model"))
+                continue
             filename = "%s.pf"%(j)
             self.write_DataFrame(filename=os.path.join(self.outdir,filename), verbose=verbose)
+        if store: self.write_store("pf", models, verbose=verbose)
 
 
 
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import time
+from .PosteriorSampler import PosteriorSampler
+from .toolbox import logsumexp
+from tqdm import tqdm # progress bar
+
+
+class SMCSampler(object):
+
+    def __init__(self, ensemble, nparticles=1000, lambdas=None, ess_threshold=0.5,
+            nmoves=10, table_memory=256., verbose=False):
+        """A Sequential Monte Carlo sampler, where a population of particles
+        (conformational state and nuisance parameter indices) is annealed
+        from lambda=0 to lambda=1. At each lambda, the particles are
+        reweighted by the change of the scaled energies, resampled when the
+        effective sample size drops below **ess_threshold** and rejuvenated
+        with Metropolis moves. The log normalizer accumulated along the
+        path gives the BICePs score without separate runs and MBAR.
+
+        Args:
+            ensemble(object): a :attr:`biceps.Ensemble` object
+            nparticles(int): number of particles
+            lambdas(list): increasing lambda schedule (defaults to 11 evenly spaced\
+                    values from 0 to 1)
+            ess_threshold(float): fraction of **nparticles** below which the\
+                    particles are resampled
+            nmoves(int): number of Metropolis sweeps over the particles at each lambda
+            table_memory(float): memory budget (in MB) for the precomputed energy\
+                    table (see :attr:`biceps.PosteriorSampler.build_energy_table`)
+        """
+
+        if lambdas is None: lambdas = np.linspace(0.0, 1.0, 11)
+        self.lambdas = np.array(lambdas, dtype=float)
+        if np.any(np.diff(self.lambdas) <= 0):
+            raise ValueError("lambdas should be strictly increasing")
+        self.nparticles = int(nparticles)
+        self.ess_threshold = ess_threshold
+        self.nmoves = int(nmoves)
+        self.verbose = verbose
+        # The PosteriorSampler provides the reference potentials and the
+        # (tabulated) restraint energies of each state
+        self.sampler = PosteriorSampler(ensemble, table_memory=table_memory)
+        self.ensemble = self.sampler.ensemble
+        self.nstates = self.sampler.nstates
+        self.unscaled_energies = np.array(ensemble.unscaled_energies, dtype=float)
+
+        allowed = self.sampler.compile_nuisance_parameters()
+        self.rest_type = []
+        self.rest_index = []
+        for i,R in enumerate(self.ensemble[0]):
+            keys = R.__dict__.keys() # all attributes of the Child Restraint class
+            for j in [key.split("_")[-1] for key in keys if "allowed_" in key]:
+                self.rest_type.append(str(j)+"_"+str(R.__repr__).split("_")[-1].split()[0])
+                self.rest_index.append(i)
+        self.allowed = [np.asarray(allowed[k], dtype=float) for k in range(len(self.rest_index))]
+        self.n_allowed = np.array([len(a) for a in self.allowed])
+        n_rest = max(self.rest_index)+1
+        bounds = np.concatenate([[0], np.cumsum(np.bincount(self.rest_index, minlength=n_rest))])
+        self.groups = [slice(bounds[i], bounds[i+1]) for i in range(n_rest)]
+        self.sampler.build_energy_table(allowed, self.rest_index)
+        if self.sampler.restraint_arrays is None: self.sampler.compile_restraint_arrays()
+        self.results = {}
+
+
+    def compute_logZ(self, lam):
+        """Compute reference state logZ of the energies scaled by **lam**.
+
+        Args:
+            lam(float): lambda value
+        """
+
+        return logsumexp(-lam*self.unscaled_energies)
+
+
+    def restraint_energies(self, states, indices):
+        """Return the restraint part of -ln P (everything but the scaled
+        energy and logZ) for each particle.
+
+        Args:
+            states(np.ndarray): conformational state of each particle
+            indices(np.ndarray): nuisance parameter indices of each particle,\
+                    with shape (nparticles, nparameters)
+
+        :rtype np.ndarray: restraint energies of each particle
+        """
+
+        result = np.zeros(len(states))
+        for i,g in enumerate(self.groups):
+            result += self.restraint_energy(i, states, indices[:,g])
+        return result
+
+
+    def restraint_energy(self, rest_index, states, indices):
+        """Return -ln P of a single restraint (see :attr:`restraint_energies`).
+
+        Args:
+            rest_index(int): restraint index
+            states(np.ndarray): conformational state of each particle
+            indices(np.ndarray): nuisance parameter indices of this restraint,\
+                    with shape (nparticles, nparameters of the restraint)
+        """
+
+        if self.sampler.energy_table is not None:
+            return self.sampler.energy_table[rest_index][(states,)+tuple(indices.T)]
+        g = self.groups[rest_index]
+        sigma = self.allowed[g.start][indices[:,0]]
+        grid = tuple(indices[:,k] for k in range(1, g.stop-g.start))
+        return self.sampler.restraint_energy(rest_index, states, sigma, grid)
+
+
+    def restraint_grid(self, rest_index, state):
+        """Return -ln P of a single restraint for **state** over every
+        combination of its nuisance parameters (flattened).
+
+        Args:
+            rest_index(int): restraint index
+            state(int): conformational state
+        """
+
+        if self.sampler.energy_table is not None:
+            return self.sampler.energy_table[rest_index][state].ravel()
+        # The terms other than sigma are evaluated once over the remaining
+        # grid and broadcast over sigma
+        shape = tuple(self.n_allowed[self.groups[rest_index]])
+        sigma = self.allowed[self.groups[rest_index].start].reshape((-1,)+(1,)*(len(shape)-1))
+        grid = tuple(np.indices(shape[1:], sparse=True))
+        result = self.sampler.restraint_energy(rest_index, state, sigma, grid)
+        return np.broadcast_to(result, shape).ravel()
+
+
+    def initialize_particles(self, lam):
+        """Draw the particles exactly from the posterior at **lam**. For a
+        given state the posterior factorizes over restraints, so the state is
+        drawn from its marginal and then the nuisance parameters of each
+        restraint independently.
+
+        Args:
+            lam(float): lambda value
+        """
+
+        N = self.nparticles
+        n_rest = len(self.groups)
+        lse = np.array([[logsumexp(-self.restraint_grid(i, s)) for i in range(n_rest)]
+            for s in range(self.nstates)])
+        log_p = -lam*self.unscaled_energies + lse.sum(axis=1)
+        p = np.exp(log_p - logsumexp(log_p))
+        self.states = np.random.choice(self.nstates, size=N, p=p/p.sum())
+        self.indices = np.zeros((N, len(self.n_allowed)), dtype=int)
+        for s in np.unique(self.states):
+            members = np.where(self.states == s)[0]
+            for i,g in enumerate(self.groups):
+                p = np.exp(-self.restraint_grid(i, s) - lse[s,i])
+                draw = np.random.choice(len(p), size=len(members), p=p/p.sum())
+                self.indices[members,g] = np.array(np.unravel_index(draw, tuple(self.n_allowed[g]))).T
+        self.u = self.energies(lam, self.states, self.indices)
+
+
+    def energies(self, lam, states, indices):
+        """Return -ln P of each particle at **lam**.
+
+        Args:
+            lam(float): lambda value
+            states(np.ndarray): conformational state of each particle
+            indices(np.ndarray): nuisance parameter indices of each particle
+        """
+
+        return lam*self.unscaled_energies[states] + self.compute_logZ(lam) + self.restraint_energies(states, indices)
+
+
+    def move(self, lam):
+        """One vectorized Metropolis sweep: each particle attempts either a
+        random step of the nuisance parameters of one restraint or a jump to
+        a random state, with the same moves as :attr:`biceps.PosteriorSampler.sample`.
+
+        Args:
+            lam(float): lambda value
+
+        :rtype float: fraction of accepted moves
+        """
+
+        N = self.nparticles
+        n_rest = len(self.groups)
+        move = np.random.randint(n_rest+1, size=N)
+        states, indices = self.states.copy(), self.indices.copy()
+        for i,g in enumerate(self.groups):
+            mask = (move == i)
+            deltas = np.random.randint(-1, 2, size=(mask.sum(), g.stop-g.start))
+            indices[mask,g] = (indices[mask,g] + deltas)%self.n_allowed[g]
+        mask = (move == n_rest)
+        states[mask] = np.random.randint(self.nstates, size=mask.sum())
+        u = self.energies(lam, states, indices)
+        accept = np.random.random(N) < np.exp(np.minimum(0.0, self.u - u))
+        self.states[accept] = states[accept]
+        self.indices[accept] = indices[accept]
+        self.u[accept] = u[accept]
+        return accept.mean()
+
+
+    def resample(self):
+        """Systematic resampling of the particles according to their weights."""
+
+        N = self.nparticles
+        w = np.exp(self.logw - logsumexp(self.logw))
+        positions = (np.random.random() + np.arange(N))/N
+        select = np.minimum(np.searchsorted(np.cumsum(w), positions), N-1)
+        self.states = self.states[select]
+        self.indices = self.indices[select]
+        self.u = self.u[select]
+        self.logw = np.zeros(N)
+
+
+    def ess(self):
+        """Effective sample size of the weighted particles."""
+
+        w = np.exp(self.logw - logsumexp(self.logw))
+        return 1.0/np.sum(w**2)
+
+
+    def sample(self, verbose=None):
+        """Anneal the particles through the lambda schedule. The incremental
+        weights are exp(-(u_{k+1} - u_k)) of each particle, and the log of the
+        mean incremental weight accumulates the log ratio of the posterior
+        normalizers, log Z(lambda_k)/Z(lambda_0). The BICePs score of each
+        lambda is -log Z(lambda_k)/Z(lambda_0).
+
+        :rtype dict: results (see :attr:`results`)
+        """
+
+        if verbose is None: verbose = self.verbose
+        K = len(self.lambdas)
+        logZ = np.zeros(K)
+        ess = np.zeros(K)
+        acceptance = np.zeros(K)
+        resampled = np.zeros(K, dtype=bool)
+        populations = np.zeros((K, self.nstates))
+        start = time.time()
+        self.initialize_particles(self.lambdas[0])
+        self.logw = np.zeros(self.nparticles)
+        ess[0] = self.nparticles
+        populations[0] = np.bincount(self.states, minlength=self.nstates)/float(self.nparticles)
+        if verbose:
+            print("""lambda\t\tESS\t\tAcceptance (%)\tBICePs score""")
+        for k in tqdm(range(1, K), disable=verbose):
+            lam = self.lambdas[k]
+            # Reweight by the change of the scaled energies
+            u = self.energies(lam, self.states, self.indices)
+            W = self.logw - logsumexp(self.logw)
+            logZ[k] = logZ[k-1] + logsumexp(W - (u - self.u))
+            self.logw += -(u - self.u)
+            self.u = u
+            ess[k] = self.ess()
+            if ess[k] < self.ess_threshold*self.nparticles:
+                self.resample()
+                resampled[k] = True
+            # Rejuvenate
+            for sweep in range(self.nmoves):
+                acceptance[k] += self.move(lam)/float(self.nmoves)
+            w = np.exp(self.logw - logsumexp(self.logw))
+            populations[k] = np.bincount(self.states, weights=w, minlength=self.nstates)
+            if verbose:
+                print("""%.3f\t\t%.1f\t\t%.2f\t\t%.5f"""%(lam, ess[k], acceptance[k]*100., -logZ[k]))
+
+        self.results = dict(lambdas=self.lambdas, logZ=logZ, BS=-logZ, ess=ess,
+                resampled=resampled, acceptance=acceptance, populations=populations,
+                states=self.states, indices=self.indices, weights=self.logw,
+                rest_type=self.rest_type)
+        print('\nBICePs score (lambda=%s): %.5f'%(self.lambdas[-1], -logZ[-1]))
+        print('Resampled %s times in %.2f s\n'%(resampled.sum(), time.time()-start))
+        return self.results
+
+
+    def write(self, filename='smc.npz'):
+        """Writes the results of :attr:`sample` into a compact binary file.
+
+        Args:
+            filename(str): path and filename of the output
+
+        :rtype: npz (numpy compressed file)
+        """
+
+        np.savez_compressed(filename, self.results)
+
+
@@ -13,6 +13,7 @@ from biceps.Restraint import Ensemble
 #from biceps.Restraint import Restraint_pf
 from biceps.PosteriorSampler import PosteriorSampler
 from biceps.PosteriorSampler import PosteriorSamplingTrajectory
+from biceps.SMCSampler import SMCSampler
 from biceps.Analysis import Analysis
 from biceps.convergence import Convergence
 import biceps.toolbox
@@ -8,6 +8,7 @@ import warnings
 warnings.filterwarnings("ignore",category=DeprecationWarning)
 warnings.filterwarnings("ignore",category=RuntimeWarning)
 from scipy.optimize import curve_fit
+from .toolbox import discard_burn_in, decompress_trajectory
 
 class Convergence(object):
 
@@ -21,8 +22,16 @@ class Convergence(object):
 
         self.verbose = verbose
         if self.verbose: print(f'Loading {filename}...')
-        self.traj = np.load(filename, allow_pickle=True)['arr_0'].item()
-        self.freq_save_traj = int(self.traj["trajectory"][1][0] - self.traj["trajectory"][0][0])
+        self.traj = discard_burn_in(np.load(filename, allow_pickle=True)['arr_0'].item())
+        # Run-length encoded trajectories are decoded transparently
+        self.traj = decompress_trajectory(self.traj)
+        if self.traj.get('reservoir'):
+            raise ValueError("%s stores a reservoir of snapshots, not a time series"%filename)
+        # The save interval may have grown during sampling (see PosteriorSamplingTrajectory.decimate)
+        if "freq_save_traj" in self.traj:
+            self.freq_save_traj = int(self.traj["freq_save_traj"])
+        else:
+            self.freq_save_traj = int(self.traj["trajectory"][1][0] - self.traj["trajectory"][0][0])
         if self.verbose: print('Collecting rest_type...')
         self.rest_type = self.traj['rest_type']
         if self.verbose: print('Collecting allowed_parameters...')
@@ -590,3 +599,194 @@ class Convergence(object):
 
 
 
+
+
+
+class ConvergenceMonitor(object):
+
+    def __init__(self, n_allowed, nstates, batch_size=100, target_ess=None,
+            jsd_threshold=None, gr_threshold=None, nchains=4):
+        """Streaming convergence statistics of a running MCMC chain, used by
+        :attr:`biceps.PosteriorSampler.sample` to stop sampling early. The
+        chain is summarized by histograms and by the sums (and sums of
+        squares) of consecutive batches of steps, so the memory does not grow
+        with every step. Batches start at **batch_size** steps and are merged
+        pairwise whenever their number reaches twice their size, so that the
+        batch size grows like the square root of the number of steps and
+        eventually exceeds the autocorrelation time, as the batch-means
+        estimate of the effective sample size requires.
+
+        The effective sample size is estimated from the batch means, the
+        Gelman-Rubin statistic from **nchains** contiguous segments of the
+        batches and the Jensen-Shannon divergence between the histograms of
+        the first and second half of the chain (see :attr:`Convergence.compute_JSD`).
+
+        Args:
+            n_allowed(list): number of allowed values of each nuisance parameter
+            nstates(int): number of conformational states
+            batch_size(int): initial number of steps in each batch
+            target_ess(float): minimum effective sample size of every variable
+            jsd_threshold(float): maximum JSD of every variable
+            gr_threshold(float): maximum Gelman-Rubin statistic of every variable
+            nchains(int): number of segments used for the Gelman-Rubin statistic
+        """
+
+        self.n_allowed = np.append(np.asarray(n_allowed, dtype=int), nstates)
+        self.offsets = np.concatenate([[0], np.cumsum(self.n_allowed)])
+        self.batch_size = int(batch_size)
+        self.target_ess = target_ess
+        self.jsd_threshold = jsd_threshold
+        self.gr_threshold = gr_threshold
+        self.nchains = int(nchains)
+        self.nvars = len(self.n_allowed)
+        self.hist = np.zeros(self.offsets[-1])
+        self.snapshots = []
+        self.batch = np.zeros(self.nvars)
+        self.batch_sq = np.zeros(self.nvars)
+        # Buffers of update (allocated once)
+        self.x = np.zeros(self.nvars)
+        self.x_sq = np.zeros(self.nvars)
+        self.positions = np.zeros(self.nvars-1, dtype=int)
+        self.state_positions = None
+        self.count = 0
+        self.batch_sums = []
+        self.batch_sq_sums = []
+        self.history = []
+
+
+    def update(self, indices, states):
+        """Add one step of the chain.
+
+        Args:
+            indices(np.ndarray): current nuisance parameter indices
+            states(np.ndarray): current state of each replica
+        """
+
+        x = self.x
+        x[:-1] = indices
+        x[-1] = np.mean(states)
+        np.add(self.offsets[:-2], indices, out=self.positions)
+        self.hist[self.positions] += 1
+        if self.state_positions is None or len(self.state_positions) != len(states):
+            self.state_positions = np.zeros(len(states), dtype=int)
+        np.add(states, self.offsets[-2], out=self.state_positions)
+        # Replicas in the same state are each counted (unbuffered addition)
+        np.add.at(self.hist, self.state_positions, 1.0/len(states))
+        self.batch += x
+        np.multiply(x, x, out=self.x_sq)
+        self.batch_sq += self.x_sq
+        self.count += 1
+        if self.count == self.batch_size:
+            self.batch_sums.append(self.batch.copy())
+            self.batch_sq_sums.append(self.batch_sq.copy())
+            self.batch[:] = 0.0
+            self.batch_sq[:] = 0.0
+            self.count = 0
+            if len(self.batch_sums) >= 2*self.batch_size: self.merge_batches()
+
+
+    def merge_batches(self):
+        """Merge consecutive pairs of batches, doubling the batch size."""
+
+        self.batch_sums = list(np.array(self.batch_sums).reshape((-1, 2, self.nvars)).sum(axis=1))
+        self.batch_sq_sums = list(np.array(self.batch_sq_sums).reshape((-1, 2, self.nvars)).sum(axis=1))
+        self.batch_size *= 2
+
+
+    def ess(self):
+        """Effective sample size of each variable from the batch means,
+        :math:`N \\sigma^{2}/(b \\sigma_{b}^{2})`.
+
+        :rtype np.ndarray: ESS of each nuisance parameter and the state
+        """
+
+        nb = len(self.batch_sums)
+        if nb < 2: return np.zeros(self.nvars)
+        b = self.batch_size
+        n = nb*b
+        sums = np.array(self.batch_sums)
+        mean = sums.sum(axis=0)/n
+        var = np.array(self.batch_sq_sums).sum(axis=0)/n - mean**2
+        var_b = (sums/b).var(axis=0, ddof=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            tau = np.maximum(b*var_b/var, 1.0)
+            ess = np.where(var > 1e-12, n/tau, 0.0)
+        # Variables with a single allowed value never change
+        ess[self.n_allowed == 1] = np.inf
+        return ess
+
+
+    def gelman_rubin(self):
+        """Gelman-Rubin statistic (R-hat) of each variable, treating
+        **nchains** contiguous segments of the chain as separate chains.
+
+        :rtype np.ndarray: R-hat of each nuisance parameter and the state
+        """
+
+        m = self.nchains
+        nb = (len(self.batch_sums)//m)*m
+        if nb < 2*m: return np.full(self.nvars, np.inf)
+        n = (nb//m)*self.batch_size
+        sums = np.array(self.batch_sums[-nb:]).reshape((m, nb//m, self.nvars)).sum(axis=1)
+        sq = np.array(self.batch_sq_sums[-nb:]).reshape((m, nb//m, self.nvars)).sum(axis=1)
+        means = sums/n
+        W = ((sq - n*means**2)/(n - 1.0)).mean(axis=0)
+        B = n*means.var(axis=0, ddof=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            R = np.sqrt(((n - 1.0)/n*W + B/n)/W)
+        R[(W <= 1e-12) & (B <= 1e-12)] = 1.0
+        return np.nan_to_num(R, nan=np.inf)
+
+
+    def jsd(self):
+        """Jensen-Shannon divergence of each variable between the histograms
+        of the first and second half of the chain (halves are taken at the
+        checks of :attr:`check`).
+
+        :rtype np.ndarray: JSD of each nuisance parameter and the state
+        """
+
+        if len(self.snapshots) < 2: return np.full(self.nvars, np.inf)
+        r1 = self.snapshots[len(self.snapshots)//2-1]
+        r2 = self.hist - r1
+        def entropy(r):
+            p = r/r.sum()
+            return -np.sum(p[p > 0]*np.log(p[p > 0]))
+        result = np.zeros(self.nvars)
+        for i in range(self.nvars):
+            seg = slice(self.offsets[i], self.offsets[i+1])
+            N1, N2 = r1[seg].sum(), r2[seg].sum()
+            N_total = N1+N2
+            result[i] = entropy(self.hist[seg]) - N1/N_total*entropy(r1[seg]) - N2/N_total*entropy(r2[seg])
+        return result
+
+
+    def check(self, step):
+        """Compute the statistics and decide whether the criteria are met.
+
+        Args:
+            step(int): the current step (stored in :attr:`history`)
+
+        :rtype bool: True if every requested criterion is met
+        """
+
+        self.snapshots.append(self.hist.copy())
+        stats = dict(step=int(step), ess=self.ess(), jsd=self.jsd(), gelman_rubin=self.gelman_rubin())
+        self.history.append(stats)
+        converged = True
+        if self.target_ess is not None:
+            converged &= bool(np.all(stats["ess"] >= self.target_ess))
+        if self.jsd_threshold is not None:
+            converged &= bool(np.all(stats["jsd"] <= self.jsd_threshold))
+        if self.gr_threshold is not None:
+            converged &= bool(np.all(stats["gelman_rubin"] <= self.gr_threshold))
+        return converged
+
+
+    def summary(self):
+        """Return the statistics of the last check as a dictionary."""
+
+        if len(self.history) == 0: return {}
+        last = self.history[-1]
+        return dict(step=last["step"], ess=last["ess"].tolist(), jsd=last["jsd"].tolist(),
+                gelman_rubin=last["gelman_rubin"].tolist())
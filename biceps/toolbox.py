@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
-import os, glob, re, pickle
+import os, glob, re, pickle, hashlib, time, zipfile
+from collections import OrderedDict
 import numpy as np
 import pandas as pd
 from biceps.J_coupling import *
@@ -916,6 +917,496 @@ def save_object(obj, filename):
         pickle.dump(obj, output, pickle.HIGHEST_PROTOCOL)
 
 
+def discard_burn_in(traj):
+    """Remove the samples before the equilibration point detected by
+    :attr:`biceps.PosteriorSamplingTrajectory.detect_equilibration` from a
+    loaded trajectory (the dictionary stored in the npz file). Run-length
+    encoded trajectories (see :attr:`compress_trajectory`) are trimmed
+    without decoding.
+
+    The histograms of the sampled nuisance parameters ('sampled_parameters')
+    are accumulated over every step during sampling, so they are rebuilt
+    from the kept snapshots, each counted for **freq_save_traj** steps.
+
+    Args:
+        traj(dict): output trajectory from BICePs sampling
+
+    :rtype dict: the trajectory without the burn-in samples
+    """
+
+    eq = traj.get('equilibration', {})
+    if not eq or eq.get('index', 0) == 0: return traj
+    nreplicas = len(traj['trajectory'][0][3])
+    if not traj.get('rle'):
+        traj['trajectory'] = traj['trajectory'][eq['index']:]
+        traj['traces'] = traj['traces'][eq['index']:]
+        traj['state_trace'] = traj['state_trace'][eq['step']*nreplicas:]
+        counts = np.ones(len(traj['trajectory']))
+    else:
+        start, lengths = trim_runs(traj['run_lengths'], eq['index'])
+        frame = list(traj['trajectory'][start])
+        frame[0] += (int(traj['run_lengths'][start]) - lengths[0])*traj['freq_save_traj']
+        traj['trajectory'] = [frame] + list(traj['trajectory'][start+1:])
+        traj['traces'] = traj['traces'][start:]
+        traj['run_lengths'] = lengths
+        start, lengths = trim_runs(traj['state_trace']['lengths'], eq['step'])
+        traj['state_trace'] = dict(values=traj['state_trace']['values'][start:], lengths=lengths)
+        counts = np.asarray(traj['run_lengths'], dtype=float)
+    freq = traj.get('freq_save_traj', 1)
+    sampled = [np.zeros(len(allowed)) for allowed in traj['allowed_parameters']]
+    for frame,n in zip(traj['trajectory'], counts):
+        for k,index in enumerate(np.concatenate(frame[4]).astype(int)):
+            sampled[k][index] += n*freq
+    traj['sampled_parameters'] = sampled
+    return traj
+
+
+def trim_runs(lengths, n):
+    """Drop the first **n** elements of a run-length encoded sequence.
+
+    Args:
+        lengths(np.ndarray): length of each run
+        n(int): number of elements to drop
+
+    :rtype tuple: (index of the first kept run, lengths of the kept runs)
+    """
+
+    lengths = np.asarray(lengths, dtype=int)
+    cum = np.cumsum(lengths)
+    start = int(np.searchsorted(cum, n, side='right'))
+    lengths = lengths[start:].copy()
+    if len(lengths): lengths[0] = cum[start] - n
+    return start, lengths
+
+
+def compress_trajectory(results):
+    """Run-length encode the traces of a trajectory (the results dictionary
+    of :attr:`biceps.PosteriorSamplingTrajectory.process_results`), since
+    most MCMC steps are rejections that repeat the previous configuration.
+    The state trace is stored as the states of each run and the run lengths,
+    and consecutive identical trajectory snapshots (and their traces) are
+    stored once, with their number in ``run_lengths``.
+
+    Args:
+        results(dict): trajectory results
+
+    :rtype dict: the compressed results
+    """
+
+    if results.get('rle') or len(results['trajectory']) == 0: return results
+    nreplicas = len(results['trajectory'][0][3])
+    trace = np.array(results['state_trace'], dtype=int).reshape((-1, nreplicas))
+    starts = np.concatenate([[0], np.where(np.any(trace[1:] != trace[:-1], axis=1))[0]+1]) if len(trace) else np.array([], dtype=int)
+    results['state_trace'] = dict(values=trace[starts], lengths=np.diff(np.append(starts, len(trace))))
+    freq = results['freq_save_traj']
+    frames, traces, lengths = [], [], []
+    for frame,values in zip(results['trajectory'], results['traces']):
+        if frames and (frame[1:] == frames[-1][1:]) and (frame[0] == frames[-1][0]+lengths[-1]*freq):
+            lengths[-1] += 1
+        else:
+            frames.append(frame)
+            traces.append(values)
+            lengths.append(1)
+    results['trajectory'] = frames
+    results['traces'] = traces
+    results['run_lengths'] = np.array(lengths, dtype=int)
+    results['rle'] = True
+    return results
+
+
+def decompress_trajectory(traj):
+    """Expand a run-length encoded trajectory (see :attr:`compress_trajectory`)
+    into the usual per-step state trace and per-snapshot trajectory and traces.
+
+    Args:
+        traj(dict): output trajectory from BICePs sampling
+
+    :rtype dict: the expanded trajectory
+    """
+
+    if not traj.get('rle'): return traj
+    traj['state_trace'] = decode_state_trace(traj)
+    freq = traj['freq_save_traj']
+    frames, traces = [], []
+    for frame,values,n in zip(traj['trajectory'], traj['traces'], traj['run_lengths']):
+        for j in range(int(n)):
+            frames.append([frame[0]+j*freq]+list(frame[1:]))
+            traces.append(values)
+    traj['trajectory'] = frames
+    traj['traces'] = traces
+    traj['rle'] = False
+    del traj['run_lengths']
+    return traj
+
+
+def decode_state_trace(traj):
+    """Return the (flattened) state trace of a trajectory, decoding it if it
+    is run-length encoded.
+
+    Args:
+        traj(dict): output trajectory from BICePs sampling
+    """
+
+    if not traj.get('rle'): return traj['state_trace']
+    trace = traj['state_trace']
+    return np.repeat(trace['values'], trace['lengths'], axis=0).ravel().tolist()
+
+
+
+
+def write_restraint_store(filename, restraint, exp, model, restraint_index=None,
+        indices=None):
+    """Write the data of a restraint for every conformational state into a
+    single (uncompressed) file: the experimental columns once, followed by the
+    contiguous (nstates, nobs) model array, which :attr:`read_restraint_store`
+    memory-maps.
+
+    Args:
+        filename(str): output filename (.npz)
+        restraint(str): restraint name (e.g., "noe", "J", "cs_H", "pf")
+        exp(np.ndarray): experimental value of each observable
+        model(np.ndarray): model value of each observable (nstates, nobs)
+        restraint_index(np.ndarray): equivalency group of each observable
+        indices(np.ndarray): atom indices of each observable
+
+    >>> biceps.toolbox.write_restraint_store("noe.npz", "noe", exp, model)
+    """
+
+    exp = np.asarray(exp, dtype=float)
+    model = np.asarray(model, dtype=float)
+    if model.ndim != 2 or model.shape[1] != len(exp):
+        raise ValueError("model should have shape (nstates, %s)"%len(exp))
+    if restraint_index is None: restraint_index = np.arange(len(exp))
+    if indices is None: indices = -np.ones((len(exp), 1), dtype=int)
+    # savez does not compress, so the model array stays contiguous on disk
+    np.savez(filename, restraint=np.array(restraint), exp=exp,
+            restraint_index=np.asarray(restraint_index, dtype=int),
+            indices=np.asarray(indices, dtype=int).reshape((len(exp), -1)),
+            model=np.ascontiguousarray(model))
+
+
+def read_restraint_store(filename, mmap_mode="r"):
+    """Read a file written by :attr:`write_restraint_store`. The model array
+    is memory-mapped (unless **mmap_mode** is None), so only the rows of the
+    states being initialized are read from disk.
+
+    Args:
+        filename(str): filename of the store
+        mmap_mode(str): see :attr:`np.memmap`
+
+    :rtype dict: data of the restraint (see :attr:`biceps.Ensemble.initialize_restraints_from_arrays`)
+    """
+
+    with np.load(filename) as npz:
+        data = {key: npz[key] for key in npz.files if key != "model"}
+        model = None if mmap_mode else npz["model"]
+    data["restraint"] = str(data["restraint"])
+    if model is None:
+        model = _memmap_member(filename, "model", mmap_mode)
+    data["model"] = model
+    return data
+
+
+def _memmap_member(filename, name, mmap_mode="r"):
+    """Memory-map the array **name** stored (uncompressed) inside the .npz
+    file **filename**."""
+
+    with zipfile.ZipFile(filename) as archive:
+        info = archive.getinfo("%s.npy"%name)
+        if info.compress_type != zipfile.ZIP_STORED:
+            raise ValueError("%s is compressed and can't be memory-mapped"%filename)
+    with open(filename, "rb") as file:
+        # Skip the local zip header, then the npy header of the member
+        file.seek(info.header_offset + 26)
+        n, m = np.frombuffer(file.read(4), dtype="<u2")
+        file.seek(info.header_offset + 30 + int(n) + int(m))
+        version = np.lib.format.read_magic(file)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(file)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(file)
+        offset = file.tell()
+    return np.memmap(filename, dtype=dtype, mode=mmap_mode, shape=shape,
+            order="F" if fortran_order else "C", offset=offset)
+
+
+def write_contact_store(filename, Ncs_fi, Nhs_fi, states, xcs=[5.0, 8.5, 0.5],
+        xhs=[2.0, 2.7, 0.1], bs=[15.0, 16.0, 1.0]):
+    """Convert the per-(state, x, b) contact count files of the protection
+    factor restraint (`Nc_x%0.1f_b%d_state%03d.npy` and `Nh_x%0.1f_b%d_state%03d.npy`)
+    into a single (uncompressed) file with one array of shape
+    (nstates, x, b, nresidues) for each of Nc and Nh, which
+    :attr:`read_contact_store` memory-maps.
+
+    Args:
+        filename(str): output filename (.npz)
+        Ncs_fi(str): directory of the Nc files
+        Nhs_fi(str): directory of the Nh files
+        states(list): state label of each conformational state in the filenames
+        xcs(list): [min, max, spacing]
+        xhs(list): [min, max, spacing]
+        bs(list): [min, max, spacing]
+
+    >>> biceps.toolbox.write_contact_store("contacts.npz", "input/Nc", "input/Nh", states=range(100))
+    """
+
+    allowed_xcs = np.arange(xcs[0], xcs[1], xcs[2])
+    allowed_xhs = np.arange(xhs[0], xhs[1], xhs[2])
+    allowed_bs = np.arange(bs[0], bs[1], bs[2])
+    Nc = np.array([[[np.load('%s/Nc_x%0.1f_b%d_state%03d.npy'%(Ncs_fi, x, b, state))
+        for b in allowed_bs] for x in allowed_xcs] for state in states], dtype=float)
+    Nh = np.array([[[np.load('%s/Nh_x%0.1f_b%d_state%03d.npy'%(Nhs_fi, x, b, state))
+        for b in allowed_bs] for x in allowed_xhs] for state in states], dtype=float)
+    # savez does not compress, so both arrays stay contiguous on disk
+    np.savez(filename, states=np.asarray(states, dtype=int), xcs=allowed_xcs,
+            xhs=allowed_xhs, bs=allowed_bs, Nc=Nc, Nh=Nh)
+
+
+def read_contact_store(filename, mmap_mode="r"):
+    """Read a file written by :attr:`write_contact_store`. The Nc and Nh
+    arrays are memory-mapped (unless **mmap_mode** is None), so only the
+    rows of the states being initialized are read from disk.
+
+    Args:
+        filename(str): filename of the store
+        mmap_mode(str): see :attr:`np.memmap`
+
+    :rtype dict: states, xcs, xhs, bs, Nc (nstates, x, b, nresidues) and Nh
+    """
+
+    with np.load(filename) as npz:
+        data = {key: npz[key] for key in npz.files if mmap_mode is None or key not in ("Nc", "Nh")}
+    if mmap_mode is not None:
+        for key in ("Nc", "Nh"):
+            data[key] = _memmap_member(filename, key, mmap_mode)
+    return data
+
+
+def logsumexp(a, axis=None):
+    """Numerically stable log(sum(exp(a))).
+
+    Args:
+        a(np.ndarray): array of log values
+        axis(int): axis to sum over
+    """
+
+    a = np.asarray(a, dtype=float)
+    shift = np.max(a, axis=axis, keepdims=True)
+    shift[~np.isfinite(shift)] = 0.0
+    result = np.log(np.sum(np.exp(a - shift), axis=axis, keepdims=True)) + shift
+    return np.squeeze(result, axis=axis) if axis is not None else float(result.ravel()[0])
+
+
+
+class LRUCache(object):
+    def __init__(self, maxsize=100000):
+        """A bounded least-recently-used memo with hit/miss counters.
+
+        Args:
+            maxsize(int): maximum number of entries to keep
+
+        >>> cache = biceps.toolbox.LRUCache(maxsize=2)
+        """
+
+        self.maxsize = int(maxsize)
+        self.data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def get(self, key, default=None):
+        """Return the value stored for **key** (and mark it as recently used),
+        otherwise return **default**."""
+
+        try:
+            value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.data[key] = value
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Store **value** for **key**, evicting the least recently used entry
+        if the cache is full."""
+
+        if key in self.data:
+            self.data.pop(key)
+        elif len(self.data) >= self.maxsize:
+            self.data.popitem(last=False)
+        self.data[key] = value
+
+    def clear(self):
+        """Remove all entries and reset the counters."""
+
+        self.data.clear()
+        self.hits, self.misses = 0, 0
+
+    def hit_rate(self):
+        """Fraction of lookups that were found in the cache."""
+
+        total = self.hits + self.misses
+        return self.hits/float(total) if total else 0.0
+
+    def summary(self):
+        """Return a dictionary of the cache statistics."""
+
+        return dict(size=len(self.data), maxsize=self.maxsize, hits=self.hits,
+                misses=self.misses, hit_rate=self.hit_rate())
+
+
+class EnsembleCache(object):
+    # Bumped whenever the layout of the stored restraints changes (the source
+    # of biceps.Restraint is also part of every key)
+    format = 3
+
+    def __init__(self, path, max_size=1024.):
+        """An on-disk cache of initialized ensembles. Each entry is stored under
+        a content hash of everything that determines the restraints: the
+        contents of the input files (and of any file or directory given in
+        the parameters), the unscaled energies and the parameters. Entries
+        are evicted least recently used first when the total size exceeds
+        **max_size**.
+
+        Args:
+            path(str): directory of the cache
+            max_size(float): size limit of the cache (in MB)
+
+        >>> cache = biceps.toolbox.EnsembleCache("cache/", max_size=512.)
+        >>> ensemble.initialize_restraints(input_data, parameters, cache=cache)
+        """
+
+        self.path = path
+        self.max_size = float(max_size)
+        if not os.path.exists(self.path): os.makedirs(self.path)
+
+    def _hash_path(self, h, path):
+        if os.path.isdir(path):
+            # The relative path and the contents of every file
+            for root, dirs, files in os.walk(path):
+                dirs.sort()
+                for name in sorted(files):
+                    filename = os.path.join(root, name)
+                    h.update(os.path.relpath(filename, path).encode())
+                    self._hash_file(h, filename)
+        else:
+            self._hash_file(h, path)
+
+    def _hash_file(self, h, filename):
+        with open(filename, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                h.update(block)
+
+    def _hash_value(self, h, val):
+        # Arrays by their dtype, shape and bytes (their repr is truncated)
+        if isinstance(val, np.ndarray):
+            val = np.ascontiguousarray(val)
+            h.update(("ndarray%s%s:"%(val.dtype.str, val.shape)).encode())
+            h.update(val.tobytes())
+        elif isinstance(val, (list, tuple)):
+            h.update(("%s%d["%(type(val).__name__, len(val))).encode())
+            for item in val:
+                self._hash_value(h, item)
+            h.update(b"]")
+        else:
+            h.update(repr(val).encode())
+
+    def key(self, input_data, energies, parameters=None):
+        """Return the content hash of an ensemble.
+
+        Args:
+            input_data(list): input files of each state (see :attr:`biceps.Ensemble.initialize_restraints`)
+            energies(np.ndarray): unscaled energies of each state
+            parameters(list of dict): parameters of each restraint
+
+        :rtype str: hex digest
+        """
+
+        import biceps
+        h = hashlib.sha256()
+        h.update(("%s:%s"%(biceps.__version__, self.format)).encode())
+        self._hash_file(h, Restraint.__file__)
+        for files in input_data:
+            for filename in np.atleast_1d(files):
+                h.update(str(filename).encode())
+                self._hash_path(h, str(filename))
+        h.update(np.ascontiguousarray(energies, dtype=float).tobytes())
+        for p in (parameters or []):
+            for key in sorted(p):
+                val = p[key]
+                h.update(("%s="%key).encode())
+                self._hash_value(h, val)
+                h.update(b";")
+                if isinstance(val, str) and os.path.exists(val):
+                    self._hash_path(h, val)
+        return h.hexdigest()
+
+    def filename(self, key):
+        return os.path.join(self.path, "%s.pkl"%key)
+
+    def get(self, key):
+        """Return the restraints stored for **key** (and mark the entry as
+        recently used), otherwise return None."""
+
+        filename = self.filename(key)
+        if not os.path.exists(filename): return None
+        try:
+            with open(filename, "rb") as file:
+                value = pickle.load(file)
+        except Exception:
+            # Truncated or stale entries are dropped and rebuilt
+            self.invalidate(key)
+            return None
+        os.utime(filename, None)
+        return value
+
+    def put(self, key, value):
+        """Store **value** for **key**, then evict the least recently used
+        entries until the cache is within **max_size**."""
+
+        filename = self.filename(key)
+        tmp = "%s.%s.tmp"%(filename, os.getpid())
+        with open(tmp, "wb") as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, filename)
+        # Stat every entry once, then subtract the evicted sizes
+        entries = []
+        for f in self.entries():
+            try:
+                stat = os.stat(f)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, f))
+        entries.sort()
+        total = sum(size for mtime, size, f in entries)
+        for mtime, size, f in entries:
+            if total <= self.max_size*1024.**2: break
+            if f == filename: continue
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+            total -= size
+
+    def entries(self):
+        """Return the filenames of all the entries."""
+
+        return glob.glob(os.path.join(self.path, "*.pkl"))
+
+    def size(self):
+        """Total size of the cache (in MB)."""
+
+        return sum(os.path.getsize(f) for f in self.entries())/1024.**2
+
+    def invalidate(self, key=None):
+        """Remove the entry of **key**, or every entry if **key** is None."""
+
+        files = self.entries() if key is None else [self.filename(key)]
+        for f in files:
+            if os.path.exists(f): os.remove(f)
 
 
 
@@ -19,13 +19,16 @@ lambda_values = np.linspace(0.0, 1.0, n_lambdas)
 parameters = [dict(ref="uniform", sigma=(0.05, 20.0, 1.02)),
         dict(ref="exp", sigma=(0.05, 5.0, 1.02), gamma=(0.2, 5.0, 1.02)),]
 print(pd.DataFrame(parameters))
+# Build the restraints once; each lambda only rescales the energies
+ensemble = biceps.Ensemble(0.0, energies)
+ensemble.initialize_restraints(input_data, parameters)
+# Workers attach the packed arrays read-only instead of holding their own copies
+biceps.PosteriorSampler(ensemble).publish_arrays(f"{outdir}/shared")
 ###### Multiprocessing Lambda values #######
 @biceps.multiprocess(iterable=lambda_values)
 def mp_lambdas(lam):
 #for lam in [0.0]:
-    ensemble = biceps.Ensemble(lam, energies)
-    ensemble.initialize_restraints(input_data, parameters)
-    sampler = biceps.PosteriorSampler(ensemble)
+    sampler = biceps.PosteriorSampler(ensemble.at_lambda(lam), shared=f"{outdir}/shared")
     sampler.sample(nsteps=nsteps, burn=0, print_freq=1000, verbose=0)
     sampler.traj.process_results(f"{outdir}/traj_lambda{lam}.npz")
 
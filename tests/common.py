@@ -0,0 +1,89 @@
+### Small ensembles and brute-force references shared by the tests
+
+import os
+import numpy as np
+import biceps
+from biceps.toolbox import logsumexp
+
+here = os.path.dirname(os.path.abspath(__file__))
+datasets = os.path.join(here, "..", "docs", "examples", "datasets")
+cineromycin = os.path.join(datasets, "cineromycin_B")
+apomyoglobin = os.path.join(datasets, "apomyoglobin")
+
+nstates = 10
+# coarse grids, so that the exact posterior can be summed by brute force
+parameters = [dict(ref="uniform", sigma=(0.05, 20.0, 1.2)),
+        dict(ref="exp", sigma=(0.05, 5.0, 1.2), gamma=(0.2, 5.0, 1.2))]
+
+
+def cineromycin_ensemble(lam=1.0, parameters=parameters):
+    energies = np.loadtxt(os.path.join(cineromycin, "cineromycinB_QMenergies.dat"))*627.509/0.5959
+    energies = energies[:nstates] - energies[:nstates].min()
+    input_data = biceps.toolbox.sort_data(os.path.join(cineromycin, "J_NOE"))[:nstates]
+    ensemble = biceps.Ensemble(lam, energies)
+    ensemble.initialize_restraints(input_data, parameters)
+    return ensemble
+
+
+def random_parameters(sampler, n, seed=0):
+    """Draw **n** random configurations of the nuisance parameters, as the
+    (parameters, parameter_indices) of each restraint."""
+
+    allowed = sampler.compile_nuisance_parameters()
+    rest_type, rest_index, indices = sampler.compile_parameter_layout()
+    rng = np.random.RandomState(seed)
+    configurations = []
+    for k in range(n):
+        ind = [rng.randint(len(allowed[j])) for j in range(len(rest_index))]
+        values = [allowed[j][ind[j]] for j in range(len(rest_index))]
+        configurations.append(([[values[j] for j in range(len(rest_index)) if rest_index[j] == i]
+            for i in range(max(rest_index)+1)],
+            [[ind[j] for j in range(len(rest_index)) if rest_index[j] == i]
+            for i in range(max(rest_index)+1)]))
+    return configurations
+
+
+def per_state_neglogP(sampler, state, parameters, parameter_indices):
+    """-ln P of a single state from the compute_neglogP of each restraint."""
+
+    result = sampler.energies[state] + sampler.logZ
+    for i,R in enumerate(sampler.ensemble[state]):
+        result += R.compute_neglogP(parameters[i], parameter_indices[i], R.sse)
+    return result
+
+
+def restraint_logsumexp(sampler):
+    """log of the sum of exp(-ln P) of the restraints of each state over
+    their nuisance parameter grids."""
+
+    allowed = sampler.compile_nuisance_parameters()
+    rest_type, rest_index, indices = sampler.compile_parameter_layout()
+    lse = np.zeros(sampler.nstates)
+    for i in range(max(rest_index)+1):
+        grids = [allowed[j] for j in range(len(rest_index)) if rest_index[j] == i]
+        for state in range(sampler.nstates):
+            R = sampler.ensemble[state][i]
+            u = [R.compute_neglogP([grids[k][ind[k]] for k in range(len(grids))], list(ind), R.sse)
+                    for ind in np.ndindex(*[len(g) for g in grids])]
+            lse[state] += logsumexp(-np.array(u))
+    return lse
+
+
+def exact_populations(sampler):
+    """Posterior populations of the states, summed over the nuisance parameters."""
+
+    log_p = -sampler.energies + restraint_logsumexp(sampler)
+    return np.exp(log_p - logsumexp(log_p))
+
+
+# Protection factors (apomyoglobin), from the contact count files of 4 states
+
+pf_states = [0, 1, 2, 3]
+pf_grid = dict(beta_c=[0.05, 0.25, 0.05], beta_h=[0.0, 5.2, 1.0], beta_0=[-10.0, 0.0, 2.0])
+
+
+def pf_ensemble(**kwargs):
+    input_data = [[os.path.join(apomyoglobin, "new_CS_PF", "%d.pf"%i)] for i in pf_states]
+    ensemble = biceps.Ensemble(1.0, np.linspace(0.0, 1.5, len(pf_states)))
+    ensemble.initialize_restraints(input_data, [dict(pf_grid, states=pf_states, **kwargs)])
+    return ensemble
@@ -0,0 +1,22 @@
+import os, glob
+import pytest
+from common import cineromycin_ensemble, apomyoglobin, pf_states
+
+
+@pytest.fixture(scope="module")
+def ensemble():
+    return cineromycin_ensemble()
+
+
+@pytest.fixture(scope="session")
+def contact_files(tmp_path_factory):
+    """Flat directories of the Nc and Nh contact count files of **pf_states**."""
+
+    path = tmp_path_factory.mktemp("contacts")
+    input_dir = os.path.join(apomyoglobin, "input", "apo_mb_ph7_input")
+    for key in ["Nc", "Nh"]:
+        os.makedirs(str(path/key))
+        for state in pf_states:
+            for filename in glob.glob(os.path.join(input_dir, "%s_all"%key, "x*", "*_state%03d.npy"%state)):
+                os.symlink(os.path.abspath(filename), str(path/key/os.path.basename(filename)))
+    return path
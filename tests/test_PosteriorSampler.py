@@ -0,0 +1,382 @@
+### Regression checks of PosteriorSampler against the per-state -ln P and
+### exact populations on small ensembles
+### $ python -m pytest -v tests
+
+import os, glob, pickle
+import numpy as np
+import pytest
+import biceps
+from biceps.toolbox import logsumexp
+
+from common import *
+
+
+def test_state_energies(ensemble):
+    sampler = biceps.PosteriorSampler(ensemble)
+    for values,ind in random_parameters(sampler, 20):
+        expected = [per_state_neglogP(sampler, state, values, ind) for state in range(nstates)]
+        assert np.allclose(sampler.state_energies(values, ind), expected, rtol=1e-10)
+        assert np.allclose([sampler.neglogP([state], values, ind) for state in range(nstates)],
+                expected, rtol=1e-10)
+
+
+def test_logZ(ensemble):
+    sampler = biceps.PosteriorSampler(ensemble)
+    assert np.isclose(sampler.logZ, np.log(np.sum(np.exp(-sampler.energies))))
+    # energies whose Boltzmann factors underflow
+    sampler.energies = 1000.0*sampler.energies + 1000.0
+    sampler.compute_logZ()
+    E0 = sampler.energies.min()
+    assert np.isfinite(sampler.logZ)
+    assert np.isclose(sampler.logZ, -E0 + np.log(np.sum(np.exp(-(sampler.energies - E0)))))
+
+
+@pytest.mark.parametrize("use_global_ref_sigma", [False, True])
+def test_reference_potentials(use_global_ref_sigma):
+    ensemble = cineromycin_ensemble(parameters=[dict(parameters[0], ref="exp"),
+        dict(parameters[1], ref="gaussian", use_global_ref_sigma=use_global_ref_sigma)])
+    biceps.PosteriorSampler(ensemble)
+    states = ensemble.to_list()
+    # exponential reference of the J couplings, one observable at a time
+    for j in range(len(states[0][0].get_observables('model'))):
+        r = [s[0].get_observables('model')[j] for s in states]
+        beta = sum(r)/(len(r)+1.0)
+        for k,s in enumerate(states):
+            assert np.isclose(s[0].neglog_exp_ref[j], np.log(beta) + r[k]/beta, rtol=1e-12)
+    for s in states:
+        R = s[0]
+        assert np.isclose(R.sum_neglog_exp_ref, np.sum(R.get_observables('weight')*R.neglog_exp_ref), rtol=1e-12)
+    # gaussian reference of the NOE distances
+    nobs = len(states[0][1].get_observables('model'))
+    mean, sigma = np.zeros(nobs), np.zeros(nobs)
+    for j in range(nobs):
+        r = np.array([s[1].get_observables('model')[j] for s in states])
+        mean[j] = r.mean()
+        sigma[j] = np.sqrt(np.sum((r - mean[j])**2.0)/(len(r)+1.0))
+    if use_global_ref_sigma:
+        sigma[:] = np.mean(sigma**-2.0)**-0.5
+    for s in states:
+        R = s[1]
+        model, weight = R.get_observables('model'), R.get_observables('weight')
+        expected = sum(weight[j]*(np.log(np.sqrt(2.0*np.pi)*sigma[j])
+            + (model[j] - mean[j])**2.0/(2.0*sigma[j]**2.0)) for j in range(nobs))
+        assert np.isclose(R.sum_neglog_gaussian_ref, expected, rtol=1e-12)
+
+
+@pytest.mark.parametrize("table_memory", [256., 0.])
+def test_lookup_neglogP(ensemble, table_memory):
+    sampler = biceps.PosteriorSampler(ensemble, table_memory=table_memory)
+    allowed = sampler.compile_nuisance_parameters()
+    rest_type, rest_index, indices = sampler.compile_parameter_layout()
+    assert sampler.build_energy_table(allowed, rest_index) == (table_memory > 0)
+    for repeat in range(2): # the second pass hits the LRU cache
+        for values,ind in random_parameters(sampler, 10):
+            for state in range(nstates):
+                assert np.isclose(sampler.lookup_neglogP([state], values, ind),
+                        per_state_neglogP(sampler, state, values, ind), rtol=1e-10)
+    if table_memory == 0:
+        assert sampler.energy_cache.hit_rate() > 0
+
+
+def test_shared_arrays(ensemble, tmp_path):
+    path = str(tmp_path/"shared")
+    biceps.PosteriorSampler(ensemble.at_lambda(0.0)).publish_arrays(path)
+    for nreplicas in [1, 3]:
+        sampler = biceps.PosteriorSampler(ensemble, nreplicas=nreplicas)
+        shared = biceps.PosteriorSampler(ensemble, nreplicas=nreplicas, shared=path)
+        assert not shared.reference_built
+        rng = np.random.RandomState(1)
+        for values,ind in random_parameters(sampler, 10):
+            states = rng.randint(nstates, size=nreplicas)
+            assert np.isclose(shared.neglogP(states, values, ind),
+                    sampler.neglogP(states, values, ind), rtol=1e-10)
+        assert not shared.reference_built
+
+
+def test_pickled_shared_sampler(tmp_path):
+    # a fresh ensemble, whose reference potentials were never built
+    ensemble = cineromycin_ensemble()
+    path = str(tmp_path/"shared")
+    biceps.PosteriorSampler(cineromycin_ensemble()).publish_arrays(path)
+    for nreplicas in [1, 2]:
+        shared = biceps.PosteriorSampler(ensemble, nreplicas=nreplicas, shared=path)
+        restored = pickle.loads(pickle.dumps(shared))
+        assert restored.shared is None
+        rng = np.random.RandomState(2)
+        for values,ind in random_parameters(shared, 10):
+            states = rng.randint(nstates, size=nreplicas)
+            assert np.isclose(restored.neglogP(states, values, ind),
+                    shared.neglogP(states, values, ind), rtol=1e-10)
+
+
+def test_pf_results_store_contact_counts(contact_files, tmp_path):
+    ensemble = pf_ensemble(ref="exp", Ncs_fi=str(contact_files/"Nc"), Nhs_fi=str(contact_files/"Nh"))
+    np.random.seed(1)
+    sampler = biceps.PosteriorSampler(ensemble)
+    sampler.sample(500)
+    sampler.traj.process_results(str(tmp_path/"traj.npz"))
+    model = sampler.traj.results['model'][0]
+    R = ensemble.to_list()[0][0]
+    assert sorted(model.keys()) == ["Nc", "Nh"]
+    assert model["Nc"].shape == (len(pf_states),)+R.Ncs[:,:,:R.n].shape
+    assert model["Nh"].shape == (len(pf_states),)+R.Nhs[:,:,:R.n].shape
+
+
+@pytest.mark.parametrize("ref,use_global_ref_sigma", [("uniform", False), ("exp", False),
+    ("gaussian", False), ("gaussian", True)])
+def test_lazy_pf(contact_files, ref, use_global_ref_sigma):
+    kwargs = dict(ref=ref, use_global_ref_sigma=use_global_ref_sigma,
+            Ncs_fi=str(contact_files/"Nc"), Nhs_fi=str(contact_files/"Nh"))
+    eager = biceps.PosteriorSampler(pf_ensemble(**kwargs))
+    lazy = biceps.PosteriorSampler(pf_ensemble(lazy=True, **kwargs), table_memory=0)
+    for values,ind in random_parameters(eager, 20):
+        expected = [per_state_neglogP(eager, state, values, ind) for state in range(len(pf_states))]
+        assert np.allclose(eager.state_energies(values, ind), expected, rtol=1e-10)
+        assert np.allclose(lazy.state_energies(values, ind), expected, rtol=1e-8)
+        assert np.allclose([lazy.neglogP([state], values, ind) for state in range(len(pf_states))],
+                expected, rtol=1e-8)
+
+
+def test_lazy_pf_results(contact_files, tmp_path):
+    ensemble = pf_ensemble(ref="gaussian", lazy=True, Ncs_fi=str(contact_files/"Nc"),
+            Nhs_fi=str(contact_files/"Nh"))
+    np.random.seed(1)
+    sampler = biceps.PosteriorSampler(ensemble)
+    sampler.sample(500)
+    sampler.traj.process_results(str(tmp_path/"traj.npz"))
+    R = ensemble.to_list()[0][0]
+    assert R.sse is None
+    model = sampler.traj.results['model'][0]
+    # the contact counts of each state, not the nuisance grid of each residue
+    nbytes = sum([array.nbytes for array in model.values()])
+    assert nbytes == len(pf_states)*8*(R.Ncs[:,:,:R.n].size + R.Nhs[:,:,:R.n].size)
+    assert nbytes < len(pf_states)*R.n*8*np.prod(R.nuisance_shape())
+
+
+def test_published_replica_models(ensemble, tmp_path):
+    single, replicas = str(tmp_path/"single"), str(tmp_path/"replicas")
+    biceps.PosteriorSampler(ensemble).publish_arrays(single)
+    biceps.PosteriorSampler(ensemble, nreplicas=2).publish_arrays(replicas)
+    assert not glob.glob(os.path.join(single, "*_model.npy"))
+    assert len(glob.glob(os.path.join(replicas, "*_model.npy"))) == 2
+    sampler = biceps.PosteriorSampler(ensemble, nreplicas=2)
+    rng = np.random.RandomState(3)
+    for path in [single, replicas]:
+        shared = biceps.PosteriorSampler(ensemble, nreplicas=2, shared=path)
+        assert (shared.replica_models is None) == (path == single)
+        for values,ind in random_parameters(sampler, 5):
+            states = rng.randint(nstates, size=2)
+            assert np.isclose(shared.neglogP(states, values, ind),
+                    sampler.neglogP(states, values, ind), rtol=1e-10)
+
+
+def test_pf_replicas_require_precomputed(contact_files):
+    ensemble = pf_ensemble(ref="exp", Ncs_fi=str(contact_files/"Nc"), Nhs_fi=str(contact_files/"Nh"))
+    with pytest.raises(ValueError):
+        biceps.PosteriorSampler(ensemble, nreplicas=2)
+    with pytest.raises(ValueError):
+        biceps.PosteriorSampler(ensemble).compile_replica_models()
+
+
+def test_cache_summary(ensemble, capsys):
+    np.random.seed(1)
+    biceps.PosteriorSampler(ensemble, nreplicas=2).sample(1000)
+    assert "Energy cache" not in capsys.readouterr().out
+    np.random.seed(1)
+    biceps.PosteriorSampler(ensemble, table_memory=0).sample(1000)
+    assert "Energy cache" in capsys.readouterr().out
+
+
+def test_multiple_try_populations(ensemble):
+    exact = exact_populations(biceps.PosteriorSampler(ensemble))
+    np.random.seed(6)
+    sampler = biceps.PosteriorSampler(ensemble)
+    sampler.sample(50000, ntries=5)
+    populations = sampler.traj.state_counts/float(np.sum(sampler.traj.state_counts))
+    assert np.abs(populations - exact).max() < 0.03
+    with pytest.raises(ValueError):
+        biceps.PosteriorSampler(ensemble, nreplicas=2).sample(10, ntries=5)
+
+
+
+def test_sampled_populations(ensemble):
+    exact = exact_populations(biceps.PosteriorSampler(ensemble))
+    np.random.seed(2)
+    sampler = biceps.PosteriorSampler(ensemble)
+    sampler.sample(100000)
+    populations = sampler.traj.state_counts/float(np.sum(sampler.traj.state_counts))
+    assert np.abs(populations - exact).max() < 0.03
+
+
+def test_warm_start(ensemble, tmp_path):
+    exact = exact_populations(biceps.PosteriorSampler(ensemble))
+    sampler = biceps.PosteriorSampler(ensemble)
+    allowed = sampler.compile_nuisance_parameters()
+    rest_type, rest_index, indices = sampler.compile_parameter_layout()
+    # brute-force MAP: each restraint is minimized over its own grid
+    total, best = sampler.energies + sampler.logZ, [[] for state in range(nstates)]
+    for i in range(max(rest_index)+1):
+        grids = [allowed[j] for j in range(len(rest_index)) if rest_index[j] == i]
+        for state in range(nstates):
+            R = sampler.ensemble[state][i]
+            u = {ind: R.compute_neglogP([grids[k][ind[k]] for k in range(len(grids))], list(ind), R.sse)
+                    for ind in np.ndindex(*[len(g) for g in grids])}
+            ind = min(u, key=u.get)
+            total[state] += u[ind]
+            best[state].extend(ind)
+    state, indices = sampler.warm_start("map")
+    assert list(state) == [np.argmin(total)]
+    assert list(indices) == best[np.argmin(total)]
+    np.random.seed(3)
+    sampler.sample(50000)
+    populations = sampler.traj.state_counts/float(np.sum(sampler.traj.state_counts))
+    assert np.abs(populations - exact).max() < 0.03
+
+    # restart from the final configuration of the sampler, its pickle, its
+    # trajectory and the stored results
+    biceps.toolbox.save_object(sampler, str(tmp_path/"sampler.pkl"))
+    sampler.traj.process_results(str(tmp_path/"traj.npz"))
+    frame = sampler.traj.trajectory[-1]
+    for source,expected in [(sampler, (sampler.state, sampler.indices)),
+            (str(tmp_path/"sampler.pkl"), (sampler.state, sampler.indices)),
+            (sampler.traj, (frame[3], np.concatenate(frame[4]))),
+            (str(tmp_path/"traj.npz"), (frame[3], np.concatenate(frame[4])))]:
+        state, indices = biceps.PosteriorSampler(ensemble).warm_start(source)
+        assert list(state) == list(expected[0]) and list(indices) == list(expected[1])
+    with pytest.raises(ValueError):
+        biceps.PosteriorSampler(ensemble).warm_start(biceps.PosteriorSampler(ensemble))
+
+
+def test_time_budget(ensemble):
+    np.random.seed(4)
+    sampler = biceps.PosteriorSampler(ensemble, freq_save_traj=10)
+    sampler.sample(None, time_budget=0.5)
+    traj = sampler.traj
+    assert 0 < traj.nsteps < 2**62
+    assert len(traj.state_trace) == traj.nsteps
+    assert np.sum(traj.state_counts) == traj.nsteps + nstates # pseudo-counts
+    assert len(traj.trajectory) == (traj.nsteps+9)//10
+    for hist in traj.sampled_parameters:
+        assert np.sum(hist) == traj.nsteps
+    # the stored energies are -ln P of the stored configurations
+    allowed = sampler.compile_nuisance_parameters()
+    for frame in traj.trajectory[::max(1, len(traj.trajectory)//50)]:
+        ind = frame[4]
+        values, offset = [], 0
+        for group in ind:
+            values.append([allowed[offset+k][j] for k,j in enumerate(group)])
+            offset += len(group)
+        assert np.isclose(frame[1], per_state_neglogP(sampler, frame[3][0], values, ind), rtol=1e-10)
+    # a budget that is not reached leaves the random stream unchanged
+    traces = []
+    for time_budget in [None, 1000.]:
+        np.random.seed(4)
+        sampler = biceps.PosteriorSampler(ensemble)
+        sampler.sample(3000, time_budget=time_budget)
+        traces.append((list(sampler.traj.state_trace), repr(sampler.traj.trajectory)))
+    assert traces[0] == traces[1]
+    with pytest.raises(ValueError):
+        biceps.PosteriorSampler(ensemble).sample(None)
+
+
+def test_reservoir(ensemble, tmp_path):
+    sampler = biceps.PosteriorSampler(ensemble, freq_save_traj=10)
+    exact = exact_populations(sampler)
+    # exact posterior mean of -ln P, from the conditional means of each restraint
+    allowed = sampler.compile_nuisance_parameters()
+    rest_type, rest_index, indices = sampler.compile_parameter_layout()
+    mean = sampler.energies + sampler.logZ
+    for i in range(max(rest_index)+1):
+        grids = [allowed[j] for j in range(len(rest_index)) if rest_index[j] == i]
+        for state in range(nstates):
+            R = sampler.ensemble[state][i]
+            u = np.array([R.compute_neglogP([grids[k][ind[k]] for k in range(len(grids))], list(ind), R.sse)
+                    for ind in np.ndindex(*[len(g) for g in grids])])
+            mean[state] += np.sum(np.exp(-u - logsumexp(-u))*u)
+    np.random.seed(5)
+    sampler.sample(100000, reservoir=200)
+    traj = sampler.traj
+    assert len(traj.state_trace) == 0
+    assert len(traj.trajectory) == 200 and traj.reservoir == dict(size=200, seen=10000)
+    populations = traj.state_counts/float(np.sum(traj.state_counts))
+    assert np.abs(populations - exact).max() < 0.03
+    assert traj.energy_stats["n"] == 100000
+    assert abs(traj.energy_stats["mean"] - np.dot(exact, mean)) < 0.15
+    traj.process_results(str(tmp_path/"traj.npz"))
+    steps = [frame[0] for frame in traj.results['trajectory']]
+    assert steps == sorted(set(steps)) and all(step%10 == 0 for step in steps)
+
+
+def test_decimation(ensemble):
+    runs = []
+    for max_snapshots in [None, 100]:
+        np.random.seed(6)
+        sampler = biceps.PosteriorSampler(ensemble, freq_save_traj=10, max_snapshots=max_snapshots)
+        sampler.sample(20000)
+        runs.append(sampler.traj)
+    full, decimated = runs
+    assert len(decimated.trajectory) <= 100 and decimated.freq_save_traj == 320
+    # the kept snapshots are those of the full run on the final interval
+    keep = [i for i,frame in enumerate(full.trajectory) if frame[0]%decimated.freq_save_traj == 0]
+    assert repr(decimated.trajectory) == repr([full.trajectory[i] for i in keep])
+    assert repr(decimated.traces) == repr([full.traces[i] for i in keep])
+    assert list(decimated.state_trace) == list(full.state_trace)
+
+
+def test_progress_freq_keeps_random_stream(ensemble):
+    traces = []
+    for progress_freq in [1000, 7]:
+        np.random.seed(7)
+        sampler = biceps.PosteriorSampler(ensemble)
+        sampler.sample(3000, progress_freq=progress_freq)
+        traces.append((list(sampler.traj.state_trace), repr(sampler.traj.trajectory)))
+    assert traces[0] == traces[1]
+
+
+def replica_reference(sampler, states, parameters):
+    """-ln P of replicas from the replica-averaged model observables, written
+    out for the J (uniform reference) and NOE (exponential reference) restraints."""
+
+    result = np.sum(sampler.energies[states]) + len(states)*sampler.logZ
+    for i in range(2):
+        R = sampler.ensemble[states[0]][i]
+        model = np.mean([sampler.ensemble[s][i].get_observables('model') for s in states], axis=0)
+        w, exp = R.get_observables('weight'), R.get_observables('exp')
+        sigma = parameters[i][0]
+        gamma = parameters[i][1] if i == 1 else 1.0
+        sse = np.sum(w*(gamma*exp - model)**2.0)
+        result += np.sum(w)*np.log(sigma) + sse/(2.0*sigma**2.0) + np.sum(w)/2.0*np.log(2.0*np.pi)
+        if R.ref == "exp":
+            result -= np.sum([sampler.ensemble[s][i].sum_neglog_exp_ref for s in states])
+    return result
+
+
+def test_replica_neglogP(ensemble):
+    for nreplicas in [2, 3]:
+        sampler = biceps.PosteriorSampler(ensemble, nreplicas=nreplicas)
+        rng = np.random.RandomState(nreplicas)
+        for values,ind in random_parameters(sampler, 10):
+            states = rng.randint(nstates, size=nreplicas)
+            assert np.isclose(sampler.neglogP(states, values, ind),
+                    replica_reference(sampler, states, values), rtol=1e-10)
+        # the running sums of the model observables stay consistent
+        np.random.seed(nreplicas)
+        sampler.sample(2000)
+        allowed = sampler.compile_nuisance_parameters()
+        values = [allowed[k][sampler.indices[k]] for k in range(len(sampler.indices))]
+        assert np.isclose(sampler.E, replica_reference(sampler, sampler.state, [values[:1], values[1:]]),
+                rtol=1e-10)
+
+
+def test_expanded_ensemble_populations(ensemble):
+    exact = exact_populations(biceps.PosteriorSampler(ensemble))
+    np.random.seed(3)
+    sampler = biceps.PosteriorSampler(ensemble.at_lambda(0.0), lambdas=[0.0, 0.5, 1.0])
+    sampler.sample(200000)
+    counts = sampler.trajs[-1].state_counts
+    assert np.abs(counts/float(np.sum(counts)) - exact).max() < 0.05
+    # the Wang-Landau weights converge to minus the log ratio of the normalizers
+    lse = restraint_logsumexp(biceps.PosteriorSampler(ensemble))
+    log_norm = np.array([logsumexp(-lam*ensemble.unscaled_energies + lse) - logsumexp(-lam*ensemble.unscaled_energies)
+            for lam in sampler.lambdas])
+    assert np.allclose(sampler.lambda_weights - sampler.lambda_weights[0], -(log_norm - log_norm[0]), atol=0.05)
@@ -0,0 +1,148 @@
+### Regression checks of the restraints against brute-force evaluations
+### $ python -m pytest -v tests
+
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import biceps
+
+from common import *
+
+
+def pf_model(R):
+    """ln PF of every residue over the full nuisance parameter grid, with
+    shape (beta_c, beta_h, beta_0, xcs, xhs, bs, residues)."""
+
+    bc, bh, b0, xc, xh, b = np.ix_(R.allowed_beta_c, R.allowed_beta_h, R.allowed_beta_0,
+            np.arange(len(R.allowed_xcs)), np.arange(len(R.allowed_xhs)), np.arange(len(R.allowed_bs)))
+    return (bc[...,np.newaxis]*R.Ncs[xc,b][...,:R.n] + bh[...,np.newaxis]*R.Nhs[xh,b][...,:R.n]
+            + b0[...,np.newaxis])
+
+
+def test_pf_model(contact_files):
+    ensemble = pf_ensemble(ref="exp", Ncs_fi=str(contact_files/"Nc"), Nhs_fi=str(contact_files/"Nh"))
+    biceps.PosteriorSampler(ensemble) # builds the reference potentials
+    for s in ensemble.to_list():
+        R = s[0]
+        model = pf_model(R)
+        w, exp = R.get_observables('weight'), R.get_observables('exp')
+        assert np.allclose(R.get_observables('model'), np.moveaxis(model, -1, 0))
+        assert np.allclose(R.sse, np.sum(w*(model - exp)**2.0, axis=-1), rtol=1e-8, atol=1e-8)
+        assert np.allclose(R.sum_neglog_exp_ref, np.sum(w*np.maximum(-model, 0.0), axis=-1))
+
+
+def test_at_lambda(ensemble):
+    view = ensemble.at_lambda(0.25)
+    assert view.lam == 0.25 and ensemble.lam == 1.0
+    assert np.allclose(view.energies, 0.25*ensemble.unscaled_energies)
+    assert np.allclose(ensemble.energies, ensemble.unscaled_energies)
+    # the restraints are shared, the containers are not
+    assert all(a is b for s,t in zip(view.to_list(), ensemble.to_list()) for a,b in zip(s,t))
+    unscaled = ensemble.unscaled_energies.copy()
+    view.to_list()[0].append(None)
+    view.to_list().append([])
+    view.unscaled_energies[0] += 1.0
+    assert len(ensemble.to_list()) == nstates
+    assert all(len(s) == 2 for s in ensemble.to_list())
+    assert np.array_equal(ensemble.unscaled_energies, unscaled)
+    # a sampler of the view matches a sampler of an ensemble built at that lambda
+    built = biceps.PosteriorSampler(cineromycin_ensemble(lam=0.25))
+    sampler = biceps.PosteriorSampler(ensemble.at_lambda(0.25))
+    assert np.isclose(sampler.logZ, built.logZ)
+    for values,ind in random_parameters(sampler, 5):
+        assert np.allclose(sampler.state_energies(values, ind), built.state_energies(values, ind), rtol=1e-10)
+
+
+@pytest.mark.parametrize("log_normal", [False, True])
+def test_noe_sse(log_normal):
+    ensemble = cineromycin_ensemble(parameters=[parameters[0], dict(parameters[1], log_normal=log_normal)])
+    states = ensemble.to_list()
+    for s in states:
+        R = s[1]
+        exp, model = R.get_observables('exp'), R.get_observables('model')
+        weight = R.get_observables('weight')
+        for g,gamma in enumerate(R.allowed_gamma):
+            if log_normal:
+                sse = sum(weight[j]*np.log(model[j]/(gamma*exp[j]))**2.0 for j in range(len(exp)))
+            else:
+                sse = sum(weight[j]*(gamma*exp[j] - model[j])**2.0 for j in range(len(exp)))
+            assert np.isclose(R.sse[g], sse, rtol=1e-8, atol=1e-10)
+        assert R.Ndof == np.sum(weight)
+        # each state holds a row of one (nstates, ngamma) array
+        assert R.sse.base is states[0][1].sse.base
+    assert states[0][1].sse.base.shape == (nstates, len(states[0][1].allowed_gamma))
+
+
+def test_initialize_restraints_from_arrays(ensemble):
+    files = biceps.toolbox.sort_data(os.path.join(cineromycin, "J_NOE"))[:nstates]
+    data = []
+    for k,restraint in enumerate(["J", "noe"]):
+        frames = [pd.read_pickle(state[k]) for state in files]
+        atoms = [c for c in frames[0].columns if c.startswith("atom_index")]
+        data.append(dict(restraint=restraint, exp=frames[0]["exp"].values,
+            model=np.array([frame["model"].values for frame in frames]),
+            restraint_index=frames[0]["restraint_index"].values, indices=frames[0][atoms].values))
+    arrays = biceps.Ensemble(ensemble.lam, ensemble.energies)
+    arrays.initialize_restraints_from_arrays(data, parameters)
+    for a,b in zip(ensemble.to_list(), arrays.to_list()):
+        for R,S in zip(a, b):
+            assert type(R) is type(S) and R.Ndof == S.Ndof
+            assert np.allclose(R.sse, S.sse, rtol=1e-12)
+    sampler, expected = biceps.PosteriorSampler(arrays), biceps.PosteriorSampler(ensemble)
+    for values,ind in random_parameters(sampler, 20):
+        assert np.allclose(sampler.state_energies(values, ind), expected.state_energies(values, ind), rtol=1e-12)
+    assert np.allclose(exact_populations(sampler), exact_populations(expected), rtol=1e-10)
+
+
+def test_restraint_store(ensemble, tmp_path):
+    # Preparation of the first states, into per-state files and into stores
+    for name in ["NOE", "J_coupling"]:
+        os.mkdir(str(tmp_path/name))
+        for state in range(nstates):
+            os.symlink(os.path.join(cineromycin, name, "%d.txt"%state), str(tmp_path/name/("%d.txt"%state)))
+    for outdir,store in [("files", False), ("store", True)]:
+        os.mkdir(str(tmp_path/outdir))
+        prep = biceps.Preparation(nstates=nstates, outdir=str(tmp_path/outdir),
+                top_file=os.path.join(cineromycin, "cineromycinB_pdbs", "0.fixed.pdb"))
+        prep.prep_J(os.path.join(cineromycin, "exp_Jcoupling.txt"), str(tmp_path/"J_coupling"/"*.txt"),
+                indices=os.path.join(cineromycin, "atom_indice_J.txt"), store=store)
+        prep.prep_noe(os.path.join(cineromycin, "noe_distance.txt"), str(tmp_path/"NOE"/"*.txt"),
+                indices=os.path.join(cineromycin, "atom_indice_noe.txt"), store=store)
+    assert sorted(os.listdir(str(tmp_path/"store"))) == ["J.npz", "noe.npz"]
+    data = biceps.toolbox.read_restraint_store(str(tmp_path/"store"/"noe.npz"))
+    assert isinstance(data["model"], np.memmap) and data["model"].shape[0] == nstates
+
+    files = biceps.Ensemble(ensemble.lam, ensemble.energies)
+    files.initialize_restraints(biceps.toolbox.sort_data(str(tmp_path/"files")), parameters)
+    store = biceps.Ensemble(ensemble.lam, ensemble.energies)
+    store.initialize_restraints([str(tmp_path/"store"/"J.npz"), str(tmp_path/"store"/"noe.npz")], parameters)
+    for a,b in zip(files.to_list(), store.to_list()):
+        for R,S in zip(a, b):
+            assert type(R) is type(S) and R.Ndof == S.Ndof
+            assert np.array_equal(R.sse, S.sse)
+    sampler, expected = biceps.PosteriorSampler(store), biceps.PosteriorSampler(files)
+    for values,ind in random_parameters(sampler, 20):
+        assert np.array_equal(sampler.state_energies(values, ind), expected.state_energies(values, ind))
+
+
+def test_parallel_initialization(ensemble, contact_files):
+    input_data = biceps.toolbox.sort_data(os.path.join(cineromycin, "J_NOE"))[:nstates]
+    parallel = biceps.Ensemble(ensemble.lam, ensemble.energies)
+    parallel.initialize_restraints(input_data, parameters, nprocs=2)
+    pairs = [(ensemble, parallel)]
+    # protection factors, whose workers read the contact files
+    input_data = [[os.path.join(apomyoglobin, "new_CS_PF", "%d.pf"%i)] for i in pf_states]
+    pf = [dict(pf_grid, states=pf_states, ref="exp", Ncs_fi=str(contact_files/"Nc"), Nhs_fi=str(contact_files/"Nh"))]
+    pairs.append([])
+    for nprocs in [1, 2]:
+        pairs[-1].append(biceps.Ensemble(1.0, np.linspace(0.0, 1.5, len(pf_states))))
+        pairs[-1][-1].initialize_restraints(input_data, pf, nprocs=nprocs)
+    for serial,parallel in pairs:
+        for a,b in zip(serial.to_list(), parallel.to_list()):
+            for R,S in zip(a, b):
+                assert type(R) is type(S) and R.Ndof == S.Ndof
+                assert np.array_equal(R.sse, S.sse)
+        sampler, expected = biceps.PosteriorSampler(parallel), biceps.PosteriorSampler(serial)
+        for values,ind in random_parameters(sampler, 10):
+            assert np.array_equal(sampler.state_energies(values, ind), expected.state_energies(values, ind))
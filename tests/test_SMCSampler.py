@@ -0,0 +1,57 @@
+### Regression checks of SMCSampler against the per-state -ln P and exact
+### populations on small ensembles
+### $ python -m pytest -v tests
+
+import numpy as np
+import pytest
+import biceps
+from biceps.toolbox import logsumexp
+
+from common import *
+
+
+def test_smc_populations(ensemble):
+    exact = exact_populations(biceps.PosteriorSampler(ensemble))
+    np.random.seed(4)
+    results = biceps.SMCSampler(ensemble, nparticles=10000, lambdas=np.linspace(0.0, 1.0, 21)).sample()
+    assert np.abs(results['populations'][-1] - exact).max() < 0.03
+    # the BICePs score against the exact log normalizers at lambda=0 and 1
+    lse = restraint_logsumexp(biceps.PosteriorSampler(ensemble))
+    log_norm = [logsumexp(-lam*ensemble.unscaled_energies + lse) - logsumexp(-lam*ensemble.unscaled_energies)
+            for lam in [0.0, 1.0]]
+    assert np.isclose(results['BS'][-1], -(log_norm[1] - log_norm[0]), atol=0.05)
+
+
+@pytest.mark.parametrize("table_memory", [256., 0.])
+def test_smc_energies(ensemble, table_memory):
+    smc = biceps.SMCSampler(ensemble, nparticles=10, table_memory=table_memory)
+    assert (smc.sampler.energy_table is not None) == (table_memory > 0)
+    rng = np.random.RandomState(0)
+    states = rng.randint(nstates, size=50)
+    indices = np.array([rng.randint(n, size=50) for n in smc.n_allowed]).T
+    sampler = smc.sampler
+    expected = []
+    for state,ind in zip(states, indices):
+        values = [smc.allowed[k][ind[k]] for k in range(len(ind))]
+        expected.append(per_state_neglogP(sampler, state, [values[g] for g in smc.groups],
+            [list(ind[g]) for g in smc.groups]))
+    assert np.allclose(smc.energies(1.0, states, indices), expected, rtol=1e-10)
+    for state in range(3):
+        u = np.sum([logsumexp(-smc.restraint_grid(i, state)) for i in range(len(smc.groups))])
+        assert np.isclose(u, restraint_logsumexp(sampler)[state], rtol=1e-10)
+
+
+def test_smc_lazy_pf(contact_files):
+    kwargs = dict(ref="gaussian", Ncs_fi=str(contact_files/"Nc"), Nhs_fi=str(contact_files/"Nh"))
+    eager = biceps.SMCSampler(pf_ensemble(**kwargs), nparticles=10)
+    lazy = biceps.SMCSampler(pf_ensemble(lazy=True, **kwargs), nparticles=10)
+    assert eager.sampler.energy_table is not None and lazy.sampler.energy_table is None
+    # the gaussian reference of the lazy path is computed from sums over
+    # states, so compare to the scale of the energies
+    table = eager.sampler.energy_table[0]
+    atol = 1e-10*np.abs(table).max()
+    for state in range(len(pf_states)):
+        assert np.allclose(lazy.restraint_grid(0, state), eager.restraint_grid(0, state), rtol=1e-8, atol=atol)
+    allowed = lazy.sampler.compile_nuisance_parameters()
+    rest_type, rest_index, indices = lazy.sampler.compile_parameter_layout()
+    assert np.allclose(lazy.sampler.restraint_table(0, allowed, rest_index), table, rtol=1e-8, atol=atol)
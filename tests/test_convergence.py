@@ -0,0 +1,35 @@
+### Regression checks of the online convergence statistics
+### $ python -m pytest -v tests
+
+import numpy as np
+import pytest
+import biceps
+from biceps.convergence import ConvergenceMonitor
+
+from common import *
+
+
+def test_monitor_ess_autocorrelated():
+    # a discretized AR(1) chain with an integrated autocorrelation time of
+    # (1+phi)/(1-phi) = 199 steps, much longer than the initial batches
+    rng = np.random.RandomState(0)
+    phi, n = 0.99, 200000
+    monitor = ConvergenceMonitor([201], nstates=1, batch_size=10)
+    x = 0.0
+    for step in range(n):
+        x = phi*x + rng.normal()*np.sqrt(1.0-phi**2)*20.0
+        monitor.update([int(np.clip(np.rint(x+100.0), 0, 200))], np.zeros(1, dtype=int))
+    assert monitor.batch_size**2 >= n/2 and monitor.batch_size**2 <= 2*n
+    ess = monitor.ess()[0]
+    assert 0.5*n/199.0 < ess < 2.0*n/199.0
+
+
+def test_target_ess(ensemble):
+    exact = exact_populations(biceps.PosteriorSampler(ensemble))
+    np.random.seed(5)
+    sampler = biceps.PosteriorSampler(ensemble)
+    sampler.sample(2000000, target_ess=300, check_freq=10000)
+    assert sampler.traj.nsteps < 2000000
+    assert np.all(np.array(sampler.traj.convergence["ess"]) >= 300)
+    populations = sampler.traj.state_counts/float(np.sum(sampler.traj.state_counts))
+    assert np.abs(populations - exact).max() < 0.05
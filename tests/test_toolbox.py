@@ -0,0 +1,145 @@
+### Regression checks of the toolbox helpers
+### $ python -m pytest -v tests
+
+import os, shutil, copy
+import numpy as np
+import pytest
+import biceps
+
+from common import *
+
+
+def copy_input_data(path):
+    """Copy the cineromycin B input files of the first **nstates** states to **path**."""
+
+    input_data = biceps.toolbox.sort_data(os.path.join(cineromycin, "J_NOE"))[:nstates]
+    os.makedirs(str(path))
+    copied = []
+    for files in input_data:
+        copied.append([shutil.copy(filename, str(path)) for filename in files])
+    return copied
+
+
+def test_ensemble_cache(tmp_path, monkeypatch):
+    input_data = copy_input_data(tmp_path/"input")
+    energies = np.linspace(0.0, 2.0, nstates)
+    cache = biceps.toolbox.EnsembleCache(str(tmp_path/"cache"))
+    built = biceps.Ensemble(1.0, energies)
+    built.initialize_restraints(input_data, parameters, cache=cache)
+    assert len(cache.entries()) == 1
+    # a hit never initializes the states
+    def fail(*args, **kwargs): raise AssertionError("cache miss")
+    monkeypatch.setattr(biceps.Ensemble, "_initialize_states", fail)
+    cached = biceps.Ensemble(0.5, energies)
+    cached.initialize_restraints(input_data, parameters, cache=cache)
+    for a,b in zip(built.to_list(), cached.to_list()):
+        for Ra,Rb in zip(a,b):
+            assert np.array_equal(Ra.sse, Rb.sse)
+        assert b[0].energy == 0.5*a[0].energy
+    monkeypatch.undo()
+    key = cache.key(input_data, energies, parameters)
+    assert cache.get(key) is not None
+    # editing an input file changes the key
+    with open(input_data[0][0], "a") as file: file.write("\n")
+    assert cache.key(input_data, energies, parameters) != key
+    cache.invalidate(key)
+    assert cache.get(key) is None and len(cache.entries()) == 0
+
+
+def test_ensemble_cache_key_arrays(tmp_path):
+    cache = biceps.toolbox.EnsembleCache(str(tmp_path/"cache"))
+    a = np.zeros(10000)
+    b = a.copy()
+    b[5000] = 1.0
+    assert repr(a) == repr(b)
+    keys = [cache.key([], np.zeros(2), [dict(prior=x)]) for x in [a, b, a.astype(np.float32), a.reshape(100, 100)]]
+    assert len(set(keys)) == len(keys)
+    assert cache.key([], np.zeros(2), [dict(prior=a.copy())]) == keys[0]
+
+
+def test_ensemble_cache_eviction(tmp_path):
+    cache = biceps.toolbox.EnsembleCache(str(tmp_path/"cache"), max_size=2.5)
+    value = np.zeros(2**17) # 1 MB
+    for k,key in enumerate(["a", "b", "c"]):
+        cache.put(key, value)
+        os.utime(cache.filename(key), (1000.0*(k+1), 1000.0*(k+1)))
+    # "b" and "c" fit, "a" was least recently used
+    assert sorted(os.path.basename(f) for f in cache.entries()) == ["b.pkl", "c.pkl"]
+    cache.get("b") # now the most recently used
+    cache.put("d", value)
+    assert sorted(os.path.basename(f) for f in cache.entries()) == ["b.pkl", "d.pkl"]
+    assert cache.size() <= 2.5
+
+
+def test_rle_roundtrip(ensemble, tmp_path):
+    np.random.seed(1)
+    sampler = biceps.PosteriorSampler(ensemble, freq_save_traj=10)
+    sampler.sample(5000)
+    sampler.traj.process_results(str(tmp_path/"traj.npz"))
+    results = copy.deepcopy(sampler.traj.results)
+    compressed = biceps.toolbox.compress_trajectory(copy.deepcopy(results))
+    assert len(compressed['trajectory']) < len(results['trajectory'])
+    assert np.sum(compressed['run_lengths']) == len(results['trajectory'])
+    assert np.sum(compressed['state_trace']['lengths']) == len(results['state_trace'])
+    restored = biceps.toolbox.decompress_trajectory(compressed)
+    assert list(restored['state_trace']) == list(results['state_trace'])
+    assert repr(restored['trajectory']) == repr(results['trajectory'])
+    assert repr(restored['traces']) == repr(results['traces'])
+    # the compressed npz file decodes to the same trajectory
+    sampler.traj.process_results(str(tmp_path/"rle.npz"), compress=True)
+    stored = np.load(str(tmp_path/"rle.npz"), allow_pickle=True)['arr_0'].item()
+    assert stored['rle']
+    stored = biceps.toolbox.decompress_trajectory(stored)
+    assert list(stored['state_trace']) == list(results['state_trace'])
+    assert repr(stored['trajectory']) == repr(results['trajectory'])
+
+
+def test_discard_burn_in(ensemble, tmp_path):
+    exact = exact_populations(biceps.PosteriorSampler(ensemble))
+    np.random.seed(8)
+    sampler = biceps.PosteriorSampler(ensemble, freq_save_traj=10)
+    sampler.sample(50000)
+    # an arbitrary equilibration point, generally inside a run of the compressed trajectory
+    sampler.traj.equilibration = eq = dict(index=1237, step=12370)
+    sampler.traj.process_results(str(tmp_path/"traj.npz"))
+    results = copy.deepcopy(sampler.traj.results)
+    trimmed = biceps.toolbox.discard_burn_in(copy.deepcopy(results))
+    assert trimmed['trajectory'][0][0] == eq["step"]
+    assert repr(trimmed['trajectory']) == repr(results['trajectory'][eq["index"]:])
+    assert list(trimmed['state_trace']) == list(results['state_trace'][eq["step"]:])
+    for k,hist in enumerate(trimmed['sampled_parameters']):
+        assert hist.sum() == 10*len(trimmed['trajectory'])
+        expected = np.bincount([np.concatenate(frame[4])[k] for frame in trimmed['trajectory']],
+                minlength=len(hist))*10
+        assert np.array_equal(hist, expected)
+    # the run-length encoded trajectory is trimmed the same way
+    rle = biceps.toolbox.discard_burn_in(biceps.toolbox.compress_trajectory(copy.deepcopy(results)))
+    for k in range(len(trimmed['sampled_parameters'])):
+        assert np.array_equal(rle['sampled_parameters'][k], trimmed['sampled_parameters'][k])
+    rle = biceps.toolbox.decompress_trajectory(rle)
+    assert list(rle['state_trace']) == list(trimmed['state_trace'])
+    assert repr(rle['trajectory']) == repr(trimmed['trajectory'])
+    populations = np.bincount(trimmed['state_trace'], minlength=nstates)/float(len(trimmed['state_trace']))
+    assert np.abs(populations - exact).max() < 0.05
+
+
+def test_contact_store(contact_files, tmp_path):
+    filename = str(tmp_path/"contacts.npz")
+    biceps.toolbox.write_contact_store(filename, str(contact_files/"Nc"), str(contact_files/"Nh"), states=pf_states)
+    store = biceps.toolbox.read_contact_store(filename)
+    assert isinstance(store["Nc"], np.memmap) and isinstance(store["Nh"], np.memmap)
+    assert np.array_equal(store["states"], pf_states)
+    for key,xs in [("Nc", store["xcs"]), ("Nh", store["xhs"])]:
+        assert store[key].shape[:3] == (len(pf_states), len(xs), len(store["bs"]))
+        for k,state in enumerate(pf_states):
+            for i,x in enumerate(xs):
+                for j,b in enumerate(store["bs"]):
+                    counts = np.load(str(contact_files/key/("%s_x%0.1f_b%d_state%03d.npy"%(key, x, b, state))))
+                    assert np.array_equal(store[key][k,i,j], counts)
+        assert np.array_equal(biceps.toolbox.read_contact_store(filename, mmap_mode=None)[key], store[key])
+    files = pf_ensemble(ref="exp", Ncs_fi=str(contact_files/"Nc"), Nhs_fi=str(contact_files/"Nh"))
+    packed = pf_ensemble(ref="exp", contacts=filename)
+    for a,b in zip(files.to_list(), packed.to_list()):
+        assert np.array_equal(a[0].Ncs, b[0].Ncs) and np.array_equal(a[0].Nhs, b[0].Nhs)
+        assert np.array_equal(a[0].sse, b[0].sse)
+        assert np.array_equal(a[0].sum_neglog_exp_ref, b[0].sum_neglog_exp_ref)